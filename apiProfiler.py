@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+# Instrumentation shared by the collectors: with --profile, every API call,
+# Redis round trip, wait and output write is recorded under an operation
+# name (e.g. 'cloudwatch.GetMetricData', 'redis.snapshot', 'sleep.backoff'),
+# with its latency histogram, errors, throttles, retries and the bytes
+# transferred where the client exposes them. A summary table is printed at
+# exit, and the data can also be written as JSON or OpenMetrics text.
+
+import atexit
+import bisect
+import collections
+import json
+import threading
+import time
+
+# The upper bounds (in seconds) of the latency histogram buckets, the last
+# bucket holding everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0)
+
+# The prefix of the OpenMetrics metric names
+METRIC_PREFIX = 'ecstats_'
+
+
+class OperationStats(object):
+    """The counters and latency histogram of one operation"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = collections.Counter()
+        self.throttled = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def get_quantile(self, quantile):
+        """Estimate a latency quantile from the histogram, interpolating
+        within its bucket
+        """
+        if self.calls == 0:
+            return 0.0
+        rank = quantile * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) \
+                    else self.max_seconds
+                return min(self.max_seconds, lower + (upper - lower) *
+                           (rank - seen) / count)
+            seen += count
+        return self.max_seconds
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': sum(self.errors.values()),
+            'error_codes': dict(self.errors),
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'p50_seconds': self.get_quantile(0.5),
+            'p95_seconds': self.get_quantile(0.95),
+            'p99_seconds': self.get_quantile(0.99),
+            'buckets': dict(zip(
+                [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                self.buckets)),
+        }
+
+
+class Measure(object):
+    """Time a block as a call of an operation; an exception escaping the
+    block is recorded as an error of the call
+    """
+
+    def __init__(self, profiler, operation):
+        self.profiler = profiler
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(
+            self.operation, time.monotonic() - self.start,
+            error=None if exc_type is None else exc_type.__name__)
+
+
+class NullMeasure(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_MEASURE = NullMeasure()
+
+
+class Profiler(object):
+    """Record the operations of a run, by operation name.
+
+    Recording does nothing until enable is called, so the collectors can
+    instrument their calls unconditionally. A single instance may be shared
+    by threads.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.output_path = None
+        self._operations = {}
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def enable(self, output_path=None):
+        """Start recording, and report at exit
+        Args:
+            output_path: also write the data to this file, as JSON when its
+                name ends with .json and as OpenMetrics text otherwise
+        """
+        self.enabled = True
+        self.output_path = output_path
+        self._start = time.monotonic()
+        atexit.register(self.report)
+
+    def _get(self, operation):
+        stats = self._operations.get(operation)
+        if stats is None:
+            stats = self._operations[operation] = OperationStats()
+        return stats
+
+    def record(self, operation, seconds, error=None, throttled=False,
+               retries=0, bytes_sent=0, bytes_received=0):
+        """Record a call of an operation
+        Args:
+            operation: the operation name, '<service>.<operation>'
+            seconds: the latency of the call
+            error: the error code or exception name if the call failed
+            throttled: the call failed because it was throttled
+            retries: the retries the client made within the call
+            bytes_sent, bytes_received: the bytes transferred by the call
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._get(operation)
+            stats.observe(seconds)
+            if error is not None:
+                stats.errors[error] += 1
+            stats.throttled += bool(throttled)
+            stats.retries += retries
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+
+    def add(self, operation, throttled=False, retries=0, bytes_sent=0,
+            bytes_received=0):
+        """Add to the counters of an operation, without recording a call,
+        e.g. for the HTTP attempts within a call
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._get(operation)
+            stats.throttled += bool(throttled)
+            stats.retries += retries
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+
+    def measure(self, operation):
+        """A context manager timing a block as a call of an operation"""
+        if not self.enabled:
+            return NULL_MEASURE
+        return Measure(self, operation)
+
+    def get_stats(self):
+        """The statistics of every operation, by operation name"""
+        with self._lock:
+            return {operation: stats.to_dict()
+                    for operation, stats in sorted(self._operations.items())}
+
+    def to_json(self):
+        return json.dumps({
+            'elapsed_seconds': time.monotonic() - self._start,
+            'operations': self.get_stats(),
+        }, indent=2)
+
+    def to_openmetrics(self):
+        """The data in the OpenMetrics text exposition format"""
+        stats = self.get_stats()
+        lines = []
+
+        def add_family(name, metric_type, help_text, samples):
+            lines.extend(format_metric_family(
+                METRIC_PREFIX + name, metric_type, help_text, samples))
+
+        for (name, key, help_text) in [
+                ('calls', 'calls', 'Calls made'),
+                ('errors', 'errors', 'Calls that failed'),
+                ('throttled', 'throttled', 'Calls that were throttled'),
+                ('retries', 'retries', 'Retries made'),
+                ('sent_bytes', 'bytes_sent', 'Bytes sent'),
+                ('received_bytes', 'bytes_received', 'Bytes received')]:
+            add_family(name, 'counter', help_text, [
+                ('_total', [('operation', operation)], operation_stats[key])
+                for operation, operation_stats in stats.items()])
+
+        samples = []
+        for operation, operation_stats in stats.items():
+            cumulative = 0
+            for bound, count in operation_stats['buckets'].items():
+                cumulative += count
+                samples.append(('_bucket', [('operation', operation),
+                                            ('le', bound)], cumulative))
+            samples.append(('_count', [('operation', operation)],
+                            operation_stats['calls']))
+            samples.append(('_sum', [('operation', operation)],
+                            operation_stats['seconds']))
+        add_family('latency_seconds', 'histogram', 'Call latency', samples)
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def print_summary(self):
+        stats = self.get_stats()
+        print("%-40s %8s %7s %9s %7s %10s %10s %9s %8s %8s %8s %8s" % (
+            "Operation", "Calls", "Errors", "Throttled", "Retries",
+            "Sent", "Received", "Total s", "p50 ms", "p95 ms", "p99 ms",
+            "Max ms"))
+        for operation, s in sorted(stats.items(), key=lambda item:
+                                   item[1]['seconds'], reverse=True):
+            print("%-40s %8d %7d %9d %7d %10s %10s %9.2f %8.1f %8.1f %8.1f "
+                  "%8.1f" % (
+                      operation, s['calls'], s['errors'], s['throttled'],
+                      s['retries'], format_bytes(s['bytes_sent']),
+                      format_bytes(s['bytes_received']), s['seconds'],
+                      s['p50_seconds'] * 1000, s['p95_seconds'] * 1000,
+                      s['p99_seconds'] * 1000, s['max_seconds'] * 1000))
+        print("Elapsed: %.2f s" % (time.monotonic() - self._start))
+
+    def report(self):
+        """Print the summary, and write the data to the output file"""
+        self.print_summary()
+        if self.output_path is not None:
+            with open(self.output_path, 'w') as f:
+                f.write(self.to_json() if self.output_path.endswith('.json')
+                        else self.to_openmetrics())
+            print("Profile written to %s" % self.output_path)
+
+
+def format_metric_family(name, metric_type, help_text, samples):
+    """Format a metric family in the OpenMetrics text exposition format
+    Args:
+        name: the metric family name
+        metric_type: e.g. counter, gauge or histogram
+        help_text: the description of the metric
+        samples: (name suffix, [(label, value)], value) tuples
+    Returns:
+        The lines of the family
+    """
+    lines = ['# TYPE %s %s' % (name, metric_type),
+             '# HELP %s %s' % (name, help_text)]
+    for (suffix, labels, value) in samples:
+        lines.append('%s%s{%s} %s' % (name, suffix, ','.join(
+            '%s="%s"' % (label, str(label_value).replace(
+                '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, label_value in labels), value))
+    return lines
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (count, unit)
+        count /= 1024.0
+
+
+# The profiler of the run, shared by all the modules
+PROFILER = Profiler()
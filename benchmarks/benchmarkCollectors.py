@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark the collectors end to end against local stand-ins of the
+# services they query, on synthetic fleets of growing sizes:
+#
+#   ec     pullElasticCacheStats.py against fakeAws (ElastiCache and
+#          CloudWatch answered in process, as with botocore's Stubber)
+#   azure  pullAzureCacheForRedisStats.py against fakeAzure (the management
+#          clients replaced by fakes)
+#   oss    pullRedisOpenSourceStats.py against fakeRedisServer (a local
+#          port per node, in separate processes)
+#
+# Every collector run happens in a fresh process, so that the peak RSS
+# reported is that of the run alone. The wall-clock time covers the
+# collection run, output included, but not the interpreter startup.
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+COLLECTORS = ['ec', 'azure', 'oss']
+
+# The nodes served by each fake Redis process, well within the file
+# descriptors a process may open (a listening socket and a connection per
+# node)
+NODES_PER_SERVER_PROCESS = 4000
+
+OSS_BASE_PORT = 20000
+
+# The prefix of the line a benchmark run reports its results on
+RESULT_PREFIX = 'BENCHMARK '
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_ec(args, out_dir):
+    from configparser import ConfigParser
+    from fakeAws import FakeAws
+    import pullElasticCacheStats
+
+    fake = FakeAws(args.nodes, args.api_latency, args.throttle_rate)
+    fake.install()
+    config = ConfigParser()
+    config.read_dict({'bench': {'aws_access_key_id': 'bench',
+                                'aws_secret_access_key': 'bench',
+                                'aws_session_token': 'bench',
+                                'region': 'us-east-1'}})
+    start = time.monotonic()
+    pullElasticCacheStats.process_aws_account(
+        config, 'bench', 'us-east-1', out_dir, args.workers or 1,
+        output_format=args.format)
+    return (time.monotonic() - start, args.nodes, fake.calls,
+            fake.datapoints)
+
+
+def run_azure(args, out_dir):
+    from fakeAzure import FakeAzure
+    import pullAzureCacheForRedisStats
+
+    fake = FakeAzure(args.nodes, args.api_latency, args.throttle_rate)
+    fake.install()
+    sys.argv = ['pullAzureCacheForRedisStats.py', '-d', out_dir,
+                '-f', args.format]
+    if args.workers is not None:
+        sys.argv += ['-w', str(args.workers)]
+    start = time.monotonic()
+    pullAzureCacheForRedisStats.main()
+    return (time.monotonic() - start, args.nodes, fake.calls,
+            fake.datapoints)
+
+
+def get_oss_fleet(nodes, shards, replicas):
+    """The fleet of the smallest number of DBs with at least nodes nodes"""
+    from fakeRedisServer import Fleet
+
+    nodes_per_db = shards * (1 + replicas)
+    return Fleet(max(1, -(-nodes // nodes_per_db)), shards, replicas,
+                 OSS_BASE_PORT)
+
+
+def get_server_stats(fleet):
+    """Sum up the commands served by every fake Redis process"""
+    import redis
+
+    calls = {}
+    connections = 0
+    for first in range(0, len(fleet), NODES_PER_SERVER_PROCESS):
+        client = redis.Redis(port=fleet.get_port(first))
+        stats = json.loads(client.execute_command('BENCHSTATS'))
+        client.close()
+        for command, count in stats['calls'].items():
+            calls[command] = calls.get(command, 0) + count
+        connections += stats['connections'] - 1
+    calls.pop('benchstats', None)
+    calls['connections'] = connections
+    return calls
+
+
+def run_oss(args, out_dir):
+    import pandas as pd
+    import pullRedisOpenSourceStats
+
+    fleet = get_oss_fleet(args.nodes, args.shards, args.replicas)
+    input_path = os.path.join(out_dir, 'input.xlsx')
+    pd.DataFrame({
+        'DB Name': ['bench-%05d' % db for db in range(fleet.dbs)],
+        'Redis Host': fleet.host,
+        'Port': fleet.get_seed_ports(),
+        'Password': None,
+        'User (ACL)': None,
+        'TLS': None,
+    }).to_excel(input_path, sheet_name='Redis Sizing Input', index=False)
+
+    start = time.monotonic()
+    pullRedisOpenSourceStats.process_file(
+        input_path, os.path.join(out_dir, 'OssStats.xlsx'), 0,
+        args.workers or 32, args.engine,
+        {'socket_connect_timeout': 10, 'socket_timeout': 10},
+        output_format=args.format)
+    elapsed = time.monotonic() - start
+    return (elapsed, len(fleet), get_server_stats(fleet), 0)
+
+
+def run_benchmark(args):
+    """Run one collector on one fleet, in this process, and report the
+    results on a RESULT_PREFIX line
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            (seconds, nodes, calls, datapoints) = {
+                'ec': run_ec, 'azure': run_azure, 'oss': run_oss,
+            }[args.run](args, out_dir)
+    calls = dict(calls)
+    throttled = calls.pop('Throttled', 0)
+    connections = calls.pop('connections', None)
+    print(RESULT_PREFIX + json.dumps({
+        'collector': args.run,
+        'nodes': nodes,
+        'seconds': round(seconds, 3),
+        'api_calls': sum(calls.values()),
+        'calls': calls,
+        'throttled': throttled,
+        'connections': connections,
+        'datapoints': datapoints,
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }))
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def serve_oss_fleet(fleet, latency):
+    """Start the fake Redis processes serving a fleet"""
+    servers = []
+    try:
+        for first in range(0, len(fleet), NODES_PER_SERVER_PROCESS):
+            servers.append(subprocess.Popen(
+                [sys.executable,
+                 os.path.join(BENCHMARKS_DIR, 'fakeRedisServer.py'),
+                 '--dbs', str(fleet.dbs), '--shards', str(fleet.shards),
+                 '--replicas', str(fleet.replicas),
+                 '--base-port', str(OSS_BASE_PORT),
+                 '--first-node', str(first),
+                 '--node-count', str(NODES_PER_SERVER_PROCESS),
+                 '--latency', str(latency)],
+                stdout=subprocess.DEVNULL))
+        for first in range(0, len(fleet), NODES_PER_SERVER_PROCESS):
+            last = min(len(fleet), first + NODES_PER_SERVER_PROCESS) - 1
+            wait_for_port(fleet.get_port(last))
+        yield
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+
+
+def benchmark(collector, nodes, args):
+    """Run a collector on a fleet in a new process
+    Returns:
+        The results of the run, or None if it failed
+    """
+    command = [sys.executable, os.path.abspath(__file__),
+               '--run', collector, '--nodes', str(nodes)]
+    for option in ('api_latency', 'redis_latency', 'throttle_rate',
+                   'workers', 'engine', 'shards', 'replicas', 'format'):
+        value = getattr(args, option)
+        if value is not None:
+            command += ['--%s' % option.replace('_', '-'), str(value)]
+    if collector == 'oss':
+        servers = serve_oss_fleet(
+            get_oss_fleet(nodes, args.shards, args.replicas),
+            args.redis_latency)
+    else:
+        servers = contextlib.nullcontext()
+    with servers:
+        process = subprocess.run(command, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    print('%s on %d nodes failed with exit code %d' % (
+        collector, nodes, process.returncode))
+    return None
+
+
+def print_result(result):
+    print('%-8s %8d %10.2f %10d %10d %12d %14.1f' % (
+        result['collector'], result['nodes'], result['seconds'],
+        result['api_calls'], result['throttled'], result['datapoints'],
+        result['peak_rss_mb']))
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the collectors against local stand-ins of "
+        "ElastiCache/CloudWatch, Azure and Redis, on synthetic fleets")
+    parser.add_argument("-c", "--collectors", default=",".join(COLLECTORS),
+                        help="comma separated collectors to benchmark, "
+                        "among %(default)s (default: %(default)s)")
+    parser.add_argument("-n", "--nodes", default="10,100,1000,10000",
+                        help="comma separated fleet sizes "
+                        "(default: %(default)s)")
+    parser.add_argument("--api-latency", type=float, default=0.05,
+                        help="seconds every AWS/Azure API call takes "
+                        "(default: %(default)s)")
+    parser.add_argument("--redis-latency", type=float, default=0.001,
+                        help="seconds every Redis round trip takes "
+                        "(default: %(default)s)")
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="share of the metrics API calls that are "
+                        "throttled (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="workers of every collector (default: the "
+                        "collector's own default)")
+    parser.add_argument("-e", "--engine", choices=['threads', 'asyncio'],
+                        default='threads',
+                        help="engine of the OSS collector "
+                        "(default: %(default)s)")
+    parser.add_argument("--shards", type=int, default=3,
+                        help="shards of every OSS DB (default: %(default)s)")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="replicas of every OSS shard "
+                        "(default: %(default)s)")
+    parser.add_argument("-f", "--format", default="xlsx",
+                        help="output format (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results to a JSON file")
+    parser.add_argument("--run", choices=COLLECTORS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        args.nodes = int(args.nodes)
+        run_benchmark(args)
+        return
+
+    collectors = parse_list(args.collectors)
+    for collector in collectors:
+        if collector not in COLLECTORS:
+            parser.error("Unknown collector %s" % collector)
+    results = []
+    print('%-8s %8s %10s %10s %10s %12s %14s' % (
+        'Collector', 'Nodes', 'Seconds', 'API calls', 'Throttled',
+        'Datapoints', 'Peak RSS (MB)'))
+    for collector in collectors:
+        for nodes in parse_list(args.nodes):
+            result = benchmark(collector, int(nodes), args)
+            if result is not None:
+                print_result(result)
+                results.append(result)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark the accumulation and writing of the rows of a run, on synthetic
+# ElastiCache node rows (4 text columns and 23 metrics), in a given output
+# format:
+#
+#   stream  the rows are appended to an outputWriters.SheetWriter as they
+#           come, as the collectors do
+#   append  a DataFrame grown a row at a time, as with DataFrame.append
+#           before (pd.concat of a one-row DataFrame on pandas 2, where
+#           DataFrame.append no longer exists, which is what it did), and
+#           written once complete
+#
+# Every run happens in a new process, so that the peak RSS reported is
+# that of the run alone.
+
+import argparse
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+METHODS = ['stream', 'append']
+
+TEXT_COLUMNS = ['ClusterId', 'NodeId', 'NodeType', 'Region']
+
+METRIC_COUNT = 23
+
+SHEET_NAME = 'ClusterData'
+
+# The prefix of the line a benchmark run reports its results on
+RESULT_PREFIX = 'BENCHMARK '
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def get_columns():
+    return TEXT_COLUMNS + ['Metric %d' % i for i in range(METRIC_COUNT)]
+
+
+def iter_rows(nodes):
+    for node in range(nodes):
+        yield ['group-%d' % (node // 3), 'cluster-%d' % node,
+               'cache.m5.large', 'us-east-1%s' % 'abc'[node % 3]] + \
+            [float(node * METRIC_COUNT + i) for i in range(METRIC_COUNT)]
+
+
+def get_dtypes(columns):
+    return {column: 'float' for column in columns[len(TEXT_COLUMNS):]}
+
+
+def run_stream(nodes, output_format, base_path):
+    from outputWriters import OutputWriter
+
+    columns = get_columns()
+    with OutputWriter(base_path, output_format) as writer:
+        sheet = writer.add_sheet(SHEET_NAME, columns, get_dtypes(columns),
+                                 index=True)
+        for row in iter_rows(nodes):
+            sheet.append(row)
+    return len(sheet)
+
+
+def run_append(nodes, output_format, base_path):
+    import pandas as pd
+
+    columns = get_columns()
+    df = pd.DataFrame(columns=columns)
+    append = getattr(pd.DataFrame, 'append', None)
+    for row in iter_rows(nodes):
+        if append is not None:
+            df = df.append(pd.Series(row, index=columns), ignore_index=True)
+        else:
+            df = pd.concat([df, pd.DataFrame([row], columns=columns)],
+                           ignore_index=True)
+    if output_format == 'xlsx':
+        df.to_excel('%s.xlsx' % base_path, sheet_name=SHEET_NAME,
+                    engine='xlsxwriter')
+    else:
+        path = '%s-%s.%s' % (base_path, SHEET_NAME, output_format)
+        if output_format == 'csv':
+            df.to_csv(path)
+        elif output_format == 'jsonl':
+            df.to_json(path, orient='records', lines=True)
+        else:
+            df.to_parquet(path, index=False)
+    return len(df)
+
+
+def run_benchmark(method, nodes, output_format):
+    """Run one method, in this process, and report the results on a
+    RESULT_PREFIX line
+    """
+    # Loading the modules is not part of the timing
+    importlib.import_module('outputWriters')
+    if method == 'append':
+        importlib.import_module('pandas')
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.monotonic()
+        rows = {'stream': run_stream, 'append': run_append}[method](
+            nodes, output_format, os.path.join(out_dir, 'bench'))
+        seconds = time.monotonic() - start
+    assert rows == nodes
+    print(RESULT_PREFIX + json.dumps({
+        'method': method,
+        'nodes': nodes,
+        'format': output_format,
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }))
+
+
+def benchmark(method, nodes, output_format):
+    """Run a method in a new process
+    Returns:
+        The results of the run, or None if it failed
+    """
+    process = subprocess.run(
+        [sys.executable, __file__, '--run', method, '--nodes', str(nodes),
+         '--format', output_format],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    print('%s on %d nodes failed with exit code %d' % (
+        method, nodes, process.returncode))
+    return None
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the node rows of a run streamed through the "
+        "output writers against a DataFrame grown a row at a time")
+    parser.add_argument("-m", "--methods", default=",".join(METHODS),
+                        help="comma separated methods to benchmark, "
+                        "among %(default)s (default: %(default)s)")
+    parser.add_argument("-n", "--nodes", default="50000",
+                        help="comma separated numbers of rows "
+                        "(default: %(default)s)")
+    parser.add_argument("-f", "--format", default="xlsx",
+                        help="output format (default: %(default)s)")
+    parser.add_argument("--run", choices=METHODS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run_benchmark(args.run, int(args.nodes), args.format)
+        return
+
+    methods = parse_list(args.methods)
+    for method in methods:
+        if method not in METHODS:
+            parser.error("Unknown method %s" % method)
+    print('%-8s %8s %10s %14s' % ('Method', 'Nodes', 'Seconds',
+                                  'Peak RSS (MB)'))
+    for nodes in parse_list(args.nodes):
+        for method in methods:
+            result = benchmark(method, int(nodes), args.format)
+            if result is not None:
+                print('%-8s %8d %10.2f %14.1f' % (
+                    result['method'], result['nodes'], result['seconds'],
+                    result['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+    main()
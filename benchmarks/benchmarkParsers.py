@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark the parsing of the INFO replies of a pullRedisOpenSourceStats.py
+# snapshot: parse_commandstats and parse_info, which read the raw replies
+# as bytes and keep only the fields the collector uses, against the parsers
+# they replaced, kept below: parse_response/get_value for INFO COMMANDSTATS,
+# and redis-py's own INFO callback for INFO.
+#
+# The replies are synthetic, shaped like those of a Redis 7 server: a
+# cmdstat line per command, and a full default INFO with its keyspace.
+
+import argparse
+import os
+import sys
+import timeit
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+# The default INFO sections, as (section, field names) pairs. The values
+# are synthetic numbers, or the words of WORD_FIELDS.
+INFO_SECTIONS = [
+    ('Server', [
+        'redis_version', 'redis_git_sha1', 'redis_git_dirty',
+        'redis_build_id', 'redis_mode', 'os', 'arch_bits',
+        'monotonic_clock', 'multiplexing_api', 'atomicvar_api',
+        'gcc_version', 'process_id', 'process_supervised', 'run_id',
+        'tcp_port', 'server_time_usec', 'uptime_in_seconds',
+        'uptime_in_days', 'hz', 'configured_hz', 'lru_clock',
+        'executable', 'config_file', 'io_threads_active']),
+    ('Clients', [
+        'connected_clients', 'cluster_connections', 'maxclients',
+        'client_recent_max_input_buffer', 'client_recent_max_output_buffer',
+        'blocked_clients', 'tracking_clients', 'clients_in_timeout_table',
+        'total_blocking_keys', 'total_blocking_keys_on_nokey']),
+    ('Memory', [
+        'used_memory', 'used_memory_human', 'used_memory_rss',
+        'used_memory_rss_human', 'used_memory_peak', 'used_memory_peak_human',
+        'used_memory_peak_perc', 'used_memory_overhead',
+        'used_memory_startup', 'used_memory_dataset',
+        'used_memory_dataset_perc', 'allocator_allocated',
+        'allocator_active', 'allocator_resident', 'total_system_memory',
+        'total_system_memory_human', 'used_memory_lua',
+        'used_memory_vm_eval', 'used_memory_lua_human',
+        'used_memory_scripts_eval', 'number_of_cached_scripts',
+        'number_of_functions', 'number_of_libraries',
+        'used_memory_vm_functions',
+        'used_memory_vm_total', 'used_memory_vm_total_human',
+        'used_memory_functions', 'used_memory_scripts',
+        'used_memory_scripts_human', 'maxmemory', 'maxmemory_human',
+        'maxmemory_policy', 'allocator_frag_ratio', 'allocator_frag_bytes',
+        'allocator_rss_ratio', 'allocator_rss_bytes', 'rss_overhead_ratio',
+        'rss_overhead_bytes', 'mem_fragmentation_ratio',
+        'mem_fragmentation_bytes', 'mem_not_counted_for_evict',
+        'mem_replication_backlog', 'mem_total_replication_buffers',
+        'mem_clients_slaves', 'mem_clients_normal', 'mem_cluster_links',
+        'mem_aof_buffer', 'mem_allocator', 'active_defrag_running',
+        'lazyfree_pending_objects', 'lazyfreed_objects']),
+    ('Persistence', [
+        'loading', 'async_loading', 'current_cow_peak', 'current_cow_size',
+        'current_cow_size_age', 'current_fork_perc',
+        'current_save_keys_processed', 'current_save_keys_total',
+        'rdb_changes_since_last_save', 'rdb_bgsave_in_progress',
+        'rdb_last_save_time', 'rdb_last_bgsave_status',
+        'rdb_last_bgsave_time_sec', 'rdb_current_bgsave_time_sec',
+        'rdb_saves', 'rdb_last_cow_size', 'rdb_last_load_keys_expired',
+        'rdb_last_load_keys_loaded', 'aof_enabled', 'aof_rewrite_in_progress',
+        'aof_rewrite_scheduled', 'aof_last_rewrite_time_sec',
+        'aof_current_rewrite_time_sec', 'aof_last_bgrewrite_status',
+        'aof_rewrites', 'aof_rewrites_consecutive_failures',
+        'aof_last_write_status', 'aof_last_cow_size',
+        'module_fork_in_progress',
+        'module_fork_last_cow_size']),
+    ('Stats', [
+        'total_connections_received', 'total_commands_processed',
+        'instantaneous_ops_per_sec', 'total_net_input_bytes',
+        'total_net_output_bytes', 'total_net_repl_input_bytes',
+        'total_net_repl_output_bytes', 'instantaneous_input_kbps',
+        'instantaneous_output_kbps', 'instantaneous_input_repl_kbps',
+        'instantaneous_output_repl_kbps', 'rejected_connections',
+        'sync_full', 'sync_partial_ok', 'sync_partial_err',
+        'expired_keys', 'expired_stale_perc', 'expired_time_cap_reached_count',
+        'expire_cycle_cpu_milliseconds', 'evicted_keys', 'evicted_clients',
+        'total_eviction_exceeded_time', 'current_eviction_exceeded_time',
+        'keyspace_hits', 'keyspace_misses', 'pubsub_channels',
+        'pubsub_patterns', 'pubsubshard_channels', 'latest_fork_usec',
+        'total_forks', 'migrate_cached_sockets',
+        'slave_expires_tracked_keys', 'active_defrag_hits',
+        'active_defrag_misses', 'active_defrag_key_hits',
+        'active_defrag_key_misses', 'total_active_defrag_time',
+        'current_active_defrag_time', 'tracking_total_keys',
+        'tracking_total_items', 'tracking_total_prefixes',
+        'unexpected_error_replies', 'total_error_replies',
+        'dump_payload_sanitizations',
+        'total_reads_processed', 'total_writes_processed',
+        'io_threaded_reads_processed', 'io_threaded_writes_processed',
+        'reply_buffer_shrinks', 'reply_buffer_expands',
+        'eventloop_cycles', 'eventloop_duration_sum',
+        'eventloop_duration_cmd_sum', 'instantaneous_eventloop_cycles_per_sec',
+        'instantaneous_eventloop_duration_usec', 'acl_access_denied_auth',
+        'acl_access_denied_cmd', 'acl_access_denied_key',
+        'acl_access_denied_channel']),
+    ('Replication', [
+        'role', 'connected_slaves', 'master_failover_state',
+        'master_replid', 'master_replid2', 'master_repl_offset',
+        'second_repl_offset', 'repl_backlog_active', 'repl_backlog_size',
+        'repl_backlog_first_byte_offset', 'repl_backlog_histlen']),
+    ('CPU', [
+        'used_cpu_sys', 'used_cpu_user', 'used_cpu_sys_children',
+        'used_cpu_user_children', 'used_cpu_sys_main_thread',
+        'used_cpu_user_main_thread']),
+    ('Modules', []),
+    ('Errorstats', []),
+    ('Cluster', ['cluster_enabled']),
+]
+
+# The fields holding words rather than numbers
+WORD_FIELDS = {
+    'redis_version': '7.2.4', 'redis_mode': 'standalone',
+    'os': 'Linux 6.1.0 x86_64', 'multiplexing_api': 'epoll',
+    'atomicvar_api': 'c11-builtin', 'gcc_version': '12.2.0',
+    'process_supervised': 'no', 'executable': '/usr/local/bin/redis-server',
+    'config_file': '/etc/redis/redis.conf', 'mem_allocator': 'jemalloc-5.3.0',
+    'maxmemory_policy': 'noeviction', 'role': 'master',
+    'master_failover_state': 'no-failover', 'monotonic_clock': 'POSIX',
+    'rdb_last_bgsave_status': 'ok', 'aof_last_bgrewrite_status': 'ok',
+    'aof_last_write_status': 'ok',
+}
+
+
+def get_value(value):
+    """The value parser replaced by parse_commandstats and parse_info"""
+    if ',' not in value or '=' not in value:
+        try:
+            if '.' in value:
+                return float(value)
+            else:
+                return int(value)
+        except ValueError:
+            return value
+    else:
+        sub_dict = {}
+        for item in value.split(','):
+            k, v = item.rsplit('=', 1)
+            sub_dict[k] = get_value(v)
+        return sub_dict
+
+
+def native_str(x):
+    return x if isinstance(x, str) else x.decode('utf-8', 'replace')
+
+
+def parse_response(response):
+    """The INFO COMMANDSTATS parser replaced by parse_commandstats"""
+    res = {}
+    response = native_str(response)
+
+    for line in response.splitlines():
+        if line and not line.startswith('#'):
+            if line.find(':') != -1:
+                key, value = line.split(':', 1)
+                if key == 'cmdstat_host':
+                    key, value = line.rsplit(':', 1)
+                res[key] = get_value(value)
+            else:
+                res.setdefault('__raw__', []).append(line)
+
+    return res
+
+
+def get_redis_parse_info():
+    """redis-py's INFO callback, which parsed the INFO replies before
+    parse_info"""
+    try:
+        from redis._parsers.helpers import parse_info
+    except ImportError:
+        from redis.client import parse_info
+    return parse_info
+
+
+def get_commandstats_reply(commands):
+    lines = ['# Commandstats']
+    for i in range(commands):
+        lines.append('cmdstat_command%d:calls=%d,usec=%d,usec_per_call=%.2f,'
+                     'rejected_calls=0,failed_calls=%d' % (
+                         i, 1000003 * (i + 1), 2000017 * (i + 1),
+                         1.5 + i % 7, i % 3))
+    lines.append('cmdstat_host::calls=1,usec=4,usec_per_call=4.00,'
+                 'rejected_calls=0,failed_calls=0')
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def get_info_reply(dbs):
+    lines = []
+    for section, fields in INFO_SECTIONS:
+        lines.append('# %s' % section)
+        for i, field in enumerate(fields):
+            if field in WORD_FIELDS:
+                value = WORD_FIELDS[field]
+            elif 'ratio' in field or 'perc' in field or 'cpu' in field:
+                value = '%.2f' % (i / 3.0)
+            else:
+                value = '%d' % (7919 * (i + 1))
+            lines.append('%s:%s' % (field, value))
+        lines.append('')
+    lines.append('# Keyspace')
+    for db in range(dbs):
+        lines.append('db%d:keys=%d,expires=%d,avg_ttl=0' % (
+            db, 100003 * (db + 1), db))
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def get_best_time(fn, number, repeat):
+    """The best time of a call, in microseconds"""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * \
+        1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parsers of the INFO replies of a "
+                    "pullRedisOpenSourceStats.py snapshot")
+    parser.add_argument("--commands", type=int, default=300,
+                        help="The cmdstat lines of the INFO COMMANDSTATS "
+                             "reply")
+    parser.add_argument("--dbs", type=int, default=16,
+                        help="The keyspace lines of the INFO reply")
+    parser.add_argument("-n", "--number", type=int, default=200,
+                        help="The parses per timing")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="The timings of every parser, the best one "
+                             "being reported")
+    args = parser.parse_args()
+
+    from pullRedisOpenSourceStats import INFO_FIELDS, parse_commandstats, \
+        parse_info
+    INFO_FIELDS_USED = [field.decode() for field in INFO_FIELDS]
+    redis_parse_info = get_redis_parse_info()
+
+    commandstats = get_commandstats_reply(args.commands)
+    info = get_info_reply(args.dbs)
+
+    # The parsers must agree on what the collector uses
+    old_stats = parse_response(commandstats)
+    new_stats = parse_commandstats(commandstats)
+    assert new_stats == {key[8:]: value['calls']
+                         for key, value in old_stats.items()}
+    old_info = redis_parse_info(info.decode())
+    new_info = parse_info(info)
+    assert all(old_info[key] == value if key in INFO_FIELDS_USED else
+               old_info[key]['keys'] == value['keys']
+               for key, value in new_info.items())
+
+    print('INFO COMMANDSTATS: %d bytes, %d lines; INFO: %d bytes, %d lines'
+          % (len(commandstats), len(commandstats.splitlines()), len(info),
+             len(info.splitlines())))
+    print('%-18s %14s %14s %8s' % ('reply', 'old (us)', 'new (us)',
+                                   'speedup'))
+    total_old = total_new = 0
+    for name, old, new in [
+            ('INFO COMMANDSTATS', lambda: parse_response(commandstats),
+             lambda: parse_commandstats(commandstats)),
+            # redis-py decoded the reply before parsing it
+            ('INFO', lambda: redis_parse_info(info.decode()),
+             lambda: parse_info(info))]:
+        old_time = get_best_time(old, args.number, args.repeat)
+        new_time = get_best_time(new, args.number, args.repeat)
+        total_old += old_time
+        total_new += new_time
+        print('%-18s %14.1f %14.1f %7.1fx' % (name, old_time, new_time,
+                                              old_time / new_time))
+    print('%-18s %14.1f %14.1f %7.1fx' % ('snapshot', total_old, total_new,
+                                          total_old / total_new))
+
+
+if __name__ == '__main__':
+    main()
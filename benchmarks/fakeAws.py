@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# A stand-in for the ElastiCache and CloudWatch APIs, for benchmarking
+# pullElasticCacheStats.py without an AWS account. boto3.Session is replaced
+# by a session whose clients answer DescribeCacheClusters,
+# DescribeReplicationGroups, DescribeReservedCacheNodes and GetMetricData
+# from a synthetic fleet, the way botocore's Stubber does: the requests
+# never leave the process, but parameter validation, pagination and error
+# handling run as usual.
+
+import collections
+import datetime
+import random
+import threading
+import time
+import zlib
+
+# The most datapoints CloudWatch returns in one GetMetricData response
+MAX_DATAPOINTS_PER_RESPONSE = 100800
+
+# The page size of the Describe* calls
+MAX_RECORDS = 100
+
+NODE_TYPES = ['cache.r6g.large', 'cache.r6g.xlarge', 'cache.m6g.large',
+              'cache.t4g.medium']
+
+# The reservations of every node type
+RESERVATIONS_PER_NODE_TYPE = 2
+
+# The nodes of a replication group: a primary and its replicas
+NODES_PER_REPLICATION_GROUP = 3
+
+CREATE_TIME = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def get_series_scale(query):
+    """A stable per series scale, so every run returns the same values"""
+    stat = query['MetricStat']
+    name = stat['Metric']['MetricName'] + ''.join(
+        dimension['Value'] for dimension in stat['Metric']['Dimensions'])
+    return 1 + zlib.crc32(name.encode()) % 1000
+
+
+class FakeAws(object):
+    """Serve a fleet of single node cache clusters, grouped into
+    replication groups of NODES_PER_REPLICATION_GROUP.
+
+    Every call sleeps for latency seconds, and a throttle_rate share of the
+    GetMetricData calls fail with a Throttling error. The calls are counted
+    by operation in calls.
+    """
+
+    def __init__(self, nodes, latency=0, throttle_rate=0, seed=0):
+        self.nodes = nodes
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = collections.Counter()
+        self.datapoints = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._timestamps = {}
+
+    def install(self):
+        """Make boto3.Session create sessions served by this fleet"""
+        import boto3
+
+        fake = self
+        session_class = boto3.Session
+
+        class Session(session_class):
+            def __init__(self, *args, **kwargs):
+                session_class.__init__(self, *args, **kwargs)
+                self.events.register('before-parameter-build',
+                                     fake._save_params)
+                self.events.register('before-call', fake._reply)
+
+        boto3.Session = Session
+
+    def _save_params(self, params, context, **kwargs):
+        # before-call only sees the serialized request, so keep the
+        # parameters as given
+        context['fake_aws_params'] = params
+
+    def _reply(self, model, context, **kwargs):
+        from botocore.awsrequest import AWSResponse
+
+        with self._lock:
+            self.calls[model.name] += 1
+            throttled = model.name == 'GetMetricData' and \
+                self._random.random() < self.throttle_rate
+            if throttled:
+                self.calls['Throttled'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            return (AWSResponse(None, 400, {}, None),
+                    {'Error': {'Code': 'Throttling',
+                               'Message': 'Rate exceeded'},
+                     'ResponseMetadata': {'HTTPStatusCode': 400}})
+        parsed = getattr(self, 'reply_%s' % model.name)(
+            context['fake_aws_params'])
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200}
+        return (AWSResponse(None, 200, {}, None), parsed)
+
+    def get_page(self, count, get_item, params):
+        """Get a page of count items, and the marker of the next page"""
+        first = int(params.get('Marker') or 0)
+        last = min(count, first + params.get('MaxRecords', MAX_RECORDS))
+        return ([get_item(i) for i in range(first, last)],
+                str(last) if last < count else None)
+
+    def get_cache_cluster(self, node):
+        group = node // NODES_PER_REPLICATION_GROUP
+        member = node % NODES_PER_REPLICATION_GROUP
+        return {
+            'CacheClusterId': 'bench-%05d-%03d' % (group, member + 1),
+            'ReplicationGroupId': 'bench-%05d' % group,
+            'CacheClusterStatus': 'available',
+            'Engine': 'redis',
+            'EngineVersion': '7.1',
+            'CacheNodeType': NODE_TYPES[group % len(NODE_TYPES)],
+            'NumCacheNodes': 1,
+            'PreferredAvailabilityZone': 'us-east-1%s' % 'abc'[member],
+            'CacheClusterCreateTime': CREATE_TIME,
+            'CacheNodes': [{
+                'CacheNodeId': '0001',
+                'CacheNodeStatus': 'available',
+                'CacheNodeCreateTime': CREATE_TIME,
+            }],
+        }
+
+    def get_replication_group(self, group):
+        first = group * NODES_PER_REPLICATION_GROUP
+        members = range(first, min(self.nodes,
+                                   first + NODES_PER_REPLICATION_GROUP))
+        return {
+            'ReplicationGroupId': 'bench-%05d' % group,
+            'Status': 'available',
+            'Engine': 'redis',
+            'CacheNodeType': NODE_TYPES[group % len(NODE_TYPES)],
+            'ClusterEnabled': False,
+            'MemberClusters': [self.get_cache_cluster(node)['CacheClusterId']
+                               for node in members],
+            'NodeGroups': [{
+                'NodeGroupId': '0001',
+                'Status': 'available',
+                'NodeGroupMembers': [{
+                    'CacheClusterId':
+                    self.get_cache_cluster(node)['CacheClusterId'],
+                    'CacheNodeId': '0001',
+                    'PreferredAvailabilityZone':
+                    'us-east-1%s' % 'abc'[node - first],
+                    'CurrentRole': 'primary' if node == first else 'replica',
+                } for node in members],
+            }],
+        }
+
+    def get_reserved_cache_node(self, index):
+        groups = (self.nodes + NODES_PER_REPLICATION_GROUP - 1) // \
+            NODES_PER_REPLICATION_GROUP
+        return {
+            'ReservedCacheNodeId': 'bench-ri-%d' % index,
+            'CacheNodeType': NODE_TYPES[index % len(NODE_TYPES)],
+            'StartTime': datetime.datetime.now(datetime.timezone.utc) -
+            datetime.timedelta(days=30 + index),
+            'Duration': 365 * 24 * 3600,
+            'CacheNodeCount': max(1, groups // len(NODE_TYPES)),
+            'ProductDescription': 'redis',
+            'State': 'active',
+        }
+
+    def reply_DescribeCacheClusters(self, params):
+        (clusters, marker) = self.get_page(
+            self.nodes, self.get_cache_cluster, params)
+        reply = {'CacheClusters': clusters}
+        if marker is not None:
+            reply['Marker'] = marker
+        return reply
+
+    def reply_DescribeReplicationGroups(self, params):
+        groups = (self.nodes + NODES_PER_REPLICATION_GROUP - 1) // \
+            NODES_PER_REPLICATION_GROUP
+        (replication_groups, marker) = self.get_page(
+            groups, self.get_replication_group, params)
+        reply = {'ReplicationGroups': replication_groups}
+        if marker is not None:
+            reply['Marker'] = marker
+        return reply
+
+    def reply_DescribeReservedCacheNodes(self, params):
+        (reserved, marker) = self.get_page(
+            min(self.nodes, RESERVATIONS_PER_NODE_TYPE * len(NODE_TYPES)),
+            self.get_reserved_cache_node,
+            params)
+        reply = {'ReservedCacheNodes': reserved}
+        if marker is not None:
+            reply['Marker'] = marker
+        return reply
+
+    def get_timestamps(self, start, end, period):
+        """The timestamps of the periods of [start, end) that have started
+        by now, newest first as CloudWatch returns them. They are shared by
+        all the series of a call.
+        """
+        now = time.time()
+        key = (start, end, period, int(now) // period)
+        with self._lock:
+            timestamps = self._timestamps.get(key)
+            if timestamps is None:
+                first = start.timestamp()
+                count = max(0, int(min(end.timestamp(), now) - first +
+                                   period - 1) // period)
+                timestamps = self._timestamps[key] = [
+                    start + datetime.timedelta(seconds=i * period)
+                    for i in reversed(range(count))]
+        return timestamps
+
+    def reply_GetMetricData(self, params):
+        queries = params['MetricDataQueries']
+        results = []
+        datapoints = 0
+        next_token = None
+        for i in range(int(params.get('NextToken') or 0), len(queries)):
+            query = queries[i]
+            timestamps = self.get_timestamps(
+                params['StartTime'], params['EndTime'],
+                query['MetricStat']['Period'])
+            if results and datapoints + len(timestamps) > \
+                    MAX_DATAPOINTS_PER_RESPONSE:
+                next_token = str(i)
+                break
+            datapoints += len(timestamps)
+            scale = get_series_scale(query)
+            results.append({
+                'Id': query['Id'],
+                'Label': query['MetricStat']['Metric']['MetricName'],
+                'Timestamps': timestamps,
+                'Values': [scale * (1 + (j * 7919) % 100 / 100.0)
+                           for j in range(len(timestamps))],
+                'StatusCode': 'Complete',
+            })
+        with self._lock:
+            self.datapoints += datapoints
+        reply = {'MetricDataResults': results, 'Messages': []}
+        if next_token is not None:
+            reply['NextToken'] = next_token
+        return reply
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# A stand-in for the Azure management APIs, for benchmarking
+# pullAzureCacheForRedisStats.py without an Azure subscription. The
+# SubscriptionClient, RedisManagementClient and MonitorManagementClient
+# classes and DefaultAzureCredential are replaced by fakes answering from a
+# synthetic fleet with the same model attributes the SDK deserializes the
+# responses into.
+
+import collections
+import datetime
+import random
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+# The caches of a subscription
+CACHES_PER_SUBSCRIPTION = 500
+
+# The caches of a resource group
+CACHES_PER_RESOURCE_GROUP = 20
+
+SKUS = ['Premium', 'Standard', 'Basic']
+
+AGGREGATIONS = ['average', 'count', 'maximum', 'minimum', 'total']
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(
+        tzinfo=datetime.timezone.utc)
+
+
+def parse_interval(interval):
+    """The seconds of an ISO 8601 PT<n>M or PT<n>H interval"""
+    unit = {'M': 60, 'H': 3600}[interval[-1]]
+    return int(interval[2:-1]) * unit
+
+
+class ThrottledResponse(object):
+    status_code = 429
+    reason = 'Too Many Requests'
+
+    def __init__(self, retry_after):
+        self.headers = {'Retry-After': str(retry_after)}
+
+    def text(self):
+        return ''
+
+
+class FakeAzure(object):
+    """Serve a fleet of caches, CACHES_PER_SUBSCRIPTION per subscription.
+
+    Every call sleeps for latency seconds, and a throttle_rate share of the
+    metrics calls fail with an HTTP 429 asking to retry after retry_after
+    seconds. The calls are counted by operation in calls.
+    """
+
+    def __init__(self, caches, latency=0, throttle_rate=0, retry_after=0,
+                 seed=0):
+        self.caches = caches
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.calls = collections.Counter()
+        self.datapoints = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._timestamps = {}
+
+    def install(self):
+        """Make the Azure SDK clients and credential answer from this
+        fleet"""
+        import azure.identity
+        import azure.mgmt.monitor
+        import azure.mgmt.redis
+        import azure.mgmt.subscription
+
+        fake = self
+
+        def subscription_client(credential, **kwargs):
+            return SimpleNamespace(subscriptions=SimpleNamespace(
+                list=lambda: fake.list_subscriptions()))
+
+        def redis_client(credential, subscription_id, **kwargs):
+            return SimpleNamespace(redis=SimpleNamespace(
+                list=lambda: fake.list_caches(subscription_id)))
+
+        def monitor_client(credential, subscription_id, **kwargs):
+            return SimpleNamespace(metrics=SimpleNamespace(
+                list=fake.list_metrics))
+
+        azure.identity.DefaultAzureCredential = lambda **kwargs: object()
+        azure.mgmt.subscription.SubscriptionClient = subscription_client
+        azure.mgmt.redis.RedisManagementClient = redis_client
+        azure.mgmt.monitor.MonitorManagementClient = monitor_client
+
+    def _call(self, operation, throttle=False):
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = throttle and \
+                self._random.random() < self.throttle_rate
+            if throttled:
+                self.calls['Throttled'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            from azure.core.exceptions import HttpResponseError
+            raise HttpResponseError(
+                message='Too many requests',
+                response=ThrottledResponse(self.retry_after))
+
+    def list_subscriptions(self):
+        self._call('subscriptions.list')
+        count = (self.caches + CACHES_PER_SUBSCRIPTION - 1) // \
+            CACHES_PER_SUBSCRIPTION
+        return [SimpleNamespace(subscription_id='%08d-0000-0000-0000-'
+                                '000000000000' % i) for i in range(count)]
+
+    def list_caches(self, subscription_id):
+        self._call('redis.list')
+        first = int(subscription_id[:8]) * CACHES_PER_SUBSCRIPTION
+        return [self.get_cache(subscription_id, i) for i in range(
+            first, min(self.caches, first + CACHES_PER_SUBSCRIPTION))]
+
+    def get_cache(self, subscription_id, index):
+        name = 'bench-%05d' % index
+        sku = SKUS[index % len(SKUS)]
+        return SimpleNamespace(
+            id='/subscriptions/%s/resourceGroups/bench-rg-%d/providers/'
+            'Microsoft.Cache/Redis/%s' % (
+                subscription_id, index // CACHES_PER_RESOURCE_GROUP, name),
+            name=name,
+            sku=SimpleNamespace(name=sku),
+            replicas_per_master=1 if sku != 'Basic' else None,
+            shard_count=index % 4 + 1 if sku == 'Premium' else None)
+
+    def get_timestamps(self, start, end, period):
+        """The timestamps of the periods of [start, end) that have started
+        by now. They are shared by all the series of a call.
+        """
+        now = time.time()
+        key = (start, end, period, int(now) // period)
+        with self._lock:
+            timestamps = self._timestamps.get(key)
+            if timestamps is None:
+                count = max(0, int(min(end.timestamp(), now) -
+                                   start.timestamp() + period - 1) // period)
+                timestamps = self._timestamps[key] = [
+                    start + datetime.timedelta(seconds=i * period)
+                    for i in range(count)]
+        return timestamps
+
+    def list_metrics(self, resource_uri, metricnames, timespan, interval,
+                     aggregation, **kwargs):
+        self._call('metrics.list', throttle=True)
+        (start, end) = (parse_time(value) for value in timespan.split('/'))
+        timestamps = self.get_timestamps(start, end, parse_interval(interval))
+        aggregations = [name.lower() for name in aggregation.split(',')]
+        metrics = []
+        for name in metricnames.split(','):
+            scale = 1 + zlib.crc32(
+                (resource_uri + name).encode()) % 1000
+            data = []
+            for i, timestamp in enumerate(timestamps):
+                value = scale * (1 + (i * 7919) % 100 / 100.0)
+                data.append(SimpleNamespace(time_stamp=timestamp, **{
+                    agg: value if agg in aggregations else None
+                    for agg in AGGREGATIONS}))
+            metrics.append(SimpleNamespace(
+                name=SimpleNamespace(value=name,
+                                     localized_value=name),
+                timeseries=[SimpleNamespace(data=data)]))
+        with self._lock:
+            self.datapoints += len(timestamps) * len(metrics)
+        return SimpleNamespace(value=metrics, timespan=timespan,
+                               interval=interval)
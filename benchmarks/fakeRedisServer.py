@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+# A stand-in for a fleet of Redis Open Source DBs, for benchmarking
+# pullRedisOpenSourceStats.py without real servers: every node of every DB
+# listens on its own local port and answers the commands the collector
+# sends (INFO, CLUSTER NODES/MYID, HELLO, PING) with synthetic, steadily
+# growing counters, and the keyspace profiling commands (SCAN, TYPE, MEMORY
+# USAGE, PTTL) over a synthetic keyspace. The replies can be delayed to
+# inject network latency.
+#
+# A large fleet can be served by several processes, each serving a range of
+# the nodes, so that no process runs out of file descriptors.
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+import zlib
+
+# Calls per second of every command in the synthetic commandstats
+COMMAND_RATES = {
+    'get': 900, 'set': 400, 'mget': 20, 'hget': 150, 'hset': 60,
+    'lpush': 30, 'rpop': 30, 'sadd': 10, 'zadd': 15, 'zrange': 25,
+    'xadd': 5, 'pfadd': 2, 'expire': 50, 'del': 40, 'ping': 10,
+    'info': 1, 'config|get': 1,
+}
+
+# The types of the synthetic keys, by key index
+KEY_TYPES = [b'string', b'string', b'string', b'hash', b'list', b'set',
+             b'zset', b'stream']
+
+# Every BIG_KEY_EVERY-th key is a big one
+BIG_KEY_EVERY = 997
+
+START = time.time()
+
+
+class Fleet(object):
+    """The layout of the synthetic fleet: dbs DBs of shards * (1 + replicas)
+    nodes each, node n listening on base_port + n. DBs with a single node
+    are not clustered.
+    """
+
+    def __init__(self, dbs, shards=1, replicas=0, base_port=20000,
+                 host='127.0.0.1'):
+        self.dbs = dbs
+        self.shards = shards
+        self.replicas = replicas
+        self.base_port = base_port
+        self.host = host
+        self.nodes_per_db = shards * (1 + replicas)
+
+    def __len__(self):
+        return self.dbs * self.nodes_per_db
+
+    def get_db(self, node):
+        return node // self.nodes_per_db
+
+    def get_port(self, node):
+        return self.base_port + node
+
+    def is_clustered(self):
+        return self.nodes_per_db > 1
+
+    def is_master(self, node):
+        return node % self.nodes_per_db % (1 + self.replicas) == 0
+
+    def get_db_nodes(self, db):
+        first = db * self.nodes_per_db
+        return range(first, first + self.nodes_per_db)
+
+    def get_seed_ports(self):
+        """The port of the first node of every DB, as in the input file"""
+        return [self.get_port(db * self.nodes_per_db)
+                for db in range(self.dbs)]
+
+
+def get_node_id(node):
+    return '%040x' % (node + 1)
+
+
+def get_cluster_nodes(fleet, node):
+    lines = []
+    db_nodes = list(fleet.get_db_nodes(fleet.get_db(node)))
+    for other in db_nodes:
+        flags = 'myself,' if other == node else ''
+        if fleet.is_master(other):
+            flags += 'master'
+            master = '-'
+            shard = (other - db_nodes[0]) // (1 + fleet.replicas)
+            slots = ' %d-%d' % (shard * 16384 // fleet.shards,
+                                (shard + 1) * 16384 // fleet.shards - 1)
+        else:
+            flags += 'slave'
+            master = get_node_id(other - other % (1 + fleet.replicas))
+            slots = ''
+        lines.append('%s %s:%d@%d %s %s 0 0 1 connected%s' % (
+            get_node_id(other), fleet.host, fleet.get_port(other),
+            fleet.get_port(other) + 10000, flags, master, slots))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def get_keyspace(node):
+    """The number of keys of every logical DB of a node"""
+    return {0: 10 ** 5 + node, 1: node % 100, 12: 7}
+
+
+def parse_key(key):
+    """The (db, index) of a synthetic key 'key:<db>:<index>', or None"""
+    try:
+        (_, db, index) = key.split(b':')
+        return (int(db), int(index))
+    except ValueError:
+        return None
+
+
+def get_key_size(key, index):
+    size = 64 + zlib.crc32(key) % 2000
+    return size * 10000 if index % BIG_KEY_EVERY == 0 else size
+
+
+def scan(node, db, cursor, count):
+    """The reply to SCAN: the keys are scanned in index order"""
+    keys = get_keyspace(node).get(db, 0)
+    last = min(keys, cursor + count)
+    return b'*2\r\n' + encode_bulk(b'%d' % (last if last < keys else 0)) + \
+        b'*%d\r\n' % (last - cursor) + b''.join(
+            encode_bulk(b'key:%d:%d' % (db, index))
+            for index in range(cursor, last))
+
+
+def get_info(fleet, node, sections):
+    elapsed = time.time() - START
+    sections = [section.lower() for section in sections] or ['default']
+    everything = 'all' in sections or 'everything' in sections
+    default = everything or 'default' in sections
+
+    def wants(section):
+        return default or section in sections
+
+    lines = []
+    if wants('server'):
+        lines += ['# Server', 'redis_version:7.2.4', 'redis_mode:%s' % (
+            'cluster' if fleet.is_clustered() else 'standalone'),
+            'run_id:%s' % get_node_id(node)[::-1],
+            'tcp_port:%d' % fleet.get_port(node),
+            'uptime_in_seconds:%d' % elapsed]
+    if wants('clients'):
+        lines += ['# Clients', 'connected_clients:%d' % (10 + node % 50)]
+    if wants('memory'):
+        lines += ['# Memory', 'used_memory:%d' % (10 ** 8 + node),
+                  'used_memory_peak:%d' % (2 * 10 ** 8 + node)]
+    if wants('stats'):
+        lines += ['# Stats', 'total_commands_processed:%d' % (
+            elapsed * sum(COMMAND_RATES.values()))]
+    if wants('replication'):
+        lines += ['# Replication', 'role:%s' % (
+            'master' if fleet.is_master(node) else 'slave'),
+            'connected_slaves:%d' % (
+                fleet.replicas if fleet.is_master(node) else 0)]
+    if wants('cluster'):
+        lines += ['# Cluster', 'cluster_enabled:%d' % fleet.is_clustered()]
+    if wants('keyspace'):
+        lines.append('# Keyspace')
+        for db, keys in get_keyspace(node).items():
+            if keys:
+                lines.append('db%d:keys=%d,expires=0,avg_ttl=0' % (db, keys))
+    if everything or 'commandstats' in sections:
+        lines.append('# Commandstats')
+        for command, rate in COMMAND_RATES.items():
+            lines.append('cmdstat_%s:calls=%d,usec=%d,usec_per_call=1.00,'
+                         'rejected_calls=0,failed_calls=0' % (
+                             command, elapsed * rate, elapsed * rate))
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def parse_command(buffer):
+    """Parse the first command of a buffer, as sent by clients: an array of
+    bulk strings
+    Returns:
+        The (command arguments, rest of the buffer) pair, or (None, buffer)
+        if the buffer doesn't hold a whole command yet
+    """
+    end = buffer.find(b'\r\n')
+    if end < 0:
+        return (None, buffer)
+    args = []
+    position = end + 2
+    for _ in range(int(buffer[1:end])):
+        end = buffer.find(b'\r\n', position)
+        if end < 0:
+            return (None, buffer)
+        length = int(buffer[position + 1:end])
+        position = end + 2 + length + 2
+        if len(buffer) < position:
+            return (None, buffer)
+        args.append(buffer[end + 2:position - 2])
+    return (args, buffer[position:])
+
+
+def encode_bulk(value):
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def encode_hello(protocol):
+    fields = [b'server', b'redis', b'version', b'7.2.4', b'proto']
+    header = b'%%%d\r\n' % 3 if protocol == 3 else b'*6\r\n'
+    return header + b''.join(encode_bulk(field) for field in fields) + \
+        b':%d\r\n' % protocol
+
+
+class FakeRedisServer(object):
+    """Serve a range of the nodes of a Fleet"""
+
+    def __init__(self, fleet, first_node, node_count, latency=0):
+        self.fleet = fleet
+        self.nodes = range(first_node,
+                           min(len(fleet), first_node + node_count))
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.connections = 0
+
+    def reply(self, node, args, connection):
+        command = args[0].decode().lower()
+        subcommand = args[1].decode().lower() if len(args) > 1 else ''
+        self.calls[command] += 1
+        if command == 'ping':
+            return b'+PONG\r\n'
+        if command == 'info':
+            return encode_bulk(get_info(
+                self.fleet, node, [arg.decode() for arg in args[1:]]))
+        if command == 'hello':
+            return encode_hello(int(args[1]) if len(args) > 1 else 2)
+        if command == 'cluster' and not self.fleet.is_clustered():
+            return b'-ERR This instance has cluster support disabled\r\n'
+        if command == 'cluster' and subcommand == 'nodes':
+            return encode_bulk(get_cluster_nodes(self.fleet, node))
+        if command == 'cluster' and subcommand == 'myid':
+            return encode_bulk(get_node_id(node).encode())
+        if command == 'benchstats':
+            return encode_bulk(json.dumps({
+                'calls': self.calls, 'connections': self.connections,
+            }).encode())
+        if command == 'select':
+            connection.db = int(args[1])
+            return b'+OK\r\n'
+        if command in ('client', 'auth'):
+            return b'+OK\r\n'
+        if command == 'scan':
+            options = dict(zip([arg.lower() for arg in args[2::2]],
+                               args[3::2]))
+            return scan(node, connection.db, int(args[1]),
+                        int(options.get(b'count', 10)))
+        if command in ('type', 'memory', 'pttl'):
+            key = args[2] if command == 'memory' else args[1]
+            parsed = parse_key(key)
+            if parsed is None or parsed[0] != connection.db or \
+                    parsed[1] >= get_keyspace(node).get(parsed[0], 0):
+                return {'type': b'+none\r\n', 'memory': b'$-1\r\n',
+                        'pttl': b':-2\r\n'}[command]
+            index = parsed[1]
+            if command == 'type':
+                return b'+%s\r\n' % KEY_TYPES[index % len(KEY_TYPES)]
+            if command == 'memory':
+                return b':%d\r\n' % get_key_size(key, index)
+            ttl = (index % 3600 + 1) * 1000 if index % 3 == 0 else -1
+            return b':%d\r\n' % ttl
+        return b'-ERR unknown command \'%s\'\r\n' % command.encode()
+
+    def get_protocol(self, node):
+        server = self
+
+        class NodeProtocol(asyncio.Protocol):
+            """Reply to the commands of a connection to a node. The replies
+            to the commands received together (e.g. a pipeline) are sent
+            together, latency seconds later, as over one network round
+            trip.
+            """
+
+            def connection_made(self, transport):
+                server.connections += 1
+                self.transport = transport
+                self.buffer = b''
+                self.replies = []
+                self.db = 0
+
+            def data_received(self, data):
+                self.buffer += data
+                while True:
+                    (args, self.buffer) = parse_command(self.buffer)
+                    if args is None:
+                        break
+                    if not self.replies and server.latency:
+                        asyncio.get_running_loop().call_later(
+                            server.latency, self.flush)
+                    self.replies.append(server.reply(node, args, self))
+                    if not server.latency:
+                        self.flush()
+
+            def flush(self):
+                if not self.transport.is_closing():
+                    self.transport.write(b''.join(self.replies))
+                self.replies = []
+
+        return NodeProtocol
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        servers = []
+        for node in self.nodes:
+            servers.append(await loop.create_server(
+                self.get_protocol(node), self.fleet.host,
+                self.fleet.get_port(node), reuse_address=True))
+        print('Serving %d nodes on ports %d-%d' % (
+            len(self.nodes), self.fleet.get_port(self.nodes[0]),
+            self.fleet.get_port(self.nodes[-1])), flush=True)
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a synthetic fleet of Redis OSS DBs locally")
+    parser.add_argument("--dbs", type=int, default=1,
+                        help="number of DBs (default: %(default)s)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="shards per DB (default: %(default)s)")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="replicas per shard (default: %(default)s)")
+    parser.add_argument("--base-port", type=int, default=20000,
+                        help="port of the first node (default: %(default)s)")
+    parser.add_argument("--first-node", type=int, default=0,
+                        help="first node served by this process")
+    parser.add_argument("--node-count", type=int, default=None,
+                        help="number of nodes served by this process "
+                        "(default: all)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds every reply is delayed by")
+    args = parser.parse_args()
+
+    fleet = Fleet(args.dbs, args.shards, args.replicas, args.base_port)
+    server = FakeRedisServer(fleet, args.first_node,
+                             args.node_count or len(fleet), args.latency)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+# Streaming readers of the endpoint inventories the OSS collector samples:
+# an Excel workbook with a "Redis Sizing Input" sheet, a CSV file with the
+# same columns, a JSON lines file with one endpoint per line, or any of
+# them on stdin. The endpoints are parsed one row at a time, and yielded as
+# soon as they are read, so the collector can start discovering the DBs
+# before the end of a large inventory, without holding all of it.
+
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+
+# The supported input formats, the default one first
+INPUT_FORMATS = ['xlsx', 'csv', 'jsonl']
+
+# The input format of every known file extension. openpyxl can't read the
+# legacy .xls workbooks.
+INPUT_EXTENSIONS = {
+    '.xlsx': 'xlsx',
+    '.xlsm': 'xlsx',
+    '.csv': 'csv',
+    '.txt': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+}
+
+# The sheet of the Excel workbook the endpoints are read from
+SHEET_NAME = 'Redis Sizing Input'
+
+# The column names (or JSON keys) accepted for every field, matched
+# regardless of case, the Excel column names first
+FIELD_NAMES = {
+    'host': ('Redis Host', 'host'),
+    'port': ('Port', 'port'),
+    'password': ('Password', 'password'),
+    'user': ('User (ACL)', 'user', 'username'),
+    'tls': ('TLS', 'tls', 'ssl'),
+}
+
+# The field of every accepted column name, lowercased
+FIELDS_BY_NAME = {name.lower(): field
+                  for field, names in FIELD_NAMES.items() for name in names}
+
+# The port of the endpoints that don't have one
+DEFAULT_PORT = 6379
+
+# The values of the TLS column that leave TLS off, besides an empty cell
+FALSE_VALUES = frozenset(['false', 'no', 'n', 'off', '0'])
+
+
+class InputError(Exception):
+    pass
+
+
+class Endpoint(object):
+    """The endpoint of a DB to sample, as listed in the input file"""
+
+    __slots__ = ('host', 'port', 'password', 'user', 'tls')
+
+    def __init__(self, host, port=DEFAULT_PORT, password=None, user=None,
+                 tls=False):
+        """
+        Args:
+            host, port: the address of a node of the DB
+            password: the password, or None
+            user: the ACL user, or None for the default user
+            tls: connect over TLS
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.user = user
+        self.tls = tls
+
+    def __repr__(self):
+        return 'Endpoint(%s:%d%s)' % (self.host, self.port,
+                                     ', tls' if self.tls else '')
+
+
+def is_empty(value):
+    """Is a cell empty (None, NaN or blank)"""
+    if value is None:
+        return True
+    if isinstance(value, float):
+        return value != value
+    return isinstance(value, str) and not value.strip()
+
+
+def get_text(value):
+    if is_empty(value):
+        return None
+    # Excel cells holding digits only are read as numbers
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def get_port(value):
+    if is_empty(value):
+        return DEFAULT_PORT
+    try:
+        port = int(float(value))
+    except ValueError:
+        raise InputError('Invalid port %r' % (value,))
+    if not 0 < port < 65536:
+        raise InputError('Invalid port %r' % (value,))
+    return port
+
+
+def get_tls(value):
+    if is_empty(value):
+        return False
+    if isinstance(value, str):
+        return value.strip().lower() not in FALSE_VALUES
+    return bool(value)
+
+
+def get_field_positions(header):
+    """
+    Map the fields to the positions of their columns in a header row
+    Args:
+        header: the column names
+    Returns:
+        a dictionary of field to column position, for the columns found
+    """
+    positions = {}
+    for position, name in enumerate(header):
+        name = get_text(name)
+        field = None if name is None else FIELDS_BY_NAME.get(name.lower())
+        if field is not None and field not in positions:
+            positions[field] = position
+    if 'host' not in positions:
+        raise InputError('No %s column in the header' %
+                         ' or '.join(FIELD_NAMES['host']))
+    return positions
+
+
+def get_endpoint(fields):
+    """
+    Build the endpoint of a row
+    Args:
+        fields: a dictionary of field to cell value
+    Returns:
+        the Endpoint, or None if the row has no host (e.g. a blank line)
+    """
+    host = get_text(fields.get('host'))
+    if host is None:
+        return None
+    return Endpoint(host, get_port(fields.get('port')),
+                    get_text(fields.get('password')),
+                    get_text(fields.get('user')),
+                    get_tls(fields.get('tls')))
+
+
+def iter_table_endpoints(rows, source):
+    """
+    Parse the endpoints of a table whose first row is the header
+    Args:
+        rows: an iterator over the rows, as sequences of cell values
+        source: the name of the input, for the error messages
+    Returns:
+        a generator of Endpoint
+    """
+    header = next(rows, None)
+    if header is None:
+        return
+    positions = get_field_positions(header)
+    for line, row in enumerate(rows, 2):
+        try:
+            endpoint = get_endpoint({
+                field: row[position] if position < len(row) else None
+                for field, position in positions.items()})
+        except InputError as e:
+            print('Skipping row %d of %s: %s' % (line, source, e))
+            continue
+        if endpoint is not None:
+            yield endpoint
+
+
+def read_xlsx(f, source):
+    """Parse the endpoints of the "Redis Sizing Input" sheet of a workbook,
+    in openpyxl's read-only mode, which loads the rows as they are read
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+    try:
+        if SHEET_NAME not in workbook.sheetnames:
+            raise InputError('No "%s" sheet in %s' % (SHEET_NAME, source))
+        for endpoint in iter_table_endpoints(
+                workbook[SHEET_NAME].iter_rows(values_only=True), source):
+            yield endpoint
+    finally:
+        workbook.close()
+
+
+def read_csv(lines, source):
+    return iter_table_endpoints(csv.reader(lines), source)
+
+
+def read_jsonl(lines, source):
+    """Parse the endpoints of a JSON lines input, one object per line"""
+    for line, text in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            value = json.loads(text)
+            if not isinstance(value, dict):
+                raise InputError('Expected an object')
+            fields = {}
+            for key, cell in value.items():
+                field = FIELDS_BY_NAME.get(key.lower())
+                if field is not None:
+                    fields.setdefault(field, cell)
+            endpoint = get_endpoint(fields)
+        except (ValueError, InputError) as e:
+            print('Skipping line %d of %s: %s' % (line, source, e))
+            continue
+        if endpoint is not None:
+            yield endpoint
+
+
+def get_input_format(path, input_format=None):
+    """
+    Get the format of an input file from its extension
+    Args:
+        path: the input file path, '-' for stdin
+        input_format: the format given by the user, one of INPUT_FORMATS,
+            or None
+    Returns:
+        the format, or None for stdin if not given
+    Raises:
+        InputError: if the extension isn't one of INPUT_EXTENSIONS
+    """
+    if input_format is not None:
+        return input_format
+    if path == '-':
+        return None
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in INPUT_EXTENSIONS:
+        raise InputError(
+            'Unknown input file extension "%s" of %s, expected one of %s, '
+            'or give the format with --input-format (%s)' % (
+                extension, path, ', '.join(INPUT_EXTENSIONS),
+                ', '.join(INPUT_FORMATS)))
+    return INPUT_EXTENSIONS[extension]
+
+
+def read_endpoints(path, input_format=None):
+    """
+    Read the endpoints listed in an input file, lazily: the rows are parsed
+    as the endpoints are consumed. Rows without a host are skipped, and
+    rows that can't be parsed are reported and skipped.
+    Args:
+        path: the input file path, '-' for stdin
+        input_format: one of INPUT_FORMATS, or None to tell it from the
+            extension of the file (stdin: JSON lines if the first line
+            starts with '{', CSV otherwise)
+    Returns:
+        a generator of Endpoint
+    """
+    input_format = get_input_format(path, input_format)
+    if input_format not in INPUT_FORMATS + [None]:
+        raise ValueError('Unknown input format %s, expected one of %s'
+                         % (input_format, ', '.join(INPUT_FORMATS)))
+    source = 'stdin' if path == '-' else path
+    if input_format == 'xlsx':
+        # A workbook is a zip file, which has to be seekable
+        f = io.BytesIO(sys.stdin.buffer.read()) if path == '-' \
+            else open(path, 'rb')
+        with f:
+            for endpoint in read_xlsx(f, source):
+                yield endpoint
+        return
+
+    f = sys.stdin if path == '-' else open(path, newline='')
+    try:
+        lines = iter(f)
+        if input_format is None:
+            first = next(lines, '')
+            input_format = 'jsonl' if first.lstrip().startswith('{') \
+                else 'csv'
+            lines = itertools.chain([first], lines)
+        reader = read_jsonl if input_format == 'jsonl' else read_csv
+        for endpoint in reader(lines, source):
+            yield endpoint
+    finally:
+        if f is not sys.stdin:
+            f.close()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Profile the keyspace of a Redis node from a sample of its keys: the keys
+# are walked with SCAN, and the TYPE, MEMORY USAGE and PTTL of every batch
+# of keys scanned are fetched in one pipelined round trip. The keys read
+# per second and the keys read per node are capped, so that profiling a
+# production node adds a bounded, predictable load to it.
+
+import bisect
+import heapq
+import itertools
+import threading
+import time
+
+from apiProfiler import PROFILER
+
+# The keys sampled per node, spread over its logical databases
+DEFAULT_MAX_KEYS = 10000
+
+# The keys sampled per second per node
+DEFAULT_KEYS_PER_SECOND = 1000
+
+# The keys scanned (SCAN COUNT) and inspected per round trip
+DEFAULT_BATCH_SIZE = 100
+
+# The biggest keys listed per node
+DEFAULT_TOP_KEYS = 20
+
+# The upper bounds (in bytes) of the key size histogram buckets, the last
+# bucket holding everything bigger
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576,
+                4194304, 16777216, 67108864)
+
+
+def format_size(count):
+    for unit in ('B', 'KB', 'MB'):
+        if count < 1024 or unit == 'MB':
+            return '%d %s' % (count, unit)
+        count //= 1024
+
+
+def get_bucket_columns():
+    return ['<= %s' % format_size(bound) for bound in SIZE_BUCKETS] + \
+        ['> %s' % format_size(SIZE_BUCKETS[-1])]
+
+
+def get_type_columns():
+    """The columns of the per node, per type rows"""
+    return ['DB Name', 'Node', 'Type', 'Sampled Keys', 'Sampled Share',
+            'Estimated Keys', 'Avg Bytes', 'Max Bytes', 'Estimated Bytes',
+            'Keys With TTL'] + get_bucket_columns()
+
+
+def get_big_key_columns():
+    """The columns of the biggest keys rows"""
+    return ['DB Name', 'Node', 'Logical DB', 'Key', 'Type', 'Bytes',
+            'TTL (s)']
+
+
+class KeyRateLimiter(object):
+    """Pace the keys read from a node to a steady number per second"""
+
+    def __init__(self, keys_per_second):
+        self.keys_per_second = keys_per_second
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def acquire(self, keys):
+        """Block until keys more keys may be read"""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + \
+                float(keys) / self.keys_per_second
+        if wait > 0:
+            with PROFILER.measure('sleep.keyspace_rate'):
+                time.sleep(wait)
+
+
+class TypeStats(object):
+    """The size histogram of the sampled keys of one type"""
+
+    __slots__ = ('keys', 'sized_keys', 'bytes', 'max_bytes', 'with_ttl',
+                 'buckets')
+
+    def __init__(self):
+        self.keys = 0
+        self.sized_keys = 0
+        self.bytes = 0
+        self.max_bytes = 0
+        self.with_ttl = 0
+        self.buckets = [0] * (len(SIZE_BUCKETS) + 1)
+
+    def observe(self, size, ttl):
+        self.keys += 1
+        self.with_ttl += ttl is not None
+        if size is None:
+            return
+        self.sized_keys += 1
+        self.bytes += size
+        self.max_bytes = max(self.max_bytes, size)
+        self.buckets[bisect.bisect_left(SIZE_BUCKETS, size)] += 1
+
+
+class KeyspaceProfile(object):
+    """The statistics of the keys sampled from a node, by type, and its
+    top_keys biggest keys
+    """
+
+    def __init__(self, top_keys=DEFAULT_TOP_KEYS):
+        self.top_keys = top_keys
+        self.types = {}
+        self.sampled = 0
+        # A min-heap of (bytes, sequence, db, key, type, ttl), the smallest
+        # of the biggest keys first; the sequence breaks ties
+        self._big_keys = []
+        self._sequence = itertools.count()
+
+    def add(self, db, key, key_type, size, ttl):
+        """
+        Add a sampled key
+        Args:
+            db: the logical database of the key
+            key: the key name (bytes)
+            key_type: the key type, e.g. 'string'
+            size: the MEMORY USAGE of the key in bytes, or None if unknown
+            ttl: the seconds before the key expires, or None
+        """
+        stats = self.types.get(key_type)
+        if stats is None:
+            stats = self.types[key_type] = TypeStats()
+        stats.observe(size, ttl)
+        self.sampled += 1
+        if size is None or self.top_keys <= 0:
+            return
+        entry = (size, next(self._sequence), db, key, key_type, ttl)
+        if len(self._big_keys) < self.top_keys:
+            heapq.heappush(self._big_keys, entry)
+        elif size > self._big_keys[0][0]:
+            heapq.heapreplace(self._big_keys, entry)
+
+    def get_type_rows(self, db_name, node, total_keys):
+        """
+        Get the per type rows of the node
+        Args:
+            db_name, node: the DB and node the keys were sampled from
+            total_keys: the keys of the node, to extrapolate the sample to
+        Returns:
+            a list of dictionaries, see get_type_columns
+        """
+        rows = []
+        for key_type, stats in sorted(self.types.items()):
+            share = float(stats.keys) / self.sampled
+            avg_bytes = float(stats.bytes) / stats.sized_keys \
+                if stats.sized_keys else None
+            row = {
+                'DB Name': db_name,
+                'Node': node,
+                'Type': key_type,
+                'Sampled Keys': stats.keys,
+                'Sampled Share': share,
+                'Estimated Keys': int(round(share * total_keys)),
+                'Avg Bytes': avg_bytes,
+                'Max Bytes': stats.max_bytes if stats.sized_keys else None,
+                'Estimated Bytes': None if avg_bytes is None else
+                int(round(avg_bytes * share * total_keys)),
+                'Keys With TTL': stats.with_ttl,
+            }
+            row.update(zip(get_bucket_columns(), stats.buckets))
+            rows.append(row)
+        return rows
+
+    def get_big_key_rows(self, db_name, node):
+        """The rows of the biggest keys of the node, biggest first"""
+        return [{
+            'DB Name': db_name,
+            'Node': node,
+            'Logical DB': db,
+            'Key': key.decode('utf-8', 'backslashreplace'),
+            'Type': key_type,
+            'Bytes': size,
+            'TTL (s)': ttl,
+        } for (size, _, db, key, key_type, ttl) in sorted(
+            self._big_keys, reverse=True)]
+
+
+def get_budgets(keyspace, max_keys):
+    """
+    Spread the keys to sample over the logical databases, in proportion to
+    their number of keys
+    Args:
+        keyspace: the number of keys of every logical database
+        max_keys: the keys to sample in all
+    Returns:
+        the number of keys to sample of every logical database
+    """
+    total = sum(keyspace.values())
+    if total <= max_keys:
+        return dict(keyspace)
+    budgets = {}
+    for db, keys in sorted(keyspace.items()):
+        budgets[db] = min(keys, max(1, max_keys * keys // total))
+    return budgets
+
+
+def get_reply(reply):
+    """A reply of the inspection pipeline, None if the command failed"""
+    if isinstance(reply, Exception):
+        return None
+    return reply
+
+
+def sample_keys(client, count, limiter, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Sample the keys of the logical database a client is connected to
+    Args:
+        client: the client connected to the node and database
+        count: the number of keys to sample
+        limiter: the KeyRateLimiter of the node
+        batch_size: the keys scanned and inspected per round trip
+    Returns:
+        a generator of (key, type, bytes, ttl) tuples, with bytes None if
+        MEMORY USAGE failed and ttl None if the key doesn't expire
+    """
+    cursor = 0
+    sampled = 0
+    while sampled < count:
+        limiter.acquire(batch_size)
+        with PROFILER.measure('redis.keyspace.scan'):
+            (cursor, keys) = client.scan(cursor, count=batch_size)
+        keys = keys[:count - sampled]
+        if keys:
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.type(key)
+                pipe.memory_usage(key)
+                pipe.pttl(key)
+            with PROFILER.measure('redis.keyspace.inspect'):
+                replies = pipe.execute(raise_on_error=False)
+            for i, key in enumerate(keys):
+                (key_type, size, ttl) = (get_reply(reply)
+                                         for reply in replies[3 * i:3 * i + 3])
+                if key_type is None:
+                    continue
+                if isinstance(key_type, bytes):
+                    key_type = key_type.decode()
+                # The key expired or was deleted since it was scanned
+                if key_type == 'none':
+                    continue
+                sampled += 1
+                yield (key, key_type, size,
+                       ttl / 1000.0 if ttl is not None and ttl >= 0
+                       else None)
+        if cursor == 0:
+            return
+
+
+def profile_node(get_db_client, keyspace, max_keys=DEFAULT_MAX_KEYS,
+                 keys_per_second=DEFAULT_KEYS_PER_SECOND,
+                 batch_size=DEFAULT_BATCH_SIZE, top_keys=DEFAULT_TOP_KEYS):
+    """
+    Profile the keyspace of a node
+    Args:
+        get_db_client: a function returning a client connected to the node
+            and to a given logical database
+        keyspace: the number of keys of every logical database of the node
+        max_keys: the keys to sample in all
+        keys_per_second: the keys to sample per second
+        batch_size: the keys scanned and inspected per round trip
+        top_keys: the biggest keys kept
+    Returns:
+        the KeyspaceProfile of the node
+    """
+    profile = KeyspaceProfile(top_keys)
+    limiter = KeyRateLimiter(keys_per_second)
+    for db, count in sorted(get_budgets(keyspace, max_keys).items()):
+        client = get_db_client(db)
+        try:
+            for (key, key_type, size, ttl) in sample_keys(
+                    client, count, limiter, batch_size):
+                profile.add(db, key, key_type, size, ttl)
+        finally:
+            client.close()
+    return profile
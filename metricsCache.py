@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# A persistent on-disk cache of metric datapoints shared by the cloud
+# collectors: the datapoints of every (resource, metric, statistic, period)
+# series are kept in a SQLite file between runs, so a re-run only fetches
+# the part of the collection window that isn't cached yet.
+
+import calendar
+import os
+import sqlite3
+import threading
+import time
+
+from apiProfiler import PROFILER
+
+# Datapoints (and series not read) older than this are evicted
+DEFAULT_TTL_DAYS = 14
+
+# The cache file is trimmed down to this size, least recently read series
+# first
+DEFAULT_MAX_SIZE_MB = 512
+
+# Datapoints of periods which ended less than this long ago may still be
+# updated by the service, so they are fetched again on the next run
+SETTLE_SECONDS = 15 * 60
+
+# The number of series evicted at once when the cache is over its size
+EVICTION_BATCH_SIZE = 1000
+
+SECONDS_IN_DAY = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    key TEXT PRIMARY KEY,
+    covered_from INTEGER NOT NULL,
+    covered_to INTEGER NOT NULL,
+    fetched_at INTEGER NOT NULL,
+    accessed_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datapoints (
+    key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (key, ts)
+) WITHOUT ROWID;
+"""
+
+
+def to_timestamp(value):
+    """Convert a datetime (naive ones are taken as UTC) to epoch seconds"""
+    if value.tzinfo is None:
+        return calendar.timegm(value.timetuple())
+    return int(value.timestamp())
+
+
+def get_settled_end(period, end, now):
+    """The end of the last period of a series which has settled by now,
+    within a window ending at end: the datapoints up to there won't change
+    any more"""
+    return min(end, int(now - SETTLE_SECONDS) // period * period)
+
+
+def get_key(*parts):
+    """Build the cache key of a series from its identifying parts"""
+    return "/".join(str(part) for part in parts)
+
+
+class MetricsCache(object):
+    """Cache the datapoints of metric series in a SQLite file.
+
+    Every series records the [covered_from, covered_to) range its cached
+    datapoints are complete for. get_missing_ranges tells which range of
+    each series must still be fetched, put stores the fetched datapoints and
+    extends the ranges, and get reads the datapoints of the collection
+    window. A series which is complete up to its last settled period isn't
+    fetched again: until another period settles, a request could only
+    return the datapoints of the periods still in progress.
+
+    A single instance may be shared by threads.
+    """
+
+    def __init__(self, path, ttl_days=DEFAULT_TTL_DAYS,
+                 max_size_mb=DEFAULT_MAX_SIZE_MB, max_age_seconds=0):
+        """
+        Args:
+            path: the SQLite file, created when missing
+            ttl_days: datapoints and unread series older than this are
+                evicted
+            max_size_mb: the size the cache file is trimmed down to
+            max_age_seconds: series fetched less than this long ago are
+                read from the cache without fetching their newest datapoints
+        """
+        self.path = path
+        self.ttl_seconds = ttl_days * SECONDS_IN_DAY
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.max_age_seconds = max_age_seconds
+        self.cached = 0
+        self.refreshed = 0
+        self.fetched = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # auto_vacuum only takes effect on a new database
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_missing_ranges(self, keys, start, end, periods):
+        """Get the ranges of several series which aren't cached yet
+        Args:
+            keys: the series keys
+            start, end: the collection window, in epoch seconds
+            periods: the period of every series, in the same order
+        Returns:
+            A dictionary of key to the (start, end) range to fetch, or None
+            if the window is cached up to its last settled period
+        """
+        now = time.time()
+        ranges = {}
+        with self._lock:
+            for key, period in zip(keys, periods):
+                row = self._conn.execute(
+                    "SELECT covered_from, covered_to, fetched_at FROM series "
+                    "WHERE key = ?", (key,)).fetchone()
+                if row is None or row[0] > start or row[1] < start:
+                    self.fetched += 1
+                    ranges[key] = (start, end)
+                elif row[1] >= get_settled_end(period, end, now) or \
+                        row[2] >= now - self.max_age_seconds:
+                    self.cached += 1
+                    ranges[key] = None
+                else:
+                    self.refreshed += 1
+                    ranges[key] = (row[1], end)
+        return ranges
+
+    def put(self, entries):
+        """Store the fetched datapoints of several series in one transaction
+        Args:
+            entries: (key, start, end, period, points) tuples, where
+                [start, end) is the fetched range in epoch seconds and points
+                the (timestamp, value) pairs returned for it
+        """
+        now = int(time.time())
+        with self._lock, self._conn, PROFILER.measure('cache.put'):
+            for (key, start, end, period, points) in entries:
+                # Periods that haven't settled yet are fetched again once
+                # they have, so the series is only complete up to the last
+                # one that has.
+                covered_to = max(start, get_settled_end(period, end, now))
+                row = self._conn.execute(
+                    "SELECT covered_from, covered_to FROM series "
+                    "WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] <= start <= row[1]:
+                    covered_from = row[0]
+                else:
+                    covered_from = start
+                    self._conn.execute(
+                        "DELETE FROM datapoints WHERE key = ?", (key,))
+                self._conn.execute(
+                    "DELETE FROM datapoints WHERE key = ? AND ts >= ? "
+                    "AND ts < ?", (key, start, end))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?)",
+                    [(key, int(ts), value) for (ts, value) in points])
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)",
+                    (key, covered_from, covered_to, now, now))
+
+    def get(self, keys, start, end):
+        """Get the cached datapoints of several series within a window
+        Returns:
+            A dictionary of key to its (timestamp, value) pairs, in timestamp
+            order
+        """
+        now = int(time.time())
+        with self._lock, self._conn, PROFILER.measure('cache.get'):
+            self._conn.executemany(
+                "UPDATE series SET accessed_at = ? WHERE key = ?",
+                [(now, key) for key in keys])
+            return {key: self._conn.execute(
+                "SELECT ts, value FROM datapoints WHERE key = ? AND ts >= ? "
+                "AND ts < ? ORDER BY ts", (key, start, end)).fetchall()
+                for key in keys}
+
+    def get_size(self):
+        """The bytes used by the cache file, excluding its free pages"""
+        (page_count,) = self._conn.execute("PRAGMA page_count").fetchone()
+        (free_count,) = self._conn.execute(
+            "PRAGMA freelist_count").fetchone()
+        (page_size,) = self._conn.execute("PRAGMA page_size").fetchone()
+        return (page_count - free_count) * page_size
+
+    def evict(self):
+        """Evict the expired datapoints and series, then the least recently
+        read series until the cache fits its size limit
+        Returns:
+            The number of series evicted
+        """
+        cutoff = int(time.time()) - self.ttl_seconds
+        with self._lock:
+            with self._conn:
+                expired = self._conn.execute(
+                    "SELECT key FROM series WHERE accessed_at < ?",
+                    (cutoff,)).fetchall()
+                self._delete_series([key for (key,) in expired])
+                self._conn.execute(
+                    "DELETE FROM datapoints WHERE ts < ?", (cutoff,))
+                self._conn.execute(
+                    "UPDATE series SET covered_from = ? "
+                    "WHERE covered_from < ?", (cutoff, cutoff))
+            evicted = len(expired)
+            while self.get_size() > self.max_size_bytes:
+                with self._conn:
+                    oldest = self._conn.execute(
+                        "SELECT key FROM series ORDER BY accessed_at "
+                        "LIMIT ?", (EVICTION_BATCH_SIZE,)).fetchall()
+                    if not oldest:
+                        break
+                    self._delete_series([key for (key,) in oldest])
+                evicted += len(oldest)
+            self._conn.execute("PRAGMA incremental_vacuum")
+        return evicted
+
+    def _delete_series(self, keys):
+        self._conn.executemany(
+            "DELETE FROM datapoints WHERE key = ?", [(k,) for k in keys])
+        self._conn.executemany(
+            "DELETE FROM series WHERE key = ?", [(k,) for k in keys])
+
+    def print_summary(self):
+        print("Metrics cache %s: %d series read from the cache, %d "
+              "refreshed, %d fetched in full" %
+              (self.path, self.cached, self.refreshed, self.fetched))
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# Streaming output writers shared by the collectors: result rows are written
+# sheet by sheet as they are produced, instead of being collected into a
+# DataFrame and written at the end of the run. Every format keeps the sheet
+# names and columns of the Excel workbook; the formats with no notion of
+# sheets write one file per sheet.
+
+import csv
+import datetime
+import json
+import math
+import os
+
+from apiProfiler import PROFILER
+from runJournal import to_json
+
+# The supported output formats, the default one first
+FORMATS = ['xlsx', 'csv', 'parquet', 'jsonl']
+
+# The number of rows buffered into each Parquet row group
+PARQUET_BATCH_SIZE = 10000
+
+
+def to_cell(value):
+    """Convert a value to a plain Python one, with missing values as None"""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def to_json_value(value):
+    """Serialize the dates and NumPy scalars found in the result rows"""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return to_json(value)
+
+
+class SheetWriter(object):
+    """Write the rows of one sheet, in order"""
+
+    def __init__(self, columns, index=False):
+        """
+        Args:
+            columns: the column names, in output order
+            index: prepend a row number column with an empty header, as
+                DataFrame.to_excel does by default
+        """
+        self.columns = list(columns)
+        self.index = index
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, row):
+        """Append a row given as a sequence in column order"""
+        if len(row) != len(self.columns):
+            raise ValueError('Expected %d values, got %d' %
+                             (len(self.columns), len(row)))
+        row = [to_cell(value) for value in row]
+        if self.index:
+            row = [self._length] + row
+        if PROFILER.enabled:
+            with PROFILER.measure('output.%s.write_row' % self.FORMAT):
+                self._write_row(row)
+        else:
+            self._write_row(row)
+        self._length += 1
+
+    def append_dict(self, row, default=''):
+        """Append a row given as a dictionary of column name to value"""
+        self.append([row.get(column, default) for column in self.columns])
+
+    def get_header(self):
+        return ([''] if self.index else []) + self.columns
+
+    def _write_row(self, row):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class XlsxSheetWriter(SheetWriter):
+    FORMAT = 'xlsx'
+
+    def __init__(self, worksheet, header_format, columns, index=False):
+        SheetWriter.__init__(self, columns, index)
+        self._worksheet = worksheet
+        self._worksheet.write_row(0, 0, self.get_header(), header_format)
+
+    def _write_row(self, row):
+        self._worksheet.write_row(self._length + 1, 0, row)
+
+
+class CsvSheetWriter(SheetWriter):
+    FORMAT = 'csv'
+
+    def __init__(self, path, columns, index=False):
+        SheetWriter.__init__(self, columns, index)
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.get_header())
+
+    def _write_row(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlSheetWriter(SheetWriter):
+    FORMAT = 'jsonl'
+
+    def __init__(self, path, columns, index=False):
+        # The row number carries no information in a JSON object per row
+        SheetWriter.__init__(self, columns, False)
+        self._file = open(path, 'w')
+
+    def _write_row(self, row):
+        self._file.write(json.dumps(dict(zip(self.columns, row)),
+                                    default=to_json_value) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSheetWriter(SheetWriter):
+    """Buffer the rows into row groups of PARQUET_BATCH_SIZE rows. The
+    schema is taken from the column dtypes and, for the other columns, from
+    the first row group.
+    """
+
+    FORMAT = 'parquet'
+
+    def __init__(self, path, columns, dtypes=None, index=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet format requires pyarrow, "
+                              "install it with 'pip install pyarrow'")
+        SheetWriter.__init__(self, columns, False)
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._path = path
+        self._types = {column: {'float': pyarrow.float64(),
+                                'int': pyarrow.int64()}[dtype]
+                       for column, dtype in (dtypes or {}).items()}
+        self._writer = None
+        self._batch = []
+
+    def _write_row(self, row):
+        self._batch.append(row)
+        if len(self._batch) >= PARQUET_BATCH_SIZE:
+            self._flush()
+
+    def _get_array(self, column, values):
+        pa = self._pa
+        column_type = self._types.get(column)
+        if column_type is None:
+            try:
+                array = pa.array(values)
+                if not pa.types.is_null(array.type):
+                    return array
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # e.g. numbers and empty strings in the same column
+                pass
+            column_type = pa.string()
+        if pa.types.is_string(column_type):
+            values = [None if value is None else str(value)
+                      for value in values]
+        return pa.array(values, type=column_type)
+
+    def _flush(self):
+        arrays = [self._get_array(column, [row[i] for row in self._batch])
+                  for i, column in enumerate(self.columns)]
+        if self._writer is None:
+            # The types of the first row group are kept for the next ones
+            self._types = {column: array.type
+                           for column, array in zip(self.columns, arrays)}
+            self._writer = self._pq.ParquetWriter(
+                self._path, self._pa.schema(list(self._types.items())))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            arrays, schema=self._writer.schema))
+        self._batch = []
+
+    def close(self):
+        if self._batch or self._writer is None:
+            self._flush()
+        self._writer.close()
+
+
+class OutputWriter(object):
+    """Write the sheets of one output, in the given format.
+
+    xlsx sheets are written to a single workbook in xlsxwriter's
+    constant_memory mode, the other formats to a <base>-<sheet>.<format>
+    file per sheet. When used as a context manager, the outputs of a failed
+    run are removed.
+    """
+
+    def __init__(self, base_path, output_format='xlsx'):
+        """
+        Args:
+            base_path: the output path, without its extension
+            output_format: one of FORMATS
+        """
+        if output_format not in FORMATS:
+            raise ValueError('Unknown output format %s, expected one of %s'
+                             % (output_format, ', '.join(FORMATS)))
+        self.format = output_format
+        self.base_path = base_path
+        self.paths = []
+        self._sheets = []
+        self._workbook = None
+        if output_format == 'xlsx':
+            import xlsxwriter
+            self.paths.append('%s.xlsx' % base_path)
+            self._workbook = xlsxwriter.Workbook(
+                self.paths[0], {'constant_memory': True,
+                                'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+            self._header_format = self._workbook.add_format(
+                {'bold': True, 'border': 1, 'align': 'center',
+                 'valign': 'top'})
+
+    def add_sheet(self, name, columns, dtypes=None, index=False):
+        """Start a new sheet
+        Args:
+            name: the sheet name
+            columns: the column names, in output order
+            dtypes: a dictionary of column name to 'float' or 'int'
+            index: prepend a row number column
+        Returns:
+            The SheetWriter the rows of the sheet are appended to
+        """
+        if self.format == 'xlsx':
+            sheet = XlsxSheetWriter(self._workbook.add_worksheet(name),
+                                    self._header_format, columns, index)
+        else:
+            path = '%s-%s.%s' % (self.base_path, name, self.format)
+            self.paths.append(path)
+            if self.format == 'csv':
+                sheet = CsvSheetWriter(path, columns, index)
+            elif self.format == 'jsonl':
+                sheet = JsonlSheetWriter(path, columns, index)
+            else:
+                sheet = ParquetSheetWriter(path, columns, dtypes, index)
+        self._sheets.append(sheet)
+        return sheet
+
+    def close(self):
+        # The xlsx workbook is only assembled and written out here
+        with PROFILER.measure('output.%s.close' % self.format):
+            for sheet in self._sheets:
+                sheet.close()
+            if self._workbook is not None:
+                self._workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # Don't leave an output behind that looks complete but isn't
+        if exc_type is not None:
+            for path in self.paths:
+                if os.path.exists(path):
+                    os.remove(path)
@@ -1,11 +1,17 @@
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.redis import RedisManagementClient
-from azure.mgmt.monitor import MonitorManagementClient
-from azure.mgmt.subscription import SubscriptionClient
+# The Azure SDK and NumPy are imported where they are used, so that --help
+# and the argument checks don't pay for loading them.
+import concurrent.futures
 import datetime
-import pandas as pd
+import email.utils
 from pathlib import Path
 import argparse
+import threading
+import time
+
+from apiProfiler import PROFILER
+from metricsCache import DEFAULT_MAX_SIZE_MB, DEFAULT_TTL_DAYS, \
+    MetricsCache, get_key, to_timestamp
+from outputWriters import FORMATS, OutputWriter
 
 # The measurement collection period in days.
 METRIC_COLLECTION_PERIOD_DAYS = 7
@@ -17,46 +23,277 @@ AGGREGATION_PERIOD = "PT1H"
 # Seconds in the aggregation period
 SECONDS_PER_AGGREGATION_PERIOD = 3600
 
-# The Azure metrics to be collected for each cluster
-METRICS = "totalcommandsprocessed,usedmemory"
+# The Azure metrics to be collected for each cluster, as
+# "<metric>:<aggregation>" pairs
+METRICS = "totalcommandsprocessed:Total,usedmemory:Total"
+
+# The aggregations Azure Monitor supports
+AGGREGATIONS = ["Average", "Count", "Maximum", "Minimum", "Total"]
+
+# The column names of the metrics the script has always reported
+METRIC_LABELS = {
+    ("totalcommandsprocessed", "Total"): "Total Commands Processed",
+    ("usedmemory", "Total"): "Used Memory",
+}
+
+# The statistics reported for every metric, over its hourly time series
+METRIC_STATS = ["max", "mean", "p95", "p99"]
+
+# Azure Monitor accepts up to 20 metrics per request
+MAX_METRICS_PER_REQUEST = 20
+
+# Retries of a throttled (HTTP 429) request, once the SDK's own retries are
+# exhausted, and the wait between them when no Retry-After is returned
+MAX_THROTTLING_RETRIES = 5
+DEFAULT_RETRY_AFTER_SECONDS = 10
+
+# The operation being called on each thread, and the HTTP attempts the SDK
+# made for it, so that profile_response can attribute them
+profile_state = threading.local()
+
+
+def get_retry_after(response):
+    """Get the seconds to wait from the Retry-After header of a response,
+    which is either a number of seconds or an HTTP date
+    """
+    retry_after = response.headers.get("Retry-After") \
+        if response is not None else None
+    if retry_after is None:
+        return DEFAULT_RETRY_AFTER_SECONDS
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0, (retry_at - datetime.datetime.now(
+            retry_at.tzinfo)).total_seconds())
+
+
+def call_with_retry_after(operation, func, *args, **kwargs):
+    """Call an Azure API, waiting for the Retry-After of throttled calls
+    Args:
+        operation: the name the call is profiled under, e.g.
+            monitor.metrics.list
+        func: the function making the call
+        args, kwargs: the arguments of func
+    """
+    from azure.core.exceptions import HttpResponseError
+
+    for attempt in range(MAX_THROTTLING_RETRIES + 1):
+        profile_state.operation = operation
+        profile_state.attempts = 0
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            throttled = isinstance(e, HttpResponseError) and \
+                e.status_code == 429
+            # The throttled HTTP attempts are counted as the SDK reports
+            # them, unless it reported none
+            PROFILER.record(
+                operation, time.monotonic() - start,
+                error=str(getattr(e, "status_code", None) or
+                          type(e).__name__),
+                throttled=throttled and profile_state.attempts == 0)
+            if not throttled or attempt == MAX_THROTTLING_RETRIES:
+                raise
+            PROFILER.add(operation, retries=1)
+            with PROFILER.measure("sleep.retry_after"):
+                time.sleep(get_retry_after(e.response))
+        else:
+            PROFILER.record(operation, time.monotonic() - start)
+            return result
+
+
+def profile_response(response):
+    """Record the bytes and throttling of every HTTP attempt of the SDK, as
+    its raw_response_hook
+    """
+    profile_state.attempts = getattr(profile_state, "attempts", 0) + 1
+    http_response = response.http_response
+    PROFILER.add(getattr(profile_state, "operation", "azure.other"),
+                 throttled=http_response.status_code == 429,
+                 bytes_sent=len(response.http_request.body or b""),
+                 bytes_received=len(http_response.body() or b""))
+
+
+def get_client_kwargs(endpoint):
+    """Get the management client arguments: those of a non-default (e.g. a
+    sovereign cloud or local) Azure Resource Manager endpoint, and the
+    profiling hook when profiling
+    """
+    kwargs = {}
+    if endpoint is not None:
+        endpoint = endpoint.rstrip("/")
+        kwargs.update(base_url=endpoint,
+                      credential_scopes=[endpoint + "/.default"])
+    if PROFILER.enabled:
+        kwargs["raw_response_hook"] = profile_response
+    return kwargs
+
+
+def parse_metric_specs(metrics):
+    """Parse a comma separated list of "<metric>:<aggregation>" pairs
+    Returns:
+        The list of (metric, aggregation) tuples
+    """
+    specs = []
+    for spec in metrics.split(","):
+        name, _, aggregation = spec.strip().partition(":")
+        aggregation = aggregation.strip().capitalize() or "Total"
+        if aggregation not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation '{}' for metric '{}', "
+                             "expected one of {}".format(
+                                 aggregation, name, ", ".join(AGGREGATIONS)))
+        specs.append((name.strip(), aggregation))
+    return specs
+
+
+def get_metric_label(spec):
+    (name, aggregation) = spec
+    return METRIC_LABELS.get((name.lower(), aggregation),
+                             "{} ({})".format(name, aggregation))
+
+
+def get_metric_columns(specs):
+    """The columns of the statistics of every metric; the max is labeled
+    with the metric label alone
+    """
+    return [get_metric_label(spec) if stat == "max" else
+            "{} ({})".format(get_metric_label(spec), stat)
+            for spec in specs
+            for stat in METRIC_STATS]
 
 
-def get_metrics(mc, resource_id):
+def get_metric_window():
+    """Get the collection window: the METRIC_COLLECTION_PERIOD_DAYS days up
+    to the end of today
+    Returns:
+        The (start, end) epoch seconds of the window
+    """
     today = datetime.date.today() + datetime.timedelta(days=1)
     then = today - datetime.timedelta(days=METRIC_COLLECTION_PERIOD_DAYS)
-    timespan = "{}/{}".format(then, today)
-    metrics_data = mc.metrics.list(
-        resource_id,
-        metricnames=METRICS,
-        timespan=timespan,
-        interval=AGGREGATION_PERIOD,
-        aggregation="Total")
-
-    # WARNING - if you change the aggregation above then you MUST change the
-    # accessor below to its lower case equivalent
-    # e.g. if you use "Maximum" above then you'd use metric_value.maximum
-    # below.
-
-    # Ugh - this is a very painful expression caused by the nesting of various
-    # arrays within the Azure data types.
-    return [
-        max(
-            [
-                metric_value.total
+    return (to_timestamp(datetime.datetime.combine(then, datetime.time())),
+            to_timestamp(datetime.datetime.combine(today, datetime.time())))
+
+
+def get_timespan(start, end):
+    return "{}/{}".format(
+        *(datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+          .strftime("%Y-%m-%dT%H:%M:%SZ") for t in (start, end)))
+
+
+def fetch_metrics(mc, resource_id, specs, start, end):
+    """Fetch the hourly datapoints of the metrics of a resource
+    Args:
+        mc: the MonitorManagementClient of the resource's subscription
+        resource_id: the resource id of the cache
+        specs: the (metric, aggregation) tuples to fetch
+        start, end: the epoch seconds of the range to fetch
+    Returns:
+        A dictionary of (metric, aggregation) to the list of
+        (timestamp, value) datapoints
+    """
+    points = {}
+    for first in range(0, len(specs), MAX_METRICS_PER_REQUEST):
+        batch = specs[first:first + MAX_METRICS_PER_REQUEST]
+        names = list(dict.fromkeys(name for name, _ in batch))
+        aggregations = list(dict.fromkeys(agg for _, agg in batch))
+        metrics_data = call_with_retry_after(
+            "monitor.metrics.list",
+            mc.metrics.list,
+            resource_id,
+            metricnames=",".join(names),
+            timespan=get_timespan(start, end),
+            interval=AGGREGATION_PERIOD,
+            aggregation=",".join(aggregations))
+
+        # Every aggregation of a metric is returned on the same metric
+        # value, under the aggregation's lower case attribute.
+        returned = {metric.name.value.lower(): metric
+                    for metric in metrics_data.value}
+        for (name, aggregation) in batch:
+            metric = returned.get(name.lower())
+            values = [] if metric is None else [
+                (to_timestamp(metric_value.time_stamp),
+                 getattr(metric_value, aggregation.lower()))
                 for ts in metric.timeseries
-                for metric_value in ts.data
-                if metric_value.total is not None
-            ]
-        )
-        for metric in metrics_data.value
-    ]
+                for metric_value in ts.data]
+            points[(name, aggregation)] = [
+                (t, v) for t, v in values if v is not None]
+    return points
+
+
+def get_metrics(mc, resource_id, specs, cache=None):
+    """Get the hourly time series of the metrics of a resource
+    Args:
+        mc: the MonitorManagementClient of the resource's subscription
+        resource_id: the resource id of the cache
+        specs: the (metric, aggregation) tuples to get
+        cache: the MetricsCache of previously fetched datapoints, if any;
+            only the range which isn't cached yet is then fetched
+    Returns:
+        A dictionary of (metric, aggregation) to a (timestamps, values) pair
+        of NumPy arrays
+    """
+    import numpy as np
+
+    (start, end) = get_metric_window()
+    if cache is None:
+        points = fetch_metrics(mc, resource_id, specs, start, end)
+    else:
+        keys = {spec: get_key("azure", resource_id.lower(), spec[0].lower(),
+                              spec[1], AGGREGATION_PERIOD)
+                for spec in specs}
+        missing_ranges = cache.get_missing_ranges(
+            list(keys.values()), start, end,
+            [SECONDS_PER_AGGREGATION_PERIOD] * len(keys))
+        missing = [spec for spec in specs
+                   if missing_ranges[keys[spec]] is not None]
+        if missing:
+            # One request covers the metrics of a cache, so fetch them all
+            # from the earliest missing datapoint
+            fetch_start = min(missing_ranges[keys[spec]][0]
+                              for spec in missing)
+            fetched = fetch_metrics(mc, resource_id, missing, fetch_start,
+                                    end)
+            cache.put([(keys[spec], fetch_start, end,
+                        SECONDS_PER_AGGREGATION_PERIOD, fetched[spec])
+                       for spec in missing])
+        cached = cache.get(list(keys.values()), start, end)
+        points = {spec: cached[keys[spec]] for spec in specs}
+    return {spec: (np.array([t for t, _ in points[spec]],
+                            dtype="datetime64[s]"),
+                   np.array([v for _, v in points[spec]], dtype=float))
+            for spec in specs}
+
+
+def get_metric_stats(series, specs):
+    """Reduce the time series of every metric to its METRIC_STATS
+    Returns:
+        The statistics, in get_metric_columns order
+    """
+    import numpy as np
+
+    stats = []
+    for spec in specs:
+        values = series[spec][1]
+        if len(values) == 0:
+            stats.extend([0] * len(METRIC_STATS))
+            continue
+        (p95, p99) = np.percentile(values, [95, 99])
+        stats.extend([values.max(), values.mean(), p95, p99])
+    return stats
 
 
 def get_resource_group(cluster):
     return cluster.id.split("/")[4]
 
 
-def process_cluster(cluster, mc):
+def process_cluster(cluster, mc, specs, cache=None):
+    """Get the row of a cache
+    Returns:
+        The (row, metric time series) pair
+    """
     non_metrics = [
         get_resource_group(cluster),
         cluster.name,
@@ -64,21 +301,64 @@ def process_cluster(cluster, mc):
         cluster.replicas_per_master,
         cluster.shard_count
     ]
-    metrics = get_metrics(mc, cluster.id)
-    return non_metrics + metrics
+    series = get_metrics(mc, cluster.id, specs, cache)
+    return non_metrics + get_metric_stats(series, specs), series
+
 
+def get_subscription_info(credential, endpoint=None):
+    from azure.mgmt.monitor import MonitorManagementClient
+    from azure.mgmt.subscription import SubscriptionClient
 
-def get_subscription_info(credential):
+    client_kwargs = get_client_kwargs(endpoint)
+    subscriptions = call_with_retry_after(
+        "subscription.subscriptions.list",
+        lambda: list(SubscriptionClient(
+            credential=credential,
+            **client_kwargs).subscriptions.list()))
     return [[sub.subscription_id, MonitorManagementClient(
             credential=credential,
-            subscription_id=sub.subscription_id
+            subscription_id=sub.subscription_id,
+            **client_kwargs
             )]
-            for sub in
-            SubscriptionClient(credential=credential).subscriptions.list()]
+            for sub in subscriptions]
+
+
+def list_clusters(credential, subscription_id, endpoint=None):
+    from azure.mgmt.redis import RedisManagementClient
 
+    # Page through the whole list here, so it happens on the worker thread
+    return call_with_retry_after(
+        "redis.redis.list",
+        lambda: list(RedisManagementClient(
+            credential, subscription_id,
+            **get_client_kwargs(endpoint)).redis.list()))
 
-def list_clusters(credential, subscription_id):
-    return RedisManagementClient(credential, subscription_id).redis.list()
+
+def collect_clusters(credential, workers, specs, endpoint=None, cache=None):
+    """List the caches of every subscription and get their metrics, on a
+    thread pool
+    Yields:
+        The (row, metric time series) pair of every cache, in subscription
+        and listing order, as soon as it and the caches before it are done
+    """
+    subscriptions = get_subscription_info(credential, endpoint)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        clusters = executor.map(
+            lambda sub_info: list_clusters(credential, sub_info[0], endpoint),
+            subscriptions)
+        jobs = [(sub_info, cluster)
+                for sub_info, sub_clusters in zip(subscriptions, clusters)
+                for cluster in sub_clusters]
+        # executor.map yields in submission order, so the rows are
+        # deterministic whatever order the requests complete in
+        yield from executor.map(
+            lambda job: get_cluster_row(job[0], job[1], specs, cache), jobs)
+
+
+def get_cluster_row(sub_info, cluster, specs, cache=None):
+    (row, series) = process_cluster(cluster, sub_info[1], specs, cache)
+    return [sub_info[0]] + row, series
 
 
 def main():
@@ -86,26 +366,105 @@ def main():
     parser.add_argument("-d", "--out-dir", dest="outDir", default=".",
                         help="directory to write the results in",
                         metavar="PATH")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="number of concurrent Azure requests",
+                        metavar="N")
+    parser.add_argument("--management-endpoint", default=None,
+                        help="Azure Resource Manager endpoint, for sovereign "
+                        "clouds or a local stand-in "
+                        "(default: https://management.azure.com)",
+                        metavar="URL")
+    parser.add_argument("-m", "--metrics", default=METRICS,
+                        help="comma separated <metric>:<aggregation> pairs "
+                        "to collect, e.g. serverLoad:Maximum,"
+                        "connectedclients:Maximum (default: %(default)s)",
+                        metavar="METRICS")
+    parser.add_argument("-t", "--timeseries", action="store_true",
+                        help="also write the hourly time series of every "
+                        "metric to a 'TimeSeries' sheet")
+    parser.add_argument("-f", "--format", choices=FORMATS,
+                        default=FORMATS[0],
+                        help="output format: xlsx writes AzureStats.xlsx, "
+                        "the other formats an AzureStats-<sheet>.<format> "
+                        "file per sheet (default: %(default)s)")
+    parser.add_argument("--cache", dest="cacheFile",
+                        help="SQLite file caching the fetched datapoints "
+                        "between runs, so that only new ones are fetched",
+                        metavar="FILE")
+    parser.add_argument("--cache-ttl-days", type=int,
+                        default=DEFAULT_TTL_DAYS,
+                        help="days cached datapoints are kept for "
+                        "(default: %(default)s)", metavar="DAYS")
+    parser.add_argument("--cache-max-mb", type=int,
+                        default=DEFAULT_MAX_SIZE_MB,
+                        help="size the cache is trimmed down to "
+                        "(default: %(default)s)", metavar="MB")
+    parser.add_argument("--cache-max-age", type=int, default=0,
+                        help="minutes within which a cached series is not "
+                        "refreshed, even if a period has completed since "
+                        "(default: %(default)s, refreshed once a period "
+                        "completes)",
+                        metavar="MINUTES")
+    parser.add_argument("--profile", action="store_true",
+                        help="record the calls, latency, throttling and "
+                        "bytes of every API operation and print a summary "
+                        "at exit")
+    parser.add_argument("--profile-output", default=None,
+                        help="also write the profile to FILE, as JSON if "
+                        "its name ends with .json and as OpenMetrics text "
+                        "otherwise (implies --profile)", metavar="FILE")
     args = parser.parse_args()
-    output_file_path = Path(args.outDir) / "AzureStats.xlsx"
+    base_path = Path(args.outDir) / "AzureStats"
+    try:
+        specs = parse_metric_specs(args.metrics)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.profile or args.profile_output is not None:
+        PROFILER.enable(args.profile_output)
 
+    cache = None
+    if args.cacheFile is not None:
+        cache = MetricsCache(args.cacheFile, args.cache_ttl_days,
+                             args.cache_max_mb, args.cache_max_age * 60)
+
+    from azure.identity import DefaultAzureCredential
     azure_credential = DefaultAzureCredential()
-    metrics = [[sub_info[0]] + process_cluster(cluster, sub_info[1])
-               for sub_info in get_subscription_info(azure_credential)
-               for cluster in list_clusters(azure_credential, sub_info[0])]
-    df = pd.DataFrame(metrics, columns=["Subscription ID",
-                                        "Resource Group",
-                                        "DB Name",
-                                        "SKU",
-                                        "Replicas per Master",
-                                        "Shard Count",
-                                        "Total Commands Processed",
-                                        "Used Memory"])
-
-    with (pd.ExcelWriter(output_file_path, engine='xlsxwriter')) as writer:
-        df.to_excel(writer, 'ClusterData', index=False)
-
-    print("Results are in {}".format(output_file_path))
+    metric_columns = get_metric_columns(specs)
+    with OutputWriter(str(base_path), args.format) as writer:
+        result = writer.add_sheet("ClusterData",
+                                  ["Subscription ID",
+                                   "Resource Group",
+                                   "DB Name",
+                                   "SKU",
+                                   "Replicas per Master",
+                                   "Shard Count"] + metric_columns,
+                                  {column: 'float'
+                                   for column in metric_columns})
+        if args.timeseries:
+            timeseries = writer.add_sheet("TimeSeries",
+                                          ["Subscription ID",
+                                           "DB Name",
+                                           "Metric",
+                                           "Aggregation",
+                                           "Timestamp",
+                                           "Value"],
+                                          {"Value": 'float'})
+        for row, series in collect_clusters(azure_credential, args.workers,
+                                            specs, args.management_endpoint,
+                                            cache):
+            result.append(row)
+            if args.timeseries:
+                for (name, aggregation), (timestamps, values) in \
+                        series.items():
+                    for timestamp, value in zip(timestamps, values):
+                        timeseries.append([row[0], row[2], name,
+                                           aggregation, timestamp, value])
+
+    if cache is not None:
+        cache.evict()
+        cache.print_summary()
+        cache.close()
+    print("Results are in {}".format(", ".join(writer.paths)))
 
 
 if __name__ == "__main__":
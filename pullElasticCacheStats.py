@@ -3,13 +3,26 @@
 # input params
 # path to the config file, see pullStatsConfig.json
 
+# boto3 is imported where it is used, so that --help and the config checks
+# don't pay for loading the AWS SDK.
+
 from optparse import OptionParser
 
-import boto3
+import concurrent.futures
 import datetime
+import itertools
 import os
-import pandas as pd
+import queue
+import random
 import sys
+import threading
+import time
+
+from apiProfiler import PROFILER
+from metricsCache import DEFAULT_MAX_SIZE_MB, DEFAULT_TTL_DAYS, \
+    MetricsCache, get_key, to_timestamp
+from outputWriters import FORMATS, OutputWriter
+from runJournal import RunJournal
 
 # Metric Collection Period (in days)
 METRIC_COLLECTION_PERIOD_DAYS = 7
@@ -19,6 +32,57 @@ SECONDS_IN_MINUTE = 60
 SECONDS_IN_HOUR = 3600
 SECONDS_IN_DAY = 24 * SECONDS_IN_HOUR
 
+# The maximal number of queries CloudWatch accepts in one GetMetricData call
+MAX_QUERIES_PER_REQUEST = 500
+
+# The columns of the ReservedData sheet
+RESERVED_COLUMNS = ["Instance Type", "Count", "Remaining Time (days)"]
+RESERVED_DTYPES = {"Count": 'int', "Remaining Time (days)": 'int'}
+
+# The cache nodes listed ahead of the ones whose metrics are fetched
+NODES_PREFETCHED = 10000
+
+# With --topology, the metrics of a shard's data set, which its replicas
+# only repeat: they are fetched for the primary only, and copied to the
+# rows of its replicas
+SHARD_METRICS = ('CurrItems', 'BytesUsedForCache')
+
+# With --topology, the metrics only nodes of one role report, which are
+# not fetched (and reported as 0) for the nodes of the other role
+ROLE_METRICS = {
+    'Evictions': 'primary',
+    'ReplicationBytes': 'primary',
+    'ReplicationLag': 'replica',
+}
+
+# The metrics the shard rollups take the maximum of, rather than the sum
+MAX_ROLLUP_METRICS = ('CurrItems', 'BytesUsedForCache',
+                      'EngineCPUUtilization', 'ReplicationLag')
+
+# The most datapoints CloudWatch returns in one GetMetricData response
+MAX_DATAPOINTS_PER_RESPONSE = 100800
+
+# The periods (in seconds) the command metrics can be fetched at with
+# --resolution, and how the columns name them. CloudWatch keeps 1 minute
+# datapoints for 15 days, so both cover the collection window.
+RESOLUTIONS = {60: 'minute', 300: '5 minutes'}
+
+# CloudWatch error codes that signal the request rate should be lowered
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException')
+
+# Retries of a throttled request and the backoff between them (in seconds)
+MAX_THROTTLING_RETRIES = 8
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+
+# The shared CloudWatch request rate (requests per second): it starts at
+# INITIAL_REQUEST_RATE, is halved on every throttling error and grows back
+# by REQUEST_RATE_INCREASE on every successful request.
+INITIAL_REQUEST_RATE = 10.0
+MIN_REQUEST_RATE = 0.5
+MAX_REQUEST_RATE = 50.0
+REQUEST_RATE_INCREASE = 0.5
+
 # Different versions of python 2.7 have renamed modules
 try:
     from configparser import ConfigParser
@@ -75,6 +139,184 @@ def get_max_metrics():
     return metrics
 
 
+class AdaptiveRateLimiter(object):
+    """A request rate shared by all the workers, which slows down when
+    CloudWatch throttles and speeds back up when it does not.
+    """
+
+    def __init__(self, rate=INITIAL_REQUEST_RATE):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_request_time = time.monotonic()
+
+    def acquire(self):
+        """Block until the next request may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request_time - now
+            self._next_request_time = \
+                max(now, self._next_request_time) + 1.0 / self.rate
+        if wait > 0:
+            with PROFILER.measure('sleep.rate_limit'):
+                time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(MAX_REQUEST_RATE,
+                            self.rate + REQUEST_RATE_INCREASE)
+
+
+class CloudWatchFetcher(object):
+    """The state shared by all the GetMetricData requests of an
+    account/region: the AdaptiveRateLimiter, so that throttling slows down
+    every later request, one CloudWatch client per worker thread, and the
+    thread pool the requests are sent from. Use it as a context manager, to
+    shut the pool down.
+    """
+
+    def __init__(self, session, workers=1):
+        """
+        Args:
+            session (:boto3:session.Session): The authenticated boto3
+                session.
+            workers: the number of concurrent CloudWatch requests
+        """
+        self.session = session
+        self.workers = workers
+        self.limiter = AdaptiveRateLimiter()
+        self._session_lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+
+    def get_client(self):
+        """The CloudWatch client of the calling thread"""
+        # boto3 sessions are not thread safe, clients are: create one
+        # client per worker thread and reuse it for all of its requests.
+        if not hasattr(self._local, 'cloud_watch'):
+            with self._session_lock:
+                self._local.cloud_watch = self.session.client('cloudwatch')
+        return self._local.cloud_watch
+
+    def map(self, fetch, batches):
+        """Call fetch on every batch on the worker threads, and iterate
+        over the results in order"""
+        return self._executor.map(fetch, batches)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown()
+
+
+def is_throttling_error(error):
+    return error.response.get('Error', {}).get('Code') in \
+        THROTTLING_ERROR_CODES
+
+
+def get_operation_name(service_model, operation_name):
+    """The name API calls are profiled under, e.g. cloudwatch.GetMetricData
+    """
+    return '%s.%s' % (service_model.service_name, operation_name)
+
+
+def profile_session(session):
+    """Record the calls made by the clients of a session in the PROFILER:
+    their latency, errors and retries, and the bytes of every HTTP attempt
+    """
+    def before_call(model, context, **kwargs):
+        context['profile_start'] = time.monotonic()
+
+    def after_call(model, http_response, parsed, context, **kwargs):
+        error = None
+        if http_response.status_code >= 300:
+            error = parsed.get('Error', {}).get('Code') or \
+                str(http_response.status_code)
+        # The throttled HTTP attempts are counted as they are received,
+        # unless the call was answered without any (e.g. by a Stubber)
+        PROFILER.record(
+            get_operation_name(model.service_model, model.name),
+            time.monotonic() - context['profile_start'], error=error,
+            throttled=error in THROTTLING_ERROR_CODES and
+            'profile_attempts' not in context,
+            retries=parsed.get('ResponseMetadata', {}).get(
+                'RetryAttempts', 0))
+
+    def after_call_error(model, exception, context, **kwargs):
+        PROFILER.record(
+            get_operation_name(model.service_model, model.name),
+            time.monotonic() - context['profile_start'],
+            error=type(exception).__name__)
+
+    def request_created(request, operation_name, **kwargs):
+        PROFILER.add(request.context.get('profile_operation'),
+                     bytes_sent=len(request.body or b''))
+
+    def response_received(response_dict, parsed_response, context,
+                          **kwargs):
+        context['profile_attempts'] = context.get('profile_attempts', 0) + 1
+        if response_dict is not None:
+            PROFILER.add(context.get('profile_operation'),
+                         throttled=(parsed_response or {}).get(
+                             'Error', {}).get('Code') in
+                         THROTTLING_ERROR_CODES,
+                         bytes_received=len(response_dict.get('body') or
+                                            b''))
+
+    def before_parameter_build(model, context, **kwargs):
+        context['profile_operation'] = get_operation_name(
+            model.service_model, model.name)
+
+    # Registered first, so that the call is timed even when another handler
+    # answers it (e.g. a Stubber)
+    session.events.register_first('before-call', before_call)
+    session.events.register('before-parameter-build', before_parameter_build)
+    session.events.register('after-call', after_call)
+    session.events.register('after-call-error', after_call_error)
+    session.events.register('request-created', request_created)
+    session.events.register('response-received', response_received)
+
+
+def call_with_backoff(limiter, func, **kwargs):
+    """Call an AWS API at the shared rate, retrying throttled calls
+    Args:
+        limiter: the AdaptiveRateLimiter shared by the workers
+        func: the client method to call
+        kwargs: the arguments of the call
+    Returns:
+    The response of the call
+    """
+    from botocore.exceptions import ClientError
+
+    client = func.__self__
+    operation = get_operation_name(
+        client.meta.service_model,
+        client.meta.method_to_api_mapping[func.__name__])
+    for attempt in range(MAX_THROTTLING_RETRIES + 1):
+        limiter.acquire()
+        try:
+            response = func(**kwargs)
+        except ClientError as e:
+            if not is_throttling_error(e) or \
+                    attempt == MAX_THROTTLING_RETRIES:
+                raise
+            limiter.throttled()
+            PROFILER.add(operation, retries=1)
+            # Full jitter, so throttled workers do not retry in lockstep
+            with PROFILER.measure('sleep.backoff'):
+                time.sleep(random.uniform(
+                    0, min(BACKOFF_MAX_SECONDS,
+                           BACKOFF_BASE_SECONDS * 2 ** attempt)))
+        else:
+            limiter.succeeded()
+            return response
+
+
 def calc_expiry_time(expiry):
     """Calculate the number of days until the reserved instance expires.
     Args:
@@ -86,30 +328,102 @@ def calc_expiry_time(expiry):
     return (expiry.replace(tzinfo=None) - datetime.datetime.utcnow()).days
 
 
-def get_clusters_info(session):
-    """Calculate the running/reserved instances in ElastiCache.
+class CacheNode(object):
+    """The fields of a cache node the collector uses, out of the much larger
+    DescribeCacheClusters and DescribeReplicationGroups dictionaries"""
+
+    __slots__ = ('key', 'cluster_id', 'node_id', 'replication_group_id',
+                 'node_type', 'availability_zone', 'role', 'shard')
+
+    def __init__(self, cluster_id, node_id, replication_group_id, node_type,
+                 availability_zone, role='', shard=''):
+        """
+        Args:
+            cluster_id, node_id: the CacheClusterId and CacheNodeId
+            replication_group_id: the ReplicationGroupId, '' if none
+            node_type: the CacheNodeType
+            availability_zone: the PreferredAvailabilityZone
+            role: 'primary', 'replica' or '' when unknown
+            shard: the NodeGroupId of the node within its replication group
+        """
+        self.key = get_key(cluster_id, node_id)
+        self.cluster_id = cluster_id
+        self.node_id = node_id
+        self.replication_group_id = replication_group_id
+        self.node_type = node_type
+        self.availability_zone = availability_zone
+        self.role = role
+        self.shard = shard
+
+    def get_shard_key(self):
+        """The key of the shard of the node, a standalone cluster being a
+        shard of its own"""
+        return (self.replication_group_id or self.cluster_id, self.shard)
+
+
+def iter_cache_nodes(conn):
+    """Iterate over the nodes of the available Redis clusters, a page of
+    clusters at a time, so the nodes of the first pages can be collected
+    while the next ones are listed.
     Args:
-        session (:boto3:session.Session): The authenticated boto3 session.
+        conn: the ElastiCache client
     Returns:
-        A dictionary of the running/reserved instances for ElastiCache nodes.
+        A generator of CacheNode
     """
-    conn = session.client('elasticache')
-    results = {
-        'elc_running_instances': {},
-        'elc_reserved_instances': {},
-    }
-
     paginator = conn.get_paginator('describe_cache_clusters')
     page_iterator = paginator.paginate(ShowCacheNodeInfo=True)
-    # Loop through running ElastiCache instance and record their engine,
-    # type, and name.
     for page in page_iterator:
         for instance in page['CacheClusters']:
             if (instance['CacheClusterStatus'] == 'available' and
                instance['Engine'] == 'redis'):
-                cluster_id = instance['CacheClusterId']
-                results['elc_running_instances'][cluster_id] = instance
+                for node in instance.get('CacheNodes', []):
+                    yield CacheNode(
+                        instance['CacheClusterId'], node['CacheNodeId'],
+                        instance.get('ReplicationGroupId', ''),
+                        instance['CacheNodeType'],
+                        instance['PreferredAvailabilityZone'])
+
+
+def iter_topology_nodes(conn):
+    """Iterate over the nodes of the available Redis replication groups,
+    tagged with their role and shard, the nodes of a group in a row, and
+    then over those of the standalone clusters. The role of the members of
+    cluster mode enabled groups isn't returned by the API, and is left
+    unknown.
+    Args:
+        conn: the ElastiCache client
+    Returns:
+        A generator of CacheNode
+    """
+    paginator = conn.get_paginator('describe_replication_groups')
+    for page in paginator.paginate():
+        for group in page['ReplicationGroups']:
+            if group['Status'] != 'available' or \
+                    group.get('Engine', 'redis') != 'redis':
+                continue
+            for node_group in group['NodeGroups']:
+                for member in node_group['NodeGroupMembers']:
+                    yield CacheNode(
+                        member['CacheClusterId'], member['CacheNodeId'],
+                        group['ReplicationGroupId'], group['CacheNodeType'],
+                        member.get('PreferredAvailabilityZone', ''),
+                        member.get('CurrentRole', ''),
+                        node_group['NodeGroupId'])
+    for node in iter_cache_nodes(conn):
+        if not node.replication_group_id:
+            node.role = 'primary'
+            yield node
 
+
+def get_reserved_nodes(conn):
+    """Sum up the active Redis reserved nodes by node type.
+    Args:
+        conn: the ElastiCache client
+    Returns:
+        A dictionary of node type to its total reserved 'count' and the
+        'expiry_time' (in days) of the reservation that expires first
+    """
+    reserved = {}
     paginator = conn.get_paginator('describe_reserved_cache_nodes')
     page_iterator = paginator.paginate()
 
@@ -121,155 +435,683 @@ def get_clusters_info(session):
                 instance_type = reserved_instance['CacheNodeType']
                 # No end datetime is returned, so calculate from 'StartTime'
                 # (a `DateTime`) and 'Duration' in seconds (integer)
-                expiry_time = reserved_instance[
-                    'StartTime'] + datetime.timedelta(
-                    seconds=reserved_instance['Duration'])
-                results['elc_reserved_instances'][instance_type] = {
-                    'count': reserved_instance['CacheNodeCount'],
-                    'expiry_time': calc_expiry_time(expiry=expiry_time)
-                }
+                expiry_time = calc_expiry_time(
+                    expiry=reserved_instance['StartTime'] +
+                    datetime.timedelta(seconds=reserved_instance['Duration']))
+                # Several reservations of the same type add up
+                totals = reserved.setdefault(
+                    instance_type, {'count': 0, 'expiry_time': expiry_time})
+                totals['count'] += reserved_instance['CacheNodeCount']
+                totals['expiry_time'] = min(totals['expiry_time'],
+                                            expiry_time)
 
-    return results
+    return reserved
 
 
-def get_metric(cloud_watch, cluster_id, node, metric, aggregation, period):
-    """Write node related metrics to file
+def prefetch(iterable, size):
+    """Iterate over an iterable on a background thread, at most size items
+    ahead of the consumer, e.g. to list resources while the ones already
+    listed are processed.
     Args:
-        ClusterId, node and metric to write
+        iterable: the iterable, whose exceptions are raised to the consumer
+        size: the most items buffered
     Returns:
-    The metric value
+        A generator of the items
+    """
+    items = queue.Queue(size)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        # Give up once the consumer is gone, rather than block forever
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            (item, error) = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def iter_chunks(iterable, size):
+    """Split an iterable into lists of up to size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_group_chunks(nodes, size):
+    """Split a stream of nodes into lists of about size nodes, without
+    splitting the nodes of a replication group listed in a row"""
+    chunk = []
+    for _, group in itertools.groupby(
+            nodes, key=lambda node: node.replication_group_id or
+            node.cluster_id):
+        group = list(group)
+        if chunk and len(chunk) + len(group) > size:
+            yield chunk
+            chunk = []
+        chunk.extend(group)
+    if chunk:
+        yield chunk
+
+
+def get_metric_query(query_id, cluster_id, node, metric, aggregation,
+                     period):
+    """Build a single GetMetricData query for a node metric
+    Args:
+        query_id: the id the results are reported back under
+        cluster_id, node: the cache cluster and cache node ids
+        metric, aggregation, period: the metric to query
+    Returns:
+    The MetricDataQuery dictionary
+    """
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/ElastiCache',
+                'MetricName': metric,
+                'Dimensions': [
+                    {'Name': 'CacheClusterId', 'Value': cluster_id},
+                    {'Name': 'CacheNodeId', 'Value': node}
+                ]
+            },
+            'Period': period,
+            'Stat': aggregation
+        },
+        'ReturnData': True
+    }
+
+
+def get_metric_window():
+    """Get the collection window: the METRIC_COLLECTION_PERIOD_DAYS days up
+    to the end of today
+    Returns:
+    The (start, end) epoch seconds of the window
     """
     today = datetime.date.today() + datetime.timedelta(days=1)
     then = today - datetime.timedelta(days=METRIC_COLLECTION_PERIOD_DAYS)
-    response = cloud_watch.get_metric_statistics(
-        Namespace='AWS/ElastiCache',
-        MetricName=metric,
-        Dimensions=[
-            {'Name': 'CacheClusterId', 'Value': cluster_id},
-            {'Name': 'CacheNodeId', 'Value': node}
-        ],
-        StartTime=then.isoformat(),
-        EndTime=today.isoformat(),
-        Period=period,
-        Statistics=[aggregation]
-    )
-
-    raw_data = [rec[aggregation] for rec in response['Datapoints']]
-    return raw_data
-
-
-def create_data_frame():
-    """Create an empty dataframe with headers
+    return (to_timestamp(datetime.datetime.combine(then, datetime.time())),
+            to_timestamp(datetime.datetime.combine(today, datetime.time())))
+
+
+def get_cached_period(aggregation, period):
+    """Get the period a metric is fetched at when it is cached: the Maximum
+    over the whole window is the maximum of its daily Maximums, which can be
+    fetched a day at a time
+    """
+    if aggregation == 'Maximum' and period > SECONDS_IN_DAY:
+        return SECONDS_IN_DAY
+    return period
+
+
+def get_metric_data_batch(cloud_watch, limiter, queries, start, end):
+    """Fetch the datapoints of up to MAX_QUERIES_PER_REQUEST queries
+    Args:
+        cloud_watch: the CloudWatch client
+        limiter: the AdaptiveRateLimiter shared by the workers
+        queries: the MetricDataQuery dictionaries to fetch
+        start, end: the epoch seconds of the range to fetch
+    Returns:
+    A dictionary of query id to the list of returned (timestamp, value)
+    datapoints
+    """
+    results = {query['Id']: [] for query in queries}
+    kwargs = {
+        'MetricDataQueries': queries,
+        'StartTime': datetime.datetime.fromtimestamp(
+            start, datetime.timezone.utc),
+        'EndTime': datetime.datetime.fromtimestamp(
+            end, datetime.timezone.utc),
+    }
+    # A single batch may be split over several pages when it holds
+    # more datapoints than one response can carry.
+    while True:
+        response = call_with_backoff(
+            limiter, cloud_watch.get_metric_data, **kwargs)
+        for result in response['MetricDataResults']:
+            results[result['Id']].extend(
+                zip(map(to_timestamp, result['Timestamps']),
+                    result['Values']))
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+    return results
+
+
+def get_metric_data(fetcher, queries, start, end):
+    """Fetch the datapoints of many metric queries with GetMetricData
+    Args:
+        fetcher: the CloudWatchFetcher of the account/region
+        queries: the MetricDataQuery dictionaries to fetch, in any number
+        start, end: the epoch seconds of the range to fetch
+    Returns:
+    A dictionary of query id to the list of returned (timestamp, value)
+    datapoints
+    """
+    def fetch(batch):
+        return get_metric_data_batch(
+            fetcher.get_client(), fetcher.limiter, batch, start, end)
+
+    batches = [queries[start:start + MAX_QUERIES_PER_REQUEST]
+               for start in range(0, len(queries), MAX_QUERIES_PER_REQUEST)]
+    results = {}
+    for batch_results in fetcher.map(fetch, batches):
+        results.update(batch_results)
+
+    return results
+
+
+def get_cached_metric_data(fetcher, queries, keys, cache):
+    """Fetch the datapoints of the collection window through the metrics
+    cache: only the ranges which aren't cached yet are fetched, grouped by
+    range so that they still share GetMetricData calls
+    Args:
+        fetcher: the CloudWatchFetcher of the account/region
+        queries: the MetricDataQuery dictionaries to fetch
+        keys: the cache keys of the queries, in the same order
+        cache: the MetricsCache, or None to fetch the whole window
+    Returns:
+    A dictionary of query id to the list of datapoint values
+    """
+    (start, end) = get_metric_window()
+    if cache is None:
+        metric_data = get_metric_data(fetcher, queries, start, end)
+        return {query_id: [value for (_, value) in data_points]
+                for query_id, data_points in metric_data.items()}
+
+    missing_ranges = cache.get_missing_ranges(
+        keys, start, end,
+        [query['MetricStat']['Period'] for query in queries])
+    groups = {}
+    for query, key in zip(queries, keys):
+        if missing_ranges[key] is not None:
+            groups.setdefault(missing_ranges[key], []).append((query, key))
+    for (fetch_start, fetch_end), group in groups.items():
+        metric_data = get_metric_data(
+            fetcher, [query for (query, _) in group], fetch_start, fetch_end)
+        cache.put([(key, fetch_start, fetch_end,
+                    query['MetricStat']['Period'], metric_data[query['Id']])
+                   for (query, key) in group])
+
+    cached = cache.get(keys, start, end)
+    return {query['Id']: [value for (_, value) in cached[key]]
+            for query, key in zip(queries, keys)}
+
+
+def get_result_columns(resolution=None, topology=False):
+    """Get the columns of the node rows
     Args:
+        resolution: the period of the command metrics, one of RESOLUTIONS,
+            or None for hourly averages
+        topology: add the role and shard of the nodes
     Returns:
-    The newely created pandas dataframe
+    The (column names, dtypes) pair
     """
     df_columns = ["ClusterId", "NodeId", "NodeType", "Region"]
+    dtypes = {}
     for metric, _, _ in get_max_metrics():
         df_columns.append(('%s (max over last week)' % metric))
+        dtypes[df_columns[-1]] = 'float'
     for metric, _, _ in get_avg_metrics():
-        df_columns.append(('%s (peak last week / hour)' % metric))
-    df = pd.DataFrame(columns=df_columns)
-    return df
+        if resolution is None:
+            df_columns.append(('%s (peak last week / hour)' % metric))
+            dtypes[df_columns[-1]] = 'float'
+            continue
+        for stat in ('peak', 'p99', 'p95'):
+            df_columns.append('%s (%s last week / %s)' % (
+                metric, stat, RESOLUTIONS[resolution]))
+            dtypes[df_columns[-1]] = 'float'
+    if topology:
+        df_columns += ["Role", "Shard"]
+    return (df_columns, dtypes)
 
 
-def get_cluster_metrics(df, clusters_info, session):
+def get_shard_columns(resolution=None):
+    """Get the columns of the shard rollup rows
+    Returns:
+    The (column names, dtypes) pair
     """
-    Get all the metrics for the clusters in the given set of clusters
+    (node_columns, dtypes) = get_result_columns(resolution)
+    return (["ClusterId", "Shard", "Nodes", "Primary", "NodeType"] +
+            node_columns[4:], dtypes)
+
+
+def get_metric_source(node, metric):
+    """How a max metric of a node is known
+    Returns:
+    None when it is queried, 'primary' when it is copied from the primary
+    of the shard, and 0 when the node doesn't report it
+    """
+    if node.role == 'replica' and metric in SHARD_METRICS:
+        return 'primary'
+    if node.role and ROLE_METRICS.get(metric, node.role) != node.role:
+        return 0
+    return None
+
+
+def get_shard_rows(nodes, rows, resolution=None):
+    """Roll up the rows of the nodes of every shard: the shard metrics are
+    those of the primary, the others the sum of those of the nodes (an
+    upper bound of the shard's peaks, which may not coincide), or their
+    maximum for MAX_ROLLUP_METRICS
     Args:
-        The cluster information dictionary
+        nodes: the CacheNode of every node, of whole shards
+        rows: the row of every node
+        resolution: the period of the command metrics
     Returns:
+    The list of shard rows
     """
-    cloud_watch = session.client('cloudwatch')
-    row = []
-    i = 0
-
-    running_instances = clusters_info['elc_running_instances']
-    for instanceId, instanceDetails in running_instances.items():
-        for node in instanceDetails.get('CacheNodes'):
-            print(
-                "Getting node % s details" %
-                (instanceDetails['CacheClusterId']))
-            if 'ReplicationGroupId' in instanceDetails:
-                row.append("%s" % instanceDetails['ReplicationGroupId'])
+    (columns, _) = get_result_columns(resolution)
+    shards = {}
+    for node, row in zip(nodes, rows):
+        shards.setdefault(node.get_shard_key(), []).append((node, row))
+    shard_rows = []
+    for (cluster_id, shard), members in shards.items():
+        primaries = [node.cluster_id for (node, _) in members
+                     if node.role == 'primary']
+        shard_row = [cluster_id, shard, len(members),
+                     primaries[0] if primaries else '',
+                     members[0][0].node_type]
+        for i in range(4, len(columns)):
+            values = [row[i] for (_, row) in members]
+            if columns[i].split(' (')[0] in MAX_ROLLUP_METRICS:
+                shard_row.append(max(values))
             else:
-                row.append("")
-
-            row.append("%s" % instanceId)
-            row.append("%s" % instanceDetails['CacheNodeType'])
-            row.append("%s" % instanceDetails['PreferredAvailabilityZone'])
-            for (metric, aggregation, period) in get_max_metrics():
-                data_points = get_metric(
-                    cloud_watch,
-                    instanceId,
-                    node.get('CacheNodeId'),
-                    metric,
-                    aggregation,
-                    period)
-                data_point = 0 if len(data_points) == 0 else data_points[0]
-                row.append(data_point)
-            for (metric, aggregation, period) in get_avg_metrics():
-                data_points = get_metric(
-                    cloud_watch,
-                    instanceId,
-                    node.get('CacheNodeId'),
-                    metric,
-                    aggregation,
-                    period)
-                data_point = 0 if len(data_points) == 0 else max(data_points)
-                row.append(data_point)
-            df.loc[i] = row
-            row = []
-            i += 1
-
-    df.sort_values(by=['NodeId'])
-
-
-def get_reserved_instances(clusters_info):
-    # create the dataframe
-    df_columns = ["Instance Type", "Count", "Remaining Time (days)"]
-    df = pd.DataFrame(columns=df_columns)
-
-    row = []
-    i = 0
-    reserved_instances = clusters_info['elc_reserved_instances']
-    for instanceId, instanceDetails in reserved_instances.items():
-        row.append(("%s" % instanceId))
-        row.append(("%s" % instanceDetails['count']))
-        row.append(("%s," % instanceDetails['expiry_time']))
-        df.loc[i] = row
-        i = i + 1
+                shard_row.append(sum(values))
+        shard_rows.append(shard_row)
+    return shard_rows
+
+
+def plan_metric_requests(query_count, start, end, period):
+    """Plan the GetMetricData requests of high resolution series, so that
+    every response holds at most MAX_DATAPOINTS_PER_RESPONSE datapoints: as
+    many queries per request as fit over the whole range, or a single query
+    per request over chunks of the range when one series doesn't fit
+    Args:
+        query_count: the number of queries to fetch
+        start, end: the epoch seconds of the range to fetch
+        period: the period of the queries
+    Returns:
+    The (queries per request, [(chunk start, chunk end)]) plan
+    """
+    points = max(1, -(-(end - start) // period))
+    if points <= MAX_DATAPOINTS_PER_RESPONSE:
+        return (max(1, min(MAX_QUERIES_PER_REQUEST, query_count,
+                           MAX_DATAPOINTS_PER_RESPONSE // points)),
+                [(start, end)])
+    chunk = MAX_DATAPOINTS_PER_RESPONSE * period
+    return (1, [(chunk_start, min(end, chunk_start + chunk))
+                for chunk_start in range(start, end, chunk)])
+
+
+def reduce_data_points(values):
+    """The (peak, p99, p95) of the datapoints of a series, 0 when it has
+    none"""
+    import numpy as np
+
+    if len(values) == 0:
+        return (0, 0, 0)
+    (p99, p95) = np.percentile(values, [99, 95])
+    return (float(values.max()), float(p99), float(p95))
+
+
+def get_peak_stats(fetcher, queries):
+    """Fetch high resolution series over the collection window and reduce
+    every one of them to its peak, p99 and p95. The requests follow
+    plan_metric_requests, and the series of every request are reduced as
+    soon as they are complete, so only the datapoints of the requests in
+    flight are held in memory.
+    Args:
+        fetcher: the CloudWatchFetcher of the account/region
+        queries: the MetricDataQuery dictionaries to fetch, of one period
+    Returns:
+    A dictionary of query id to the (peak, p99, p95) of its datapoints
+    """
+    import numpy as np
+
+    if not queries:
+        return {}
+    period = queries[0]['MetricStat']['Period']
+    (start, end) = get_metric_window()
+    # The window ends at midnight, there are no datapoints after now
+    end = min(end, int(time.time()) // period * period + period)
+    (batch_size, chunks) = plan_metric_requests(len(queries), start, end,
+                                                period)
+    def fetch(batch):
+        values = {query['Id']: [] for query in batch}
+        for (chunk_start, chunk_end) in chunks:
+            metric_data = get_metric_data_batch(
+                fetcher.get_client(), fetcher.limiter, batch, chunk_start,
+                chunk_end)
+            for query_id, data_points in metric_data.items():
+                values[query_id].append(np.fromiter(
+                    (value for (_, value) in data_points), float,
+                    len(data_points)))
+        return {query_id: reduce_data_points(np.concatenate(arrays))
+                for query_id, arrays in values.items()}
+
+    batches = [queries[i:i + batch_size]
+               for i in range(0, len(queries), batch_size)]
+    print("Fetching %d series at %d seconds in %d requests of %d" % (
+        len(queries), period, len(batches) * len(chunks), batch_size))
+    results = {}
+    for batch_results in fetcher.map(fetch, batches):
+        results.update(batch_results)
+    return results
+
+
+def get_node_rows(nodes, fetcher, cache=None, cache_scope='',
+                  resolution=None, topology=False):
+    """
+    Get the metrics of a set of nodes
+    Args:
+        nodes: the CacheNode of every node
+        fetcher: the CloudWatchFetcher of the account/region
+        cache: the MetricsCache of previously fetched datapoints, if any
+        cache_scope: the account/region prefix of the cache keys
+        resolution: fetch the command metrics at this period (one of
+            RESOLUTIONS) and report their peak, p99 and p95, instead of
+            their peak hourly average. They are not cached.
+        topology: the nodes are whole shards tagged with their role: only
+            query the metrics that differ by role (see get_metric_source),
+            and add the role and shard columns
+    Returns:
+    The (node key, row) pair of every node
+    """
+    queries = []
+    keys = []
+    peak_queries = []
+    node_queries = []
+    # The positions in query_ids of the metrics of every node which are
+    # copied from the primary of its shard
+    node_copied = []
+
+    # Build the queries of every node up front, so they can be packed into
+    # as few GetMetricData calls as possible. The metrics that aren't
+    # queried have a None query id.
+    for node in nodes:
+        (instanceId, nodeId) = (node.cluster_id, node.node_id)
+        query_ids = []
+        copied = []
+        for (metric, aggregation, period) in get_max_metrics():
+            source = get_metric_source(node, metric) if topology else None
+            if source is not None:
+                if source == 'primary':
+                    copied.append(len(query_ids))
+                query_ids.append(None)
+                continue
+            query_id = 'q%d' % len(queries)
+            if cache is not None:
+                period = get_cached_period(aggregation, period)
+            queries.append(get_metric_query(
+                query_id,
+                instanceId,
+                nodeId,
+                metric,
+                aggregation,
+                period))
+            keys.append(get_key(cache_scope, instanceId, nodeId, metric,
+                                aggregation, period))
+            query_ids.append(query_id)
+        for (metric, aggregation, period) in get_avg_metrics():
+            if resolution is None:
+                query_id = 'q%d' % len(queries)
+                queries.append(get_metric_query(
+                    query_id, instanceId, nodeId, metric, aggregation,
+                    period))
+                keys.append(get_key(cache_scope, instanceId, nodeId, metric,
+                                    aggregation, period))
+            else:
+                query_id = 'p%d' % len(peak_queries)
+                peak_queries.append(get_metric_query(
+                    query_id, instanceId, nodeId, metric, aggregation,
+                    resolution))
+            query_ids.append(query_id)
+        node_queries.append(query_ids)
+        node_copied.append(copied)
+
+    metric_data = get_cached_metric_data(fetcher, queries, keys, cache)
+    peak_stats = get_peak_stats(fetcher, peak_queries)
+
+    rows = []
+    primary_rows = {}
+    # The row cells of every node to copy from the primary of its shard
+    node_copied_cells = []
+    for node, query_ids, copied in zip(nodes, node_queries, node_copied):
+        print("Getting node % s details" % node.cluster_id)
         row = []
+        row.append("%s" % node.replication_group_id)
+        row.append("%s" % node.cluster_id)
+        row.append("%s" % node.node_type)
+        row.append("%s" % node.availability_zone)
+        # The max metrics have a single datapoint (or a daily one per day
+        # when cached), the avg metrics an hourly one, unless they were
+        # fetched at a higher resolution and already reduced
+        copied_cells = []
+        for i, query_id in enumerate(query_ids):
+            if query_id is None:
+                # Not reported by the node, or copied from the primary once
+                # all rows are built
+                if i in copied:
+                    copied_cells.append(len(row))
+                row.append(0)
+                continue
+            if query_id in peak_stats:
+                row.extend(peak_stats[query_id])
+                continue
+            data_points = metric_data[query_id]
+            data_point = 0 if len(data_points) == 0 else max(data_points)
+            row.append(data_point)
+        if topology:
+            row += [node.role, node.shard]
+            if node.role == 'primary':
+                primary_rows[node.get_shard_key()] = row
+        rows.append((node.key, row))
+        node_copied_cells.append(copied_cells)
 
-    return (df, i)
+    for node, (_, row), copied_cells in zip(nodes, rows, node_copied_cells):
+        primary_row = primary_rows.get(node.get_shard_key())
+        if primary_row is not None:
+            for i in copied_cells:
+                row[i] = primary_row[i]
+    return rows
 
 
-def process_aws_account(config, section, outDir):
+def get_cluster_metrics(result, nodes, fetcher, cache=None, cache_scope='',
+                        journal=None, resolution=None, shard_result=None):
+    """
+    Get all the metrics of a stream of nodes. The nodes are fetched one
+    round of concurrent requests at a time, as they come, and the rows of
+    every round are appended (and journaled) once it completes.
+    Args:
+        result: the SheetWriter the node rows are appended to, in
+            inventory order
+        nodes: an iterable of CacheNode, e.g. iter_cache_nodes
+        fetcher: the CloudWatchFetcher of the account/region, shared by
+            all the rounds
+        cache: the MetricsCache of previously fetched datapoints, if any
+        cache_scope: the account/region prefix of the cache keys
+        journal: the RunJournal the node rows are recorded in as they
+            complete, if any; the nodes it already holds are not fetched
+        resolution: the period of the command metrics, see get_node_rows
+        shard_result: in topology mode (see iter_topology_nodes), the
+            SheetWriter the shard rollup rows are appended
+            to, None otherwise
+    Returns:
+    The number of nodes
+    """
+    topology = shard_result is not None
+    chunk_size = max(1, MAX_QUERIES_PER_REQUEST * fetcher.workers //
+                     len(get_max_metrics() + get_avg_metrics()))
+    count = 0
+    # In topology mode, a chunk holds whole replication groups, so the
+    # replicas find their primary and the shards can be rolled up
+    for chunk in (iter_group_chunks if topology else iter_chunks)(
+            nodes, chunk_size):
+        pending = [node for node in chunk
+                   if journal is None or node.key not in journal]
+        rows = {}
+        if pending:
+            node_rows = get_node_rows(pending, fetcher, cache, cache_scope,
+                                      resolution, topology)
+            if journal is not None:
+                journal.record(node_rows)
+            rows.update(node_rows)
+        chunk_rows = [rows[node.key] if node.key in rows
+                      else journal.get(node.key) for node in chunk]
+        for row in chunk_rows:
+            result.append(row)
+        if topology:
+            for shard_row in get_shard_rows(chunk, chunk_rows, resolution):
+                shard_result.append(shard_row)
+        count += len(chunk)
+    print("Got the metrics of %d nodes" % count)
+    return count
+
+
+def get_reserved_instances(result, reserved_nodes):
+    """
+    Get the reserved nodes sheet
+    Args:
+        result: the SheetWriter of the RESERVED_COLUMNS the rows are
+            appended to
+        reserved_nodes: the reserved nodes by node type, see
+            get_reserved_nodes
+    Returns:
+    The number of rows
+    """
+    for instanceId, instanceDetails in reserved_nodes.items():
+        row = []
+        row.append(("%s" % instanceId))
+        row.append(instanceDetails['count'])
+        row.append(instanceDetails['expiry_time'])
+        result.append(row)
+
+    return len(reserved_nodes)
+
+
+def get_regions(config, section):
+    """Get the regions a configuration section should be collected from
+    Args:
+        config: the parsed configuration file
+        section: the section (account) name
+    Returns:
+    The list of regions: the comma separated 'regions' option when present,
+    otherwise the single 'region' option
+    """
+    if config.has_option(section, 'regions'):
+        return [region.strip()
+                for region in config.get(section, 'regions').split(',')
+                if region.strip()]
+    return [config.get(section, 'region')]
+
+
+def process_aws_account(config, section, region, outDir, workers=1,
+                        cache=None, resume=False, output_format='xlsx',
+                        resolution=None, topology=False):
+    import boto3
+
     # connect to ElastiCache
     # aws key, secret and region
-    region = config.get(section, 'region')
     access_key = config.get(section, 'aws_access_key_id')
     secret_key = config.get(section, 'aws_secret_access_key')
     session_token = config.get(section, 'aws_session_token')
     session = boto3.Session(
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-	aws_session_token=session_token,
+        aws_session_token=session_token,
         region_name=region)
+    if PROFILER.enabled:
+        profile_session(session)
+    # Created here, as boto3 sessions are not thread safe
+    conn = session.client('elasticache')
 
-    cluster_df = create_data_frame()
+    (columns, dtypes) = get_result_columns(resolution, topology)
+    base_path = "%s/%s-%s" % (outDir, section, region)
+    with OutputWriter(base_path, output_format) as writer:
+        cluster_sheet = writer.add_sheet('ClusterData', columns, dtypes,
+                                         index=True)
+        shard_sheet = None
+        if topology:
+            (shard_columns, shard_dtypes) = get_shard_columns(resolution)
+            shard_sheet = writer.add_sheet('ShardData', shard_columns,
+                                           shard_dtypes, index=True)
+        # The node rows are journaled as they complete, so a failed run can
+        # be resumed; the journal is removed once the output is written.
+        journal = RunJournal("%s.journal" % base_path, columns, resume)
+        try:
+            # The clusters are listed on a background thread while the
+            # metrics of those already listed are fetched
+            nodes = prefetch((iter_topology_nodes if topology
+                              else iter_cache_nodes)(conn), NODES_PREFETCHED)
+            with CloudWatchFetcher(session, workers) as fetcher:
+                get_cluster_metrics(cluster_sheet, nodes, fetcher, cache,
+                                    get_key('aws', section, region), journal,
+                                    resolution, shard_sheet)
+        finally:
+            journal.close()
 
-    clusters_info = get_clusters_info(session)
+        get_reserved_instances(
+            writer.add_sheet('ReservedData', RESERVED_COLUMNS,
+                             RESERVED_DTYPES, index=True),
+            get_reserved_nodes(conn))
+    journal.remove()
+    print("Wrote %s" % ", ".join(writer.paths))
 
-    get_cluster_metrics(cluster_df, clusters_info, session)
 
-    (reservedDF, _) = get_reserved_instances(clusters_info)
+def run_job(config, section, region, outDir, workers, cache=None,
+            resume=False, output_format='xlsx', resolution=None,
+            topology=False):
+    """Process a single account/region, without letting its failure stop
+    the other jobs
+    Returns:
+    A (section, region, status, elapsed seconds) tuple
+    """
+    start = time.monotonic()
+    try:
+        process_aws_account(config, section, region, outDir, workers,
+                            cache, resume, output_format, resolution,
+                            topology)
+        status = 'OK'
+    except Exception as e:
+        print("Failed processing %s (%s): %s" % (section, region, e))
+        status = 'FAILED: %s' % e
+    return (section, region, status, time.monotonic() - start)
+
 
-    output_file_path = "%s/%s-%s.xlsx" % (outDir, section, region)
-    print(f"Writing {output_file_path}")
-    with pd.ExcelWriter(output_file_path, engine='xlsxwriter') as writer:
-        cluster_df.to_excel(writer, 'ClusterData')
-        reservedDF.to_excel(writer, 'ReservedData')
+def print_job_summary(job_results):
+    print("%-30s %-16s %10s  %s" % ("Section", "Region", "Seconds", "Status"))
+    for (section, region, status, elapsed) in sorted(
+            job_results, key=lambda result: result[3], reverse=True):
+        print("%-30s %-16s %10.1f  %s" % (section, region, elapsed, status))
 
 
 def main():
@@ -278,20 +1120,108 @@ def main():
                       help="Location of configuration file", metavar="FILE")
     parser.add_option("-d", "--out-dir", dest="outDir", default=".",
                       help="directory to write the results in", metavar="PATH")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=1,
+                      help="number of concurrent CloudWatch requests",
+                      metavar="N")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of account/region sections processed "
+                      "concurrently", metavar="N")
+    parser.add_option("--cache", dest="cacheFile",
+                      help="SQLite file caching the fetched datapoints "
+                      "between runs, so that only new ones are fetched",
+                      metavar="FILE")
+    parser.add_option("--cache-ttl-days", dest="cacheTtlDays", type="int",
+                      default=DEFAULT_TTL_DAYS,
+                      help="days cached datapoints are kept for "
+                      "[default: %default]", metavar="DAYS")
+    parser.add_option("--cache-max-mb", dest="cacheMaxMb", type="int",
+                      default=DEFAULT_MAX_SIZE_MB,
+                      help="size the cache is trimmed down to "
+                      "[default: %default]", metavar="MB")
+    parser.add_option("--cache-max-age", dest="cacheMaxAge", type="int",
+                      default=0,
+                      help="minutes within which a cached series is not "
+                      "refreshed, even if a period has completed since "
+                      "[default: %default, refreshed once a period "
+                      "completes]", metavar="MINUTES")
+    parser.add_option("--resume", dest="resume", action="store_true",
+                      default=False,
+                      help="skip the nodes already collected by a failed "
+                      "run, as recorded in its <section>-<region>.journal "
+                      "files in the output directory")
+    parser.add_option("-f", "--format", dest="format", type="choice",
+                      choices=FORMATS, default=FORMATS[0],
+                      help="output format, one of %s: xlsx writes a "
+                      "<section>-<region>.xlsx workbook, the others a "
+                      "<section>-<region>-<sheet>.<format> file per sheet "
+                      "[default: %%default]" % ", ".join(FORMATS),
+                      metavar="FORMAT")
+    parser.add_option("--resolution", dest="resolution", type="choice",
+                      choices=[str(period) for period in RESOLUTIONS],
+                      help="fetch the command metrics at a %s second "
+                      "period and report their peak, p99 and p95 over the "
+                      "week, instead of their peak hourly average; these "
+                      "series are not cached" % " or ".join(
+                          str(period) for period in RESOLUTIONS),
+                      metavar="SECONDS")
+    parser.add_option("--topology", dest="topology", action="store_true",
+                      default=False,
+                      help="list the nodes by replication group with their "
+                      "role and shard, skip the metrics replicas only "
+                      "repeat, and add a ShardData sheet of per shard "
+                      "rollups")
+    parser.add_option("--profile", dest="profile", action="store_true",
+                      default=False,
+                      help="record the calls, latency, throttling and bytes "
+                      "of every API operation and print a summary at exit")
+    parser.add_option("--profile-output", dest="profileOutput",
+                      help="also write the profile to FILE, as JSON if its "
+                      "name ends with .json and as OpenMetrics text "
+                      "otherwise (implies --profile)", metavar="FILE")
 
     (options, _) = parser.parse_args()
-    if options.configFile is None:
+    if options.configFile is None or options.workers < 1 or \
+            options.jobs < 1:
         parser.print_help()
         sys.exit(1)
 
+    if options.profile or options.profileOutput is not None:
+        PROFILER.enable(options.profileOutput)
+
     config = ConfigParser()
     config.read(options.configFile)
 
     if not os.path.isdir(options.outDir):
         os.makedirs(options.outDir)
 
-    for section in config.sections():
-        process_aws_account(config, section, options.outDir)
+    cache = None
+    if options.cacheFile is not None:
+        cache = MetricsCache(options.cacheFile, options.cacheTtlDays,
+                             options.cacheMaxMb,
+                             options.cacheMaxAge * SECONDS_IN_MINUTE)
+
+    resolution = None if options.resolution is None \
+        else int(options.resolution)
+    jobs = [(section, region)
+            for section in config.sections()
+            for region in get_regions(config, section)]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=options.jobs) as executor:
+        futures = [executor.submit(run_job, config, section, region,
+                                   options.outDir, options.workers, cache,
+                                   options.resume, options.format,
+                                   resolution, options.topology)
+                   for (section, region) in jobs]
+        job_results = [future.result() for future in futures]
+
+    print_job_summary(job_results)
+    if cache is not None:
+        cache.evict()
+        cache.print_summary()
+        cache.close()
+    if any(status != 'OK' for (_, _, status, _) in job_results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
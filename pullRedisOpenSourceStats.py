@@ -1,11 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import collections
 import concurrent.futures
+import functools
+import json
+import math
+import os
+import signal
+import threading
 import time
 
-import pandas as pd
-import redis
+# redis, NumPy, openpyxl and asyncio are imported where they are used, so
+# that --help and the argument checks don't pay for loading them.
+
+from apiProfiler import PROFILER, format_metric_family
+from inputReaders import INPUT_FORMATS, InputError, get_input_format, \
+    read_endpoints
+from keyspaceProfiler import DEFAULT_BATCH_SIZE, DEFAULT_KEYS_PER_SECOND, \
+    DEFAULT_MAX_KEYS, DEFAULT_TOP_KEYS, get_big_key_columns, \
+    get_type_columns, profile_node
+from outputWriters import FORMATS, OutputWriter
+from ringBuffer import RingBuffer
+from runJournal import RunJournal
 
 debug_flag = False
 
@@ -16,69 +33,193 @@ def debug(msg):
         print(msg)
 
 
+# The INFO fields a snapshot keeps, besides the keyspace 'db<N>' lines
+INFO_FIELDS = frozenset([
+    b'cluster_enabled',
+    b'connected_clients',
+    b'connected_slaves',
+    b'total_commands_processed',
+    b'used_memory_peak'])
+
+
+def native_bytes(x):
+    return x if isinstance(x, bytes) else x.encode('utf-8')
+
+
 def get_value(value):
-    if ',' not in value or '=' not in value:
+    try:
+        return int(value)
+    except ValueError:
         try:
-            if '.' in value:
-                return float(value)
-            else:
-                return int(value)
+            return float(value)
         except ValueError:
-            return value
-    else:
-        sub_dict = {}
-        for item in value.split(','):
-            k, v = item.rsplit('=', 1)
-            sub_dict[k] = get_value(v)
-        return sub_dict
+            return value.decode('utf-8', 'replace')
 
 
-def native_str(x):
-    return x if isinstance(x, str) else x.decode('utf-8', 'replace')
+def parse_commandstats(response):
+    """
+        Parse the number of calls of every command out of the raw reply of
+        INFO COMMANDSTATS, without splitting the other fields of a line.
+        Args:
+            response: the response from the info commandstats command
+        Returns:
+            a dictionary of command name to number of calls
+    """
+    calls = {}
+    for line in native_bytes(response).split(b'\r\n'):
+        if not line.startswith(b'cmdstat_'):
+            continue
+        # The 'host:' pseudo-command is the only case where the command
+        # contains ':', so look for the last ':calls='
+        start = line.rfind(b':calls=')
+        if start == -1:
+            continue
+        end = line.find(b',', start)
+        if end == -1:
+            end = len(line)
+        calls[line[8:start].decode('utf-8', 'replace')] = \
+            int(line[start + 7:end])
+    return calls
 
 
-def parse_response(response):
+def parse_info(response, fields=INFO_FIELDS):
     """
-        Parse the result of Redis's INFO command into a Python dict
+        Parse the requested fields and the keyspace out of the raw reply of
+        INFO
         Args:
             response: the response from the info command
+            fields: the (bytes) names of the fields to parse
         Returns:
-            command stats output
-    """
-    res = {}
-    response = native_str(response)
-
-    for line in response.splitlines():
-        if line and not line.startswith('#'):
-            if line.find(':') != -1:
-                # Split, the info fields keys and values.
-                # Note that the value may contain ':'. but the 'host:'
-                # pseudo-command is the only case where the key contains ':'
-                key, value = line.split(':', 1)
-                if key == 'cmdstat_host':
-                    key, value = line.rsplit(':', 1)
-                res[key] = get_value(value)
-            else:
-                # if the line isn't splittable, append it to the "__raw__" key
-                res.setdefault('__raw__', []).append(line)
+            a dictionary of the fields, with the keyspace as
+            'db<N>': {'keys': <count>}
+    """
+    info = {}
+    for line in native_bytes(response).split(b'\r\n'):
+        key, separator, value = line.partition(b':')
+        if not separator:
+            continue
+        if key in fields:
+            info[key.decode()] = get_value(value)
+        elif key.startswith(b'db') and key[2:].isdigit() and \
+                value.startswith(b'keys='):
+            end = value.find(b',')
+            info[key.decode()] = {
+                'keys': int(value[5:end if end != -1 else len(value)])}
+    return info
+
+
+# The command categories, as (metric, commands) pairs, in output order.
+# Commands that are not listed are counted under OTHER_CMDS_METRIC.
+COMMAND_CATEGORIES = [
+    ('HashBasedCmds', [
+        'hdel', 'hexists', 'hget', 'hgetall', 'hincrby', 'hincrbyfloat',
+        'hkeys', 'hlen', 'hmget', 'hmset', 'hrandfield', 'hscan', 'hset',
+        'hsetnx', 'hstrlen', 'hvals']),
+    ('HyperLogLogBasedCmds', [
+        'pfadd', 'pfcount', 'pfmerge']),
+    ('KeyBasedCmds', [
+        'copy', 'del', 'dump', 'exists', 'expire', 'expireat',
+        'expiretime', 'keys', 'move', 'object', 'persist', 'pexpire',
+        'pexpireat', 'pexpiretime', 'pttl', 'randomkey', 'rename',
+        'renamenx', 'restore', 'scan', 'sort', 'sort_ro', 'touch', 'ttl',
+        'type', 'unlink']),
+    ('ListBasedCmds', [
+        'blmove', 'blmpop', 'blpop', 'brpop', 'brpoplpush', 'lindex',
+        'linsert', 'llen', 'lmove', 'lmpop', 'lpop', 'lpos', 'lpush',
+        'lpushx', 'lrange', 'lrem', 'lset', 'ltrim', 'rpop', 'rpoplpush',
+        'rpush', 'rpushx']),
+    ('SetBasedCmds', [
+        'sadd', 'scard', 'sdiff', 'sdiffstore', 'sinter', 'sintercard',
+        'sinterstore', 'sismember', 'smembers', 'smismember', 'smove',
+        'spop', 'srandmember', 'srem', 'sscan', 'sunion', 'sunionstore']),
+    ('SortedSetBasedCmds', [
+        'bzmpop', 'bzpopmax', 'bzpopmin', 'zadd', 'zcard', 'zcount',
+        'zdiff', 'zdiffstore', 'zincrby', 'zinter', 'zintercard',
+        'zinterstore', 'zlexcount', 'zmpop', 'zmscore', 'zpopmax',
+        'zpopmin', 'zrandmember', 'zrange', 'zrangebylex', 'zrangebyscore',
+        'zrangestore', 'zrank', 'zrem', 'zremrangebylex', 'zremrangebyrank',
+        'zremrangebyscore', 'zrevrange', 'zrevrangebylex',
+        'zrevrangebyscore', 'zrevrank', 'zscan', 'zscore', 'zunion',
+        'zunionstore']),
+    ('StringBasedCmds', [
+        'append', 'decr', 'decrby', 'get', 'getdel', 'getex', 'getrange',
+        'getset', 'incr', 'incrby', 'incrbyfloat', 'lcs', 'mget', 'mset',
+        'msetnx', 'psetex', 'set', 'setex', 'setnx', 'setrange', 'strlen',
+        'substr']),
+    ('StreamBasedCmds', [
+        'xack', 'xadd', 'xautoclaim', 'xclaim', 'xdel', 'xgroup', 'xinfo',
+        'xlen', 'xpending', 'xrange', 'xread', 'xreadgroup', 'xrevrange',
+        'xsetid', 'xtrim'])]
+
+OTHER_CMDS_METRIC = 'OtherCmds'
+
+
+def build_command_index(categories):
+    """
+        Build the command name to category position index
+        Args:
+            categories: the (metric, commands) pairs
+        Returns:
+            a dictionary of command name to the position of its category
+    """
+    return {command: position
+            for position, (_, commands) in enumerate(categories)
+            for command in commands}
+
+
+# Built once, so every commandstats reply is bucketed in a single pass
+COMMAND_INDEX = build_command_index(COMMAND_CATEGORIES)
+
+
+def load_command_categories(path):
+    """
+        Extend the command categories from a JSON file of the form
+        {"<metric>": ["<command>", ...]}. Commands of an existing metric are
+        added to it, and new metrics are appended as new categories.
+        Args:
+            path: the JSON file path
+        Returns:
+            None
+    """
+    global COMMAND_INDEX
+
+    with open(path) as f:
+        extra = json.load(f)
+    positions = {metric: position
+                 for position, (metric, _) in enumerate(COMMAND_CATEGORIES)}
+    for metric, commands in extra.items():
+        if metric not in positions:
+            positions[metric] = len(COMMAND_CATEGORIES)
+            COMMAND_CATEGORIES.append((metric, []))
+        for command in commands:
+            command = command.lower()
+            # A command listed in the file moves to the category it is
+            # listed under
+            for _, listed in COMMAND_CATEGORIES:
+                if command in listed:
+                    listed.remove(command)
+            COMMAND_CATEGORIES[positions[metric]][1].append(command)
+    COMMAND_INDEX = build_command_index(COMMAND_CATEGORIES)
 
-    return res
+
+def get_command_categories():
+    return COMMAND_CATEGORIES
 
 
 def get_cmd_metrics():
-    metrics = [
-        'HashBasedCmds',
-        'HyperLogLogBasedCmds',
-        'KeyBasedCmds',
-        'ListBasedCmds',
-        'SetBasedCmds',
-        'SortedSetBasedCmds',
-        'StringBasedCmds',
-        'StreamBasedCmds',
-        'TotalOps']
+    metrics = [metric for metric, _ in get_command_categories()]
+    metrics.append(OTHER_CMDS_METRIC)
+    metrics.append('TotalOps')
     return metrics
 
 
+def get_rate_stats():
+    return ['avg', 'max', 'p95', 'p99']
+
+
+SECONDS_IN_HOUR = 3600
+
+
 def get_metrics():
     metrics = [
         'CurrItems',
@@ -91,78 +232,347 @@ def get_metrics():
     return metrics
 
 
-def create_data_frame():
-    """Create an empty dataframe with headers
+def get_result_columns(rate_stats=False, peak_hour=False):
+    """Get the columns of the node results
     Args:
+        rate_stats: add the per interval ops/sec statistics columns
+        peak_hour: add the peak hourly average ops/sec columns
     Returns:
-    The newely created pandas dataframe
+    The (column names, dtypes) pair
     """
     df_columns = ["DB Name", "Node Type"]
     for metric in get_metrics():
         df_columns.append(('%s' % metric))
     for metric in get_cmd_metrics():
         df_columns.append(('%s' % metric))
-    df = pd.DataFrame(columns=df_columns)
-    return df
+    df_columns.append('Source')
+    dtypes = {metric: 'int' for metric in get_cmd_metrics()}
+    if rate_stats:
+        for metric in get_cmd_metrics():
+            for stat in get_rate_stats():
+                df_columns.append('%s (%s ops/sec)' % (metric, stat))
+                dtypes[df_columns[-1]] = 'float'
+    if peak_hour:
+        for metric in get_cmd_metrics():
+            df_columns.append('%s (peak hour avg ops/sec)' % metric)
+            dtypes[df_columns[-1]] = 'float'
+    return (df_columns, dtypes)
 
 
-def get_command_by_args(cmds1, cmds2, *args):
-    count = 0
-    for cmd in args:
-        command = 'cmdstat_%s' % cmd
-        try:
-            count += cmds2[command]['calls'] - cmds1[command]['calls']
-        except KeyError:
-            pass
-    return count
+def get_keyspace(info):
+    """
+        Get the number of keys of every logical database of a node
+        Args:
+            info: the parsed INFO reply of the node
+        Returns:
+            a dictionary of database index to number of keys
+    """
+    return {int(field[2:]): value['keys'] for field, value in info.items()
+            if field.startswith('db') and field[2:].isdigit()}
 
 
-def is_ssl(row):
-    return not pd.isnull(row['TLS'])
+def get_counters(snapshot):
+    """
+        Get the cumulative call counters of a snapshot
+        Args:
+            snapshot: a snapshot taken by take_snapshot
+        Returns:
+            the counter of every get_cmd_metrics() metric, in order
+    """
+    (res, info, _) = snapshot
+    other = len(COMMAND_CATEGORIES)
+    counters = [0] * (other + 2)
+    for command, calls in res.items():
+        position = COMMAND_INDEX.get(command)
+        if position is None:
+            # Subcommands (e.g. 'config|get') fall back to their command
+            position = COMMAND_INDEX.get(command.split('|', 1)[0], other)
+        counters[position] += calls
+    counters[-1] = info['total_commands_processed']
+    return counters
+
+
+class NodeSampling(object):
+    """The samples taken from a single node.
+
+    Only the cumulative counters and the timestamp of every snapshot are
+    kept, in preallocated arrays, along with the latest INFO reply.
+    """
+
+    __slots__ = ('client', 'counters', 'timestamps', 'count', 'info')
+
+    def __init__(self, client, snapshot_count):
+        self.client = client
+        import numpy as np
+
+        self.counters = np.zeros(
+            (snapshot_count, len(get_cmd_metrics())), dtype=np.int64)
+        self.timestamps = np.zeros(snapshot_count)
+        self.count = 0
+        self.info = None
 
+    def add(self, snapshot):
+        self.counters[self.count] = get_counters(snapshot)
+        self.timestamps[self.count] = snapshot[2]
+        self.count += 1
+        self.info = snapshot[1]
 
-def process_node(row, node, is_master_shard, duration):
+    def get_window(self):
+        """The (counters, timestamps) arrays of the snapshots taken"""
+        return (self.counters[:self.count], self.timestamps[:self.count])
+
+
+class NodeHistory(object):
+    """The samples of a node sampled continuously, in bounded memory.
+
+    The cumulative counters and timestamps of the last history snapshots
+    are kept in ring buffers, so get_node_result computes the rate
+    statistics over them like over a NodeSampling. The average ops/sec of
+    every hour is kept in another ring buffer, for the peak hour over the
+    last peak_hours hours.
     """
-        Get the current command stats of the passed node
+
+    __slots__ = ('client', 'counters', 'timestamps', 'hours', 'hour',
+                 'hour_ops', 'hour_seconds', 'info')
+
+    def __init__(self, client, history, peak_hours):
+        import numpy as np
+
+        metrics = len(get_cmd_metrics())
+        self.client = client
+        self.counters = RingBuffer(history, (metrics,), np.int64)
+        self.timestamps = RingBuffer(history)
+        self.hours = RingBuffer(peak_hours, (metrics,))
+        self.hour = None
+        self.hour_ops = np.zeros(metrics)
+        self.hour_seconds = 0.0
+        self.info = None
+
+    @property
+    def count(self):
+        return len(self.counters)
+
+    @property
+    def nbytes(self):
+        return self.counters.nbytes + self.timestamps.nbytes + \
+            self.hours.nbytes
+
+    def add(self, snapshot, now=None):
+        """
+            Add a snapshot
+            Args:
+                snapshot: a snapshot taken by take_snapshot
+                now: the wall clock time of the snapshot, for the hourly
+                    averages (default: the current time)
+        """
+        import numpy as np
+
+        counters = np.array(get_counters(snapshot), dtype=np.int64)
+        if self.count:
+            previous = self.counters.last()[0]
+            if (counters < previous).any():
+                # The node restarted, and its counters with it: the rates
+                # are computed from the snapshots taken since
+                self.counters.clear()
+                self.timestamps.clear()
+            else:
+                self._add_to_hour(
+                    counters - previous,
+                    snapshot[2] - self.timestamps.last()[0],
+                    time.time() if now is None else now)
+        self.counters.append(counters)
+        self.timestamps.append(snapshot[2])
+        self.info = snapshot[1]
+
+    def _add_to_hour(self, ops, seconds, now):
+        hour = int(now // SECONDS_IN_HOUR)
+        if hour != self.hour:
+            if self.hour_seconds > 0:
+                self.hours.append(self.hour_ops / self.hour_seconds)
+            self.hour = hour
+            self.hour_ops[:] = 0
+            self.hour_seconds = 0.0
+        self.hour_ops += ops
+        self.hour_seconds += seconds
+
+    def get_window(self):
+        """The (counters, timestamps) arrays of the snapshots kept"""
+        return (self.counters.values(), self.timestamps.values())
+
+    def get_rates(self):
+        """The ops/sec of every metric over every interval kept"""
+        import numpy as np
+
+        (counters, timestamps) = self.get_window()
+        return np.diff(counters, axis=0) / np.diff(timestamps)[:, np.newaxis]
+
+    def get_current_rates(self):
+        """The ops/sec of every metric over the last interval, or None"""
+        if self.count < 2:
+            return None
+        counters = self.counters.last(2)
+        timestamps = self.timestamps.last(2)
+        return (counters[1] - counters[0]) / (timestamps[1] - timestamps[0])
+
+    def get_peak_rates(self):
+        """The max ops/sec of every metric over the intervals kept, or
+        None"""
+        if self.count < 2:
+            return None
+        return self.get_rates().max(axis=0)
+
+    def get_peak_hour_rates(self):
+        """The highest hourly average ops/sec of every metric over the
+        hours kept, or None before the first hour is over"""
+        if not len(self.hours):
+            return None
+        return self.hours.values().max(axis=0)
+
+
+def get_auth_kwargs(row):
+    """The password and ACL user arguments of the DB of an input row"""
+    if row.password is None:
+        return {}
+    if row.user is None:
+        return {'password': row.password}
+    return {'password': row.password, 'username': row.user}
+
+
+def get_client(row, host, port, client_class=None, **kwargs):
+    """
+        Create a client for a node of the DB described by an input row
+        Args:
+            row: the inputReaders.Endpoint of a row from the input file
+            host, port: the node to connect to
+            client_class: redis.Redis (the default) or redis.asyncio.Redis
+            kwargs: additional client arguments
+        Returns:
+            the client
+    """
+    import redis
+
+    if client_class is None:
+        client_class = redis.Redis
+    kwargs.update(get_auth_kwargs(row))
+    return client_class(host=host, port=port, ssl=row.tls, **kwargs)
+
+
+class NodePools(object):
+    """One connection pool per node, logical database and credentials,
+    shared by the discovery, the sampling and the keyspace profiling of the
+    node, so that a node is connected to and authenticated once however
+    many input rows and stages reach it with the same credentials. A pool,
+    like its clients, may be shared by threads.
+    """
+
+    def __init__(self, client_kwargs):
+        """
+        Args:
+            client_kwargs: the connection arguments (e.g. timeouts)
+        """
+        self.client_kwargs = client_kwargs
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, row, host, port, db=0):
+        """
+            Get a client of the pool of a node, for the credentials and TLS
+            setting of a row: rows reaching the node with other ones get a
+            pool of their own
+            Args:
+                row: a row from the input file
+                host, port: the node to connect to
+                db: the logical database
+            Returns:
+                the client, whose close() leaves the pool open
+        """
+        import redis
+
+        key = (host, int(port), db, row.user, row.password, bool(row.tls))
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = redis.ConnectionPool(
+                    connection_class=redis.SSLConnection if row.tls
+                    else redis.Connection,
+                    host=host, port=int(port), db=db,
+                    **dict(get_auth_kwargs(row), **self.client_kwargs))
+        return redis.Redis(connection_pool=pool)
+
+    def close(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.disconnect()
+
+
+def get_snapshot_pipeline(client):
+    """
+        Queue both INFO commands of a snapshot on a pipeline, so a snapshot
+        costs a single round trip
+        Args:
+            client: the (sync or asyncio) client connected to the node
+        Returns:
+            the pipeline
+    """
+    pipe = client.pipeline(transaction=False)
+    pipe.execute_command('info commandstats')
+    pipe.execute_command('info default')
+    return pipe
+
+
+def take_snapshot(client):
+    """
+        Take a single stats snapshot of a node
+        Args:
+            client: the client connected to the node
+        Returns:
+            a (commandstats, info, timestamp) tuple, the timestamp being the
+            midpoint of the round trip on the time.monotonic() clock
+    """
+    pipe = get_snapshot_pipeline(client)
+    sent = time.monotonic()
+    with PROFILER.measure('redis.snapshot'):
+        (res, info) = pipe.execute()
+    timestamp = (sent + time.monotonic()) / 2
+    return parse_commandstats(res), parse_info(info), timestamp
+
+
+async def async_take_snapshot(client):
+    """
+        Take a single stats snapshot of a node with an asyncio client
+        Args:
+            client: the redis.asyncio client connected to the node
+        Returns:
+            a (commandstats, info, timestamp) tuple, see take_snapshot
+    """
+    pipe = get_snapshot_pipeline(client)
+    sent = time.monotonic()
+    with PROFILER.measure('redis.snapshot'):
+        (res, info) = await pipe.execute()
+    timestamp = (sent + time.monotonic()) / 2
+    return parse_commandstats(res), parse_info(info), timestamp
+
+
+def get_node_result(row, is_master_shard, sampling, rate_stats=False):
+    """
+        Compute the stats of a node from its snapshots
         Args:
             row: a row from the input file
-            node: the node to be processed
             is_master_shard: is master shard
-            duration: the duration between runs
+            sampling: the NodeSampling (or NodeHistory) of the node
+            rate_stats: compute the per interval ops/sec statistics
         Returns:
-            command stats output
+            the node stats dictionary
     """
-    params = node.split(':')
-    if pd.isnull(row['Password']):
-        client = redis.Redis(host=params[0], port=params[1], ssl=is_ssl(row))
-    else:
-        if pd.isnull(row['User (ACL)']):
-            client = redis.Redis(
-                host=params[0],
-                port=params[1],
-                password=row['Password'],
-                ssl=is_ssl(row))
-        else:
-            client = redis.Redis(
-                host=params[0],
-                port=params[1],
-                password=row['Password'],
-                username=row['User (ACL)'],
-                ssl=is_ssl(row))
-
-    print('Processing %s' % row['Redis Host'])
-    result = {}
-
-    # first run
-    res1 = parse_response(client.execute_command('info commandstats'))
-    info1 = client.execute_command('info')
-    time.sleep(duration * 60)
+    import numpy as np
 
-    # second run
-    res2 = parse_response(client.execute_command('info commandstats'))
-    info2 = client.execute_command('info')
+    info2 = sampling.info
+    (counters, timestamps) = sampling.get_window()
+    result = {}
     result['Source'] = 'oss'
-    result['DB Name'] = row['Redis Host'].replace('.', '-')
+    result['DB Name'] = row.host.replace('.', '-')
     result['BytesUsedForCache'] = info2['used_memory_peak']
     result['Memory Limit (GB)'] = info2['used_memory_peak'] / 1024 ** 3
     result['CurrConnections'] = info2['connected_clients']
@@ -171,180 +581,961 @@ def process_node(row, node, is_master_shard, duration):
     result['Node Type'] = 'Master' if is_master_shard else 'Replica'
     result['connected_slaves'] = info2['connected_slaves'] \
         if 'connected_slaves' in info2 else ''
-    result['duration'] = 60 * duration
-    result['TotalOps'] = info2['total_commands_processed'] - \
-        info1['total_commands_processed']
-
-    # String
-    result['StringBasedCmds'] = get_command_by_args(
-        res1, res2, 'get', 'set', 'incr', 'decr', 'incrby', 'decrby')
-
-    # Hash
-    result['HashBasedCmds'] = get_command_by_args(
-        res1, res2, 'hget', 'hset', 'hgetall', 'hmget', 'hsetnx')
-
-    # HyperLogLog
-    result['HyperLogLogBasedCmds'] = get_command_by_args(
-        res1, res2, 'pfadd', 'pfcount', 'pfmerge')
-
-    # Keys
-    result['KeyBasedCmds'] = get_command_by_args(
-        res1, res2, 'del', 'expire', 'unlink')
-
-    # List
-    result['ListBasedCmds'] = get_command_by_args(
-        res1,
-        res2,
-        'blpop',
-        'brpop',
-        'brpoplpush',
-        'blmove',
-        'linsert',
-        'llen',
-        'lpop',
-        'lpush',
-        'lpushx',
-        'lrange',
-        'lset',
-        'lrem',
-        'rpop',
-        'rpoplpush',
-        'rpush',
-        'rpushx')
-
-    # Sets
-    result['SetBasedCmds'] = get_command_by_args(
-        res1, res2, 'sadd', 'scard', 'sdiff', 'sdiffstore', 'sinter',
-        'sinterstore', 'sismember', 'smismember', 'smembers', 'smove', 'spop',
-        'srandmember', 'srem', 'sunion', 'sunionstore', 'sscan')
-
-    # SortedSets
-    result['SortedSetBasedCmds'] = get_command_by_args(
-        res1, res2, 'bzpopmin', 'bzpopmax', 'zadd', 'zcard', 'zcount',
-        'zdiff', 'zdiffstore', 'zincrby', 'zinter', 'zinterstore',
-        'zlexcount', 'zpopmax', 'zpopmin', 'zrange', 'zrangebylex',
-        'zrevrangebylex', 'zrangebyscore', 'zrank', 'zrem',
-        'zremrangebylex', 'zremrangebyrank', 'zremrangebyscore',
-        'zrevrange', 'zrevrangebyscore', 'zrevrank', 'zscore', 'zunion',
-        'zmscore', 'zunionstore', 'zscan')
-
-    # Streams
-    result['StreamBasedCmds'] = get_command_by_args(
-        res1,
-        res2,
-        'xadd',
-        'xtrim',
-        'xdel',
-        'xrange',
-        'xrevrange',
-        'xlen',
-        'xread',
-        'xgroup',
-        'xreadgroup',
-        'xack',
-        'xclaim',
-        'xpending')
-    result['CurrItems'] = 0
-    for x in range(10):
-        db = 'db%s' % x
-        if db in info2:
-            debug('num of keys %s' % info2[db]['keys'])
-            result['CurrItems'] += info2[db]['keys']
-    result_arr = [result]
-    return result_arr
-
-
-def process_db(row, output_df, duration):
-    """
-        Get the current command stats of the DB
+    # The measured time between the first and last snapshots, rather than
+    # the nominal duration, so the rates account for scheduling delays
+    result['duration'] = round(timestamps[-1] - timestamps[0], 3)
+
+    totals = counters[-1] - counters[0]
+    if rate_stats:
+        rates = np.diff(counters, axis=0) / \
+            np.diff(timestamps)[:, np.newaxis]
+    for i, metric in enumerate(get_cmd_metrics()):
+        result[metric] = int(totals[i])
+        if rate_stats:
+            result['%s (avg ops/sec)' % metric] = rates[:, i].mean()
+            result['%s (max ops/sec)' % metric] = rates[:, i].max()
+            result['%s (p95 ops/sec)' % metric] = \
+                np.percentile(rates[:, i], 95)
+            result['%s (p99 ops/sec)' % metric] = \
+                np.percentile(rates[:, i], 99)
+
+    # Every logical database, not only db0-db9 (databases can be >= 16)
+    keyspace = get_keyspace(info2)
+    debug('num of keys %s' % keyspace)
+    result['CurrItems'] = sum(keyspace.values())
+    return result
+
+
+def is_cluster_enabled(info):
+    return 'cluster_enabled' in info and info['cluster_enabled'] == 1
+
+
+def get_targets(row, nodes):
+    """
+        Get the sampling targets of a DB from its topology
         Args:
             row: a row from the input file
-            output_df: the output data frame
-            duration: the duration between runs
+            nodes: the parsed 'cluster nodes' output of the DB
         Returns:
-            command stats output
-    """
-    if pd.isnull(row['Password']):
-        client = redis.Redis(
-            host=row['Redis Host'],
-            port=row['Port'],
-            socket_timeout=10,
-            ssl=is_ssl(row))
-    else:
-        if pd.isnull(row['User (ACL)']):
-            client = redis.Redis(
-                host=row['Redis Host'],
-                port=row['Port'],
-                password=row['Password'],
-                socket_timeout=10,
-                ssl=is_ssl(row))
-        else:
-            client = redis.Redis(
-                host=row['Redis Host'],
-                port=row['Port'],
-                password=row['Password'],
-                username=row['User (ACL)'],
-                socket_timeout=10,
-                ssl=is_ssl(row))
+            a list of (row, node, is_master_shard) sampling targets
+    """
+    targets = []
+    for node, stats in nodes.items():
+        is_master_shard = False
+        if stats['flags'].find('master') >= 0:
+            is_master_shard = True
+
+        if stats['connected'] is True:
+            targets.append((row, node, is_master_shard))
+    return targets
+
+
+def get_single_node(row):
+    return {
+        '%s:%s' %
+        (row.host, row.port): {
+            'flags': 'master', 'connected': True}}
+
+
+def get_topology_pipeline(client):
+    """
+        Queue the topology discovery commands on a pipeline, so discovering
+        a DB costs a single round trip. 'cluster nodes' fails on DBs that
+        aren't clustered, so the pipeline is executed with
+        raise_on_error=False.
+        Args:
+            client: the (sync or asyncio) client connected to the DB
+        Returns:
+            the pipeline
+    """
+    pipe = client.pipeline(transaction=False)
+    pipe.execute_command('info server')
+    pipe.execute_command('info cluster')
+    pipe.execute_command('cluster nodes')
+    return pipe
+
+
+def get_topology(row, server, info, nodes):
+    """
+        Get the topology of a DB from its topology pipeline replies. The
+        nodes are identified by their cluster node ID (the CLUSTER MYID of
+        the node), or by the run ID of a DB that isn't clustered, so that
+        the same node reached from several input rows, under different
+        addresses, is recognized.
+        Args:
+            row: a row from the input file
+            server, info, nodes: the replies of the topology pipeline
+        Returns:
+            a (DB ID, [(node ID, node, is_master_shard)]) pair, the DB ID
+            being the smallest node ID of a cluster, or None if the
+            discovery failed
+    """
+    if isinstance(info, Exception) or isinstance(server, Exception):
+        print('Error connecting to Redis %s' % row.host)
+        return None
+    if not is_cluster_enabled(parse_info(info)):
+        run_id = parse_info(server, frozenset([b'run_id'])).get('run_id')
+        # Without a run ID (some hosted services hide it), only the same
+        # address is recognized as the same node
+        node_id = '%s' % run_id if run_id is not None else \
+            '%s:%s' % (row.host, row.port)
+        return (node_id, [(node_id, node, is_master_shard)
+                          for (_, node, is_master_shard)
+                          in get_targets(row, get_single_node(row))])
+    if isinstance(nodes, Exception):
+        print('Error discovering the nodes of %s: %s' %
+              (row.host, nodes))
+        return None
+    return (min(stats['node_id'] for stats in nodes.values()),
+            [(nodes[node]['node_id'], node, is_master_shard)
+             for (_, node, is_master_shard) in get_targets(row, nodes)])
+
+
+def get_seed(row):
+    """The (host, port) endpoint of the DB of an input row"""
+    return (row.host, row.port)
+
+
+# The input rows read ahead of the oldest discovery still running, per
+# worker: the rows are discovered as they are read, without reading the
+# whole input first
+ROWS_AHEAD_PER_WORKER = 8
+
+
+class TargetSet(object):
+    """The sampling targets of the DBs of the input rows, every node once:
+    a node reached from several rows (e.g. seed nodes of the same cluster,
+    or the same host listed twice) is sampled for the first row that
+    reaches it. The rows are added in input order.
+    """
+
+    def __init__(self):
+        self.targets = []
+        self._node_ids = set()
+        self._dbs = {}
+
+    def add(self, row, topology):
+        """
+            Add the nodes of the DB of an input row
+            Args:
+                row: the inputReaders.Endpoint of a row from the input file
+                topology: the topology of the DB, see get_topology, or None
+                    if the discovery failed
+        """
+        if topology is None:
+            return
+        (db_id, nodes) = topology
+        if db_id in self._dbs:
+            print('%s:%s is a node of the DB of %s, which is sampled once' %
+                  (row.host, row.port, self._dbs[db_id]))
+            return
+        self._dbs[db_id] = '%s:%s' % get_seed(row)
+        for (node_id, node, is_master_shard) in nodes:
+            if node_id not in self._node_ids:
+                self._node_ids.add(node_id)
+                self.targets.append((row, node, is_master_shard))
+
+
+class TopologyCache(object):
+    """The topology of the DBs discovered during the run, by endpoint: a
+    DB is discovered once per seed endpoint, and not at all from an
+    endpoint that is a node of a DB already discovered.
+    """
 
+    def __init__(self, pools):
+        """
+        Args:
+            pools: the NodePools the seed nodes are connected with
+        """
+        self.pools = pools
+        self._topologies = {}
+        self._lock = threading.Lock()
+
+    def discover(self, row):
+        """
+            Discover the DB of an input row, unless already known
+            Args:
+                row: a row from the input file
+            Returns:
+                the topology of the DB, see get_topology, or None if the
+                discovery failed
+        """
+        import redis
+
+        seed = get_seed(row)
+        with self._lock:
+            topology = self._topologies.get(seed)
+        if topology is not None:
+            return topology
+        client = self.pools.get_client(row, *seed)
+        try:
+            with PROFILER.measure('redis.topology'):
+                (server, info, nodes) = get_topology_pipeline(
+                    client).execute(raise_on_error=False)
+        except redis.RedisError:
+            print('Error connecting to Redis %s' % row.host)
+            return None
+        topology = get_topology(row, server, info, nodes)
+        if topology is not None:
+            with self._lock:
+                self._topologies[seed] = topology
+                for (_, node, _) in topology[1]:
+                    host, port = node.rsplit(':', 1)
+                    self._topologies.setdefault((host, int(port)), topology)
+        return topology
+
+    def get_targets(self, rows, executor, workers):
+        """
+            Discover the DBs of the input rows concurrently, every seed
+            endpoint once, as the rows are read
+            Args:
+                rows: an iterable of the rows of the input file
+                executor: the thread pool the DBs are discovered on
+                workers: the number of threads of the pool
+            Returns:
+                the sampling targets, every node once, see TargetSet
+        """
+        targets = TargetSet()
+        futures = {}
+        pending = collections.deque()
+        for row in rows:
+            seed = get_seed(row)
+            if seed not in futures:
+                futures[seed] = executor.submit(self.discover, row)
+            pending.append((row, futures[seed]))
+            while pending and (pending[0][1].done() or len(pending) >
+                               workers * ROWS_AHEAD_PER_WORKER):
+                (row, future) = pending.popleft()
+                targets.add(row, future.result())
+        for (row, future) in pending:
+            targets.add(row, future.result())
+        return targets.targets
+
+
+def get_target_key(target):
+    row, node, _ = target
+    return '%s/%s' % (row.host, node)
+
+
+def get_snapshot_offsets(duration, interval=None):
+    """
+        Get the times the snapshots are taken at
+        Args:
+            duration: the sampling window (in minutes)
+            interval: the seconds between snapshots, or None to take a
+                snapshot at the start and at the end of the window only
+        Returns:
+            the offsets in seconds from the start of the window, the last
+            one being the end of the window, even when the interval doesn't
+            divide it (the rates use the measured snapshot times)
+    """
+    if interval is None:
+        return [0, duration * 60]
+    offsets = list(range(0, duration * 60 + 1, interval))
+    if offsets[-1] != duration * 60:
+        offsets.append(duration * 60)
+    return offsets
+
+
+def start_sampling(target, snapshot_count, pools):
+    """
+        Connect to a node and take its first snapshot
+        Args:
+            target: a (row, node, is_master_shard) sampling target
+            snapshot_count: the number of snapshots that will be taken
+            pools: the NodePools of the nodes
+        Returns:
+            the NodeSampling of the node, or None if the node failed
+    """
+    import redis
+
+    row, node, _ = target
+    host, port = node.rsplit(':', 1)
+    print('Processing %s (%s)' % (row.host, node))
+    client = pools.get_client(row, host, port)
     try:
-        client.ping()
-    except BaseException:
-        print('Error connecting to Redis %s' % row['Redis Host'])
-        return output_df
-
-    info = client.execute_command('info')
-    is_clustered = False
-    if 'cluster_enabled' in info and info['cluster_enabled'] == 1:
-        is_clustered = True
-
-    if is_clustered is True:
-        nodes = client.execute_command('cluster nodes')
-    else:
-        nodes = {
-            '%s:%s' %
-            (row['Redis Host'], row['Port']): {
-                'flags': 'master', 'connected': True}}
-
-    with concurrent.futures.ProcessPoolExecutor():
-        for node, stats in nodes.items():
-            is_master_shard = False
-            if stats['flags'].find('master') >= 0:
-                is_master_shard = True
-
-            if stats['connected'] is True:
-                output_df = output_df.append(
-                    process_node(
-                        row,
-                        node,
-                        is_master_shard,
-                        duration),
-                    ignore_index=True)
-    return output_df
-
-
-def process_file(input_file_path, output_file_path, duration):
+        sampling = NodeSampling(client, snapshot_count)
+        sampling.add(take_snapshot(client))
+        return sampling
+    except redis.RedisError as e:
+        print('Error sampling %s: %s' % (node, e))
+        client.close()
+        return None
+
+
+def continue_sampling(target, sampling):
+    """
+        Take the next snapshot of a node
+        Args:
+            target: a (row, node, is_master_shard) sampling target
+            sampling: the NodeSampling of the node
+        Returns:
+            the NodeSampling of the node, or None if the node failed
+    """
+    import redis
+
+    if sampling is None:
+        return None
+    try:
+        sampling.add(take_snapshot(sampling.client))
+        return sampling
+    except redis.RedisError as e:
+        print('Error sampling %s: %s' % (target[1], e))
+        sampling.client.close()
+        return None
+
+
+def sample_rows(rows, offsets, workers, pools, done=()):
+    """
+        Sample all the nodes of the DBs on a thread pool, over one shared
+        window: every snapshot is taken on all the nodes before waiting for
+        the next one. Every node is sampled once, however many rows reach
+        it.
+        Args:
+            rows: an iterable of the rows of the input file, which are
+                discovered as they are read
+            offsets: the snapshot times, see get_snapshot_offsets
+            workers: the number of nodes sampled concurrently
+            pools: the NodePools of the nodes
+            done: the keys (see get_target_key) of the nodes to skip
+        Returns:
+            the (targets, samplings) lists
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        targets = [target
+                   for target in TopologyCache(pools).get_targets(
+                       rows, executor, workers)
+                   if get_target_key(target) not in done]
+        start = time.monotonic()
+        samplings = list(executor.map(
+            functools.partial(start_sampling,
+                              snapshot_count=len(offsets),
+                              pools=pools),
+            targets))
+        for offset in offsets[1:]:
+            with PROFILER.measure('sleep.window'):
+                time.sleep(max(0, start + offset - time.monotonic()))
+            samplings = list(executor.map(
+                continue_sampling, targets, samplings))
+
+    for sampling in samplings:
+        if sampling is not None:
+            sampling.client.close()
+    return targets, samplings
+
+
+async def async_get_topology(row, semaphore, client_kwargs):
+    """
+        Discover the nodes of the DB with an asyncio client
+        Args:
+            row: a row from the input file
+            semaphore: limits the number of concurrent connection attempts
+            client_kwargs: the connection arguments (e.g. timeouts)
+        Returns:
+            the topology of the DB, see get_topology, or None if the
+            discovery failed
+    """
+    import redis.asyncio
+
+    async with semaphore:
+        client = get_client(row, row.host, row.port,
+                            client_class=redis.asyncio.Redis, **client_kwargs)
+        try:
+            with PROFILER.measure('redis.topology'):
+                (server, info, nodes) = await get_topology_pipeline(
+                    client).execute(raise_on_error=False)
+        except (redis.RedisError, OSError):
+            print('Error connecting to Redis %s' % row.host)
+            return None
+        finally:
+            await client.aclose()
+
+    return get_topology(row, server, info, nodes)
+
+
+async def async_start_sampling(target, semaphore, snapshot_count,
+                               client_kwargs):
+    """
+        Connect to a node and take its first snapshot with an asyncio client
+        Args:
+            target: a (row, node, is_master_shard) sampling target
+            semaphore: limits the number of concurrent connection attempts
+            snapshot_count: the number of snapshots that will be taken
+            client_kwargs: the connection arguments (e.g. timeouts)
+        Returns:
+            the NodeSampling of the node, or None if the node failed
+    """
+    import redis.asyncio
+
+    row, node, _ = target
+    host, port = node.rsplit(':', 1)
+    async with semaphore:
+        print('Processing %s (%s)' % (row.host, node))
+        client = get_client(row, host, port,
+                            client_class=redis.asyncio.Redis, **client_kwargs)
+        try:
+            sampling = NodeSampling(client, snapshot_count)
+            sampling.add(await async_take_snapshot(client))
+            return sampling
+        except (redis.RedisError, OSError) as e:
+            print('Error sampling %s: %s' % (node, e))
+            await client.aclose()
+            return None
+
+
+async def async_continue_sampling(target, sampling, semaphore):
+    """
+        Take the next snapshot of a node with an asyncio client
+        Args:
+            target: a (row, node, is_master_shard) sampling target
+            sampling: the NodeSampling of the node
+            semaphore: limits the number of concurrent snapshots
+        Returns:
+            the NodeSampling of the node, or None if the node failed
+    """
+    import redis
+
+    if sampling is None:
+        return None
+    async with semaphore:
+        try:
+            sampling.add(await async_take_snapshot(sampling.client))
+            return sampling
+        except (redis.RedisError, OSError) as e:
+            print('Error sampling %s: %s' % (target[1], e))
+            await sampling.client.aclose()
+            return None
+
+
+async def async_sample_rows(rows, offsets, concurrency, client_kwargs,
+                            done=()):
+    """
+        Sample all the nodes of the DBs with asyncio clients, over one shared
+        window. Open connections wait on the event loop instead of holding a
+        thread each, so one process can sample thousands of nodes. Every
+        node is sampled once, however many rows reach it.
+        Args:
+            rows: an iterable of the rows of the input file, which are
+                discovered as they are read
+            offsets: the snapshot times, see get_snapshot_offsets
+            concurrency: the number of concurrent connection attempts and
+                snapshots
+            client_kwargs: the connection arguments (e.g. timeouts)
+            done: the keys (see get_target_key) of the nodes to skip
+        Returns:
+            the (targets, samplings) lists
+    """
+    import asyncio
+
+    semaphore = asyncio.Semaphore(concurrency)
+    target_set = TargetSet()
+    tasks = {}
+    pending = collections.deque()
+    for row in rows:
+        seed = get_seed(row)
+        if seed not in tasks:
+            tasks[seed] = asyncio.ensure_future(
+                async_get_topology(row, semaphore, client_kwargs))
+        pending.append((row, tasks[seed]))
+        # Let the discoveries started run while the input is read
+        await asyncio.sleep(0)
+        while pending and (pending[0][1].done() or len(pending) >
+                           concurrency * ROWS_AHEAD_PER_WORKER):
+            (row, task) = pending.popleft()
+            target_set.add(row, await task)
+    for (row, task) in pending:
+        target_set.add(row, await task)
+    targets = [target for target in target_set.targets
+               if get_target_key(target) not in done]
+    start = time.monotonic()
+    samplings = await asyncio.gather(
+        *(async_start_sampling(target, semaphore, len(offsets),
+                               client_kwargs)
+          for target in targets))
+    for offset in offsets[1:]:
+        with PROFILER.measure('sleep.window'):
+            await asyncio.sleep(max(0, start + offset - time.monotonic()))
+        samplings = await asyncio.gather(
+            *(async_continue_sampling(target, sampling, semaphore)
+              for target, sampling in zip(targets, samplings)))
+
+    for sampling in samplings:
+        if sampling is not None:
+            await sampling.client.aclose()
+    return targets, samplings
+
+
+def profile_target(target, keyspace, pools, keyspace_kwargs):
+    """
+        Profile the keyspace of a node from a sample of its keys
+        Args:
+            target: a (row, node, is_master_shard) sampling target
+            keyspace: the number of keys of every logical database of the
+                node, see get_keyspace
+            pools: the NodePools of the nodes
+            keyspace_kwargs: the arguments of keyspaceProfiler.profile_node
+                (e.g. max_keys)
+        Returns:
+            the (type rows, big key rows) of the node, or None if the node
+            failed
+    """
+    import redis
+
+    row, node, _ = target
+    host, port = node.rsplit(':', 1)
+    db_name = row.host.replace('.', '-')
+    print('Profiling the keyspace of %s (%s)' % (row.host, node))
+    try:
+        profile = profile_node(
+            lambda db: pools.get_client(row, host, port, db),
+            keyspace, **keyspace_kwargs)
+    except redis.RedisError as e:
+        print('Error profiling the keyspace of %s: %s' % (node, e))
+        return None
+    return (profile.get_type_rows(db_name, node, sum(keyspace.values())),
+            profile.get_big_key_rows(db_name, node))
+
+
+def profile_keyspaces(targets, samplings, workers, pools, keyspace_kwargs):
+    """
+        Profile the keyspace of every master sampled, on a thread pool
+        Args:
+            targets, samplings: the nodes sampled, see sample_rows
+            workers: the number of nodes profiled concurrently
+            pools: the NodePools of the nodes
+            keyspace_kwargs: the arguments of keyspaceProfiler.profile_node
+        Returns:
+            the (type rows, big key rows) lists of all the nodes
+    """
+    masters = [(target, get_keyspace(sampling.info))
+               for target, sampling in zip(targets, samplings)
+               if sampling is not None and target[2]]
+    type_rows = []
+    big_key_rows = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        for rows in executor.map(
+                lambda master: profile_target(
+                    master[0], master[1], pools, keyspace_kwargs),
+                masters):
+            if rows is not None:
+                type_rows.extend(rows[0])
+                big_key_rows.extend(rows[1])
+    return (type_rows, big_key_rows)
+
+
+def process_file(input_file_path, output_file_path, duration, workers,
+                 engine='threads', client_kwargs=None, interval=None,
+                 resume=False, output_format='xlsx', keyspace_kwargs=None,
+                 input_format=None):
     """
         Process the entire input file
         Args:
-            input_file_path: the file path to be processed
+            input_file_path: the file path to be processed, '-' for stdin
             output_file_path: the file path for the processed file
             duration: duration between each run
+            workers: the number of nodes processed concurrently
+            engine: 'threads' or 'asyncio'
+            client_kwargs: the connection arguments (e.g. timeouts)
+            interval: the seconds between snapshots, or None to take only
+                two snapshots, duration apart
+            resume: skip the nodes recorded in the journal of a failed run
+            output_format: the format the results are written in, see
+                outputWriters.FORMATS
+            keyspace_kwargs: profile the keyspace of the masters sampled
+                once the window is over, with these arguments of
+                keyspaceProfiler.profile_node, or None not to
+            input_format: the format of the input file, see
+                inputReaders.read_endpoints
         Returns:
             None
     """
-    input_df = pd.read_excel(
-        input_file_path,
-        header=0,
-        sheet_name="Redis Sizing Input")
-    output_df = create_data_frame()
+    rows = read_endpoints(input_file_path, input_format)
+    (columns, dtypes) = get_result_columns(rate_stats=interval is not None)
+    client_kwargs = client_kwargs or {}
+    offsets = get_snapshot_offsets(duration, interval)
+
+    # The node results are journaled as they complete, so a failed run can
+    # be resumed; the journal is removed once the workbook is written with
+    # every node.
+    journal = RunJournal('%s.journal' % output_file_path, columns, resume)
+    pools = NodePools(client_kwargs)
+    try:
+        try:
+            if engine == 'asyncio':
+                import asyncio
+                (targets, samplings) = asyncio.run(async_sample_rows(
+                    rows, offsets, workers, client_kwargs, journal))
+            else:
+                (targets, samplings) = sample_rows(
+                    rows, offsets, workers, pools, journal)
+
+            journal.record(
+                (get_target_key(target), get_node_result(
+                    target[0], target[2], sampling, interval is not None))
+                for target, sampling in zip(targets, samplings)
+                if sampling is not None)
+        finally:
+            journal.close()
+
+        if keyspace_kwargs is not None:
+            # After the window, so the commands sent don't count in its
+            # stats
+            (type_rows, big_key_rows) = profile_keyspaces(
+                targets, samplings, workers, pools, keyspace_kwargs)
+    finally:
+        pools.close()
+
+    with OutputWriter(os.path.splitext(output_file_path)[0],
+                      output_format) as writer:
+        sheet = writer.add_sheet('ClusterData', columns, dtypes)
+        for node_result in journal.values():
+            sheet.append_dict(node_result)
+        if keyspace_kwargs is not None:
+            sheet = writer.add_sheet('KeyspaceTypes', get_type_columns())
+            for type_row in type_rows:
+                sheet.append_dict(type_row)
+            sheet = writer.add_sheet('BigKeys', get_big_key_columns())
+            for big_key_row in big_key_rows:
+                sheet.append_dict(big_key_row)
+    print("Results are in %s" % ", ".join(writer.paths))
+
+    failed = sum(1 for sampling in samplings if sampling is None)
+    if failed:
+        print('%d nodes failed, run again with --resume to sample only '
+              'them' % failed)
+    else:
+        journal.remove()
+
+
+# The content type of the /metrics endpoint of the daemon mode
+OPENMETRICS_CONTENT_TYPE = \
+    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class Daemon(object):
+    """Sample every node of the DBs at a fixed cadence, until stopped.
+
+    Every node keeps its client, and so its pooled connection, across
+    snapshots, and is sampled once however many input rows reach it. Its
+    samples are kept in a NodeHistory: the memory used is set by
+    the number of nodes and the history kept, however long the daemon runs.
+    The results are written over the samples kept at the time, on demand or
+    on a schedule.
+    """
+
+    def __init__(self, rows, output_file_path, interval, workers,
+                 client_kwargs, history=1440, peak_hours=168,
+                 output_format='xlsx'):
+        """
+        Args:
+            rows: an iterable of the rows of the input file
+            output_file_path: the file path the results are written to
+            interval: the seconds between snapshots
+            workers: the number of nodes sampled concurrently
+            client_kwargs: the connection arguments (e.g. timeouts)
+            history: the number of snapshots kept per node
+            peak_hours: the number of hourly averages kept per node
+            output_format: the format the results are written in, see
+                outputWriters.FORMATS
+        """
+        self.rows = rows
+        self.output_file_path = output_file_path
+        self.interval = interval
+        self.workers = workers
+        self.pools = NodePools(client_kwargs)
+        self.history = history
+        self.peak_hours = peak_hours
+        self.output_format = output_format
+        self.targets = []
+        self.histories = []
+        self.ticks = 0
+        self.started = time.time()
+        # Guards the histories, which the HTTP threads read while the
+        # sampling threads add to them
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+
+    def discover(self):
+        """Discover the nodes of the DBs, and connect to them"""
+        for target in TopologyCache(self.pools).get_targets(
+                self.rows, self._executor, self.workers):
+            row, node, _ = target
+            host, port = node.rsplit(':', 1)
+            self.targets.append(target)
+            self.histories.append(NodeHistory(
+                self.pools.get_client(row, host, port),
+                self.history, self.peak_hours))
+        print('Sampling %d nodes every %d seconds, with %.1f MB of history'
+              % (len(self.targets), self.interval,
+                 sum(history.nbytes for history in self.histories) /
+                 1024.0 ** 2))
+
+    def sample_node(self, index):
+        """
+            Take the next snapshot of a node. A node that fails is tried
+            again on the next tick, the client reconnecting as needed.
+            Args:
+                index: the index of the node in targets
+            Returns:
+                True if the snapshot was taken
+        """
+        import redis
+
+        history = self.histories[index]
+        try:
+            snapshot = take_snapshot(history.client)
+        except redis.RedisError as e:
+            print('Error sampling %s: %s' % (self.targets[index][1], e))
+            return False
+        with self._lock:
+            history.add(snapshot)
+        return True
 
-    with concurrent.futures.ProcessPoolExecutor():
-        for (index, row) in input_df.iterrows():
-            output_df = process_db(row, output_df, duration)
+    def sample(self):
+        """
+            Take a snapshot of every node
+            Returns:
+                the number of nodes that failed
+        """
+        return sum(1 for taken in self._executor.map(
+            self.sample_node, range(len(self.histories))) if not taken)
 
-    with (pd.ExcelWriter(output_file_path, engine='xlsxwriter')) as writer:
-        output_df.to_excel(writer, 'ClusterData', index=False)
+    def run(self, stop, dump_interval=None):
+        """
+            Sample the nodes every interval seconds until stop is set, then
+            write the results. A tick that starts late, e.g. because the
+            previous one took longer than the interval, skips the ticks
+            missed rather than sampling them back to back.
+            Args:
+                stop: the threading.Event stopping the daemon
+                dump_interval: the seconds between scheduled writes of the
+                    results, or None to write them on demand only
+        """
+        start = time.monotonic()
+        next_dump = None if not dump_interval else start + dump_interval
+        while not stop.is_set():
+            failed = self.sample()
+            self.ticks += 1
+            if failed:
+                print('%d of %d nodes failed' % (failed, len(self.targets)))
+            now = time.monotonic()
+            if next_dump is not None and now >= next_dump:
+                self.dump()
+                next_dump = now + dump_interval
+            next_tick = start + self.interval * (
+                math.floor((time.monotonic() - start) / self.interval) + 1)
+            with PROFILER.measure('sleep.window'):
+                stop.wait(max(0, next_tick - time.monotonic()))
+        self.dump()
+
+    def get_results(self):
+        """The node results over the samples kept"""
+        results = []
+        for target, history in zip(self.targets, self.histories):
+            with self._lock:
+                if history.count < 2:
+                    continue
+                result = get_node_result(target[0], target[2], history,
+                                         rate_stats=True)
+                peak_hour = history.get_peak_hour_rates()
+            for i, metric in enumerate(get_cmd_metrics()):
+                result['%s (peak hour avg ops/sec)' % metric] = \
+                    float('nan') if peak_hour is None else peak_hour[i]
+            results.append(result)
+        return results
+
+    def dump(self):
+        """
+            Write the results over the samples kept. They are written to
+            temporary files first, so the previous results stay complete
+            until replaced.
+            Returns:
+                the paths written
+        """
+        (columns, dtypes) = get_result_columns(rate_stats=True,
+                                               peak_hour=True)
+        base_path = os.path.splitext(self.output_file_path)[0]
+        temp_path = '%s.tmp%d' % (base_path, os.getpid())
+        paths = []
+        with self._dump_lock:
+            with OutputWriter(temp_path, self.output_format) as writer:
+                sheet = writer.add_sheet('ClusterData', columns, dtypes)
+                for node_result in self.get_results():
+                    sheet.append_dict(node_result)
+            for path in writer.paths:
+                paths.append(base_path + path[len(temp_path):])
+                os.replace(path, paths[-1])
+        print("Results are in %s" % ", ".join(paths))
+        return paths
+
+    def get_rates(self):
+        """The current, peak and peak hour ops/sec of every node"""
+        metrics = get_cmd_metrics()
+
+        def to_dict(rates):
+            return None if rates is None else dict(zip(metrics,
+                                                       rates.tolist()))
+
+        nodes = []
+        for (row, node, is_master_shard), history in zip(self.targets,
+                                                         self.histories):
+            with self._lock:
+                nodes.append({
+                    'db': row.host.replace('.', '-'),
+                    'node': node,
+                    'role': 'Master' if is_master_shard else 'Replica',
+                    'samples': history.count,
+                    'current': to_dict(history.get_current_rates()),
+                    'peak': to_dict(history.get_peak_rates()),
+                    'peak_hour': to_dict(history.get_peak_hour_rates()),
+                })
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                     time.gmtime(self.started)),
+            'interval': self.interval,
+            'ticks': self.ticks,
+            'nodes': nodes,
+        }
+
+    def get_openmetrics(self):
+        """The rates of every node in the OpenMetrics text format"""
+        nodes = self.get_rates()['nodes']
+        lines = []
+        for (name, key, help_text) in [
+                ('ops_per_second', 'current',
+                 'Commands per second over the last interval'),
+                ('peak_ops_per_second', 'peak',
+                 'Highest commands per second over an interval kept'),
+                ('peak_hour_ops_per_second', 'peak_hour',
+                 'Highest hourly average of commands per second')]:
+            lines.extend(format_metric_family(
+                'ecstats_oss_' + name, 'gauge', help_text, [
+                    ('', [('db', node['db']), ('node', node['node']),
+                          ('role', node['role']), ('category', metric)],
+                     rate)
+                    for node in nodes if node[key] is not None
+                    for metric, rate in node[key].items()]))
+        lines.extend(format_metric_family(
+            'ecstats_oss_samples', 'gauge', 'Snapshots kept', [
+                ('', [('db', node['db']), ('node', node['node']),
+                      ('role', node['role'])], node['samples'])
+                for node in nodes]))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self._executor.shutdown()
+        self.pools.close()
+
+
+def serve_http(daemon, host, port):
+    """
+        Serve the rates of a daemon on a background thread:
+            GET /rates (or /)  the rates of every node, as JSON
+            GET /metrics       the rates in the OpenMetrics text format
+            POST /dump         write the results now
+        Args:
+            daemon: the Daemon
+            host, port: the address to listen on
+        Returns:
+            the server, to shut down
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, content_type, body):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path in ('/', '/rates'):
+                self.reply(200, 'application/json',
+                           json.dumps(daemon.get_rates()))
+            elif path == '/metrics':
+                self.reply(200, OPENMETRICS_CONTENT_TYPE,
+                           daemon.get_openmetrics())
+            else:
+                self.reply(404, 'text/plain', 'Not found\n')
+
+        def do_POST(self):
+            if self.path.split('?', 1)[0] != '/dump':
+                self.reply(404, 'text/plain', 'Not found\n')
+                return
+            try:
+                paths = daemon.dump()
+            except OSError as e:
+                self.reply(500, 'text/plain', 'Error writing: %s\n' % e)
+                return
+            self.reply(200, 'application/json', json.dumps({'paths': paths}))
+
+        def log_message(self, format, *args):
+            debug('%s - %s' % (self.address_string(), format % args))
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Serving the rates on http://%s:%d/' % server.server_address[:2])
+    return server
+
+
+def run_daemon(input_file_path, output_file_path, interval, workers,
+               client_kwargs, history, peak_hours, http_host, http_port,
+               dump_interval, output_format='xlsx', input_format=None):
+    """
+        Sample the DBs of the input file continuously, until interrupted
+        (SIGINT or SIGTERM), then write the results. SIGUSR1 writes them
+        without stopping.
+        Args:
+            input_file_path: the file path to be processed
+            output_file_path: the file path for the results
+            interval: the seconds between snapshots
+            workers: the number of nodes sampled concurrently
+            client_kwargs: the connection arguments (e.g. timeouts)
+            history: the number of snapshots kept per node
+            peak_hours: the number of hourly averages kept per node
+            http_host, http_port: the address of the HTTP endpoint, which
+                is disabled if http_port is 0
+            dump_interval: the minutes between scheduled writes of the
+                results, 0 to write them on demand and at exit only
+            output_format: the format the results are written in, see
+                outputWriters.FORMATS
+            input_format: the format of the input file, see
+                inputReaders.read_endpoints
+    """
+    daemon = Daemon(read_endpoints(input_file_path, input_format),
+                    output_file_path, interval, workers, client_kwargs,
+                    history, peak_hours, output_format)
+    stop = threading.Event()
+
+    def on_stop(signum, frame):
+        print('Stopping, the results will be written once the current '
+              'snapshots are taken')
+        stop.set()
+
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGTERM, on_stop)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+            target=daemon.dump).start())
+
+    server = None
+    try:
+        daemon.discover()
+        if http_port:
+            server = serve_http(daemon, http_host, http_port)
+        daemon.run(stop, dump_interval * 60)
+    finally:
+        if server is not None:
+            server.shutdown()
+        daemon.close()
 
 
 def main():
@@ -353,8 +1544,18 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("inputFile",
                         help='''
-    The Excel file containing Redis endpoints to pull stats from
+    The file containing Redis endpoints to pull stats from: an Excel file
+    with a "Redis Sizing Input" sheet, a CSV file with the same columns or
+    a JSON lines file, '-' for stdin
                         ''')
+
+    parser.add_argument(
+        "--input-format",
+        choices=INPUT_FORMATS,
+        default=None,
+        help="The format of the input file (default: from its extension, "
+        ".xlsx/.xlsm, .csv/.txt or .jsonl/.ndjson; on stdin JSON lines if "
+        "the first line is an object, CSV otherwise)")
     parser.add_argument(
         "-d",
         "--duration",
@@ -362,6 +1563,129 @@ def main():
         help="Period in minutes between gathering data from the endpoint",
         default=5)
 
+    parser.add_argument(
+        "-i",
+        "--interval",
+        type=int,
+        help="Take a snapshot every INTERVAL seconds over the duration "
+        "and report the avg/max/p95/p99 ops/sec of every interval, "
+        "instead of only diffing the first and last snapshots. With "
+        "--daemon, the seconds between snapshots (default: 60)",
+        default=None)
+
+    parser.add_argument(
+        "--keyspace",
+        action="store_true",
+        help="Once the window is over, profile the keyspace of every "
+        "master from a sample of its keys (SCAN, then TYPE, MEMORY USAGE "
+        "and PTTL), and add KeyspaceTypes and BigKeys sheets")
+
+    parser.add_argument(
+        "--keyspace-max-keys",
+        type=int,
+        help="With --keyspace, the keys sampled per master",
+        default=DEFAULT_MAX_KEYS)
+
+    parser.add_argument(
+        "--keyspace-rate",
+        type=int,
+        help="With --keyspace, the keys sampled per second per master",
+        default=DEFAULT_KEYS_PER_SECOND)
+
+    parser.add_argument(
+        "--keyspace-batch",
+        type=int,
+        help="With --keyspace, the keys scanned and inspected per round "
+        "trip",
+        default=DEFAULT_BATCH_SIZE)
+
+    parser.add_argument(
+        "--keyspace-top",
+        type=int,
+        help="With --keyspace, the biggest keys listed per master",
+        default=DEFAULT_TOP_KEYS)
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Sample the nodes every INTERVAL seconds until interrupted, "
+        "keeping the last HISTORY snapshots of every node, serving the "
+        "current and peak rates over HTTP and writing the output file "
+        "every DUMP_INTERVAL minutes, on SIGUSR1 and at exit")
+
+    parser.add_argument(
+        "--history",
+        type=int,
+        help="With --daemon, the number of snapshots kept per node",
+        default=1440)
+
+    parser.add_argument(
+        "--peak-hours",
+        type=int,
+        help="With --daemon, the number of hourly averages kept per node "
+        "for the peak hour columns (default: a week)",
+        default=168)
+
+    parser.add_argument(
+        "--http-host",
+        help="With --daemon, the address of the HTTP endpoint",
+        default="127.0.0.1")
+
+    parser.add_argument(
+        "--http-port",
+        type=int,
+        help="With --daemon, the port of the HTTP endpoint serving /rates "
+        "(JSON), /metrics (OpenMetrics) and POST /dump, 0 to disable it",
+        default=9121)
+
+    parser.add_argument(
+        "--dump-interval",
+        type=int,
+        help="With --daemon, the minutes between writes of the output "
+        "file, 0 to write it on demand and at exit only",
+        default=60)
+
+    parser.add_argument(
+        "--command-categories",
+        metavar="FILE",
+        help="JSON file mapping command category metrics to additional "
+        "commands, e.g. {\"StringBasedCmds\": [\"getex\"], "
+        "\"JSONBasedCmds\": [\"json.get\", \"json.set\"]}",
+        default=None)
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of nodes connected to and sampled concurrently",
+        default=32)
+
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=['threads', 'asyncio'],
+        default='threads',
+        help="Sample the nodes on a thread pool, or with asyncio clients "
+        "which scale to thousands of nodes in one process")
+
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        help="Timeout in seconds for connecting to a node",
+        default=10)
+
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        help="Timeout in seconds for a node to reply to a command",
+        default=10)
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the nodes already collected by a failed run, as "
+        "recorded in the <output file>.journal file")
+
     parser.add_argument(
         "-o",
         "--output-file",
@@ -369,15 +1693,93 @@ def main():
         help='''
     Name of file results are written to. Defaults to OssStats.xlsx.
     ''')
+
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=FORMATS,
+        default=FORMATS[0],
+        help="Output format: xlsx writes the output file, the other formats "
+        "a ClusterData file named after it, e.g. OssStats-ClusterData.csv")
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record the round trips, latency and errors of every Redis "
+        "operation and print a summary at exit")
+
+    parser.add_argument(
+        "--profile-output",
+        metavar="FILE",
+        default=None,
+        help="Also write the profile to FILE, as JSON if its name ends with "
+        ".json and as OpenMetrics text otherwise (implies --profile)")
     args = parser.parse_args()
+    if args.daemon:
+        if args.engine != 'threads':
+            parser.error("--daemon samples the nodes with the threads "
+                         "engine")
+        if args.resume or args.keyspace:
+            parser.error("--resume and --keyspace can't be used with "
+                         "--daemon")
+        if args.interval is None:
+            args.interval = 60
+        if args.interval < 1 or args.history < 2 or args.peak_hours < 1 \
+                or args.dump_interval < 0:
+            parser.error("--interval and --peak-hours must be at least 1, "
+                         "--history at least 2 and --dump-interval at "
+                         "least 0")
+    elif args.interval is not None and \
+            not 0 < args.interval <= args.duration * 60:
+        parser.error("--interval must be between 1 and the duration "
+                     "in seconds")
+    try:
+        get_input_format(args.inputFile, args.input_format)
+    except InputError as e:
+        parser.error(str(e))
+    if args.keyspace:
+        if args.resume:
+            # Only the nodes sampled by the resumed run would be profiled
+            parser.error("--keyspace can't be used with --resume")
+        if args.keyspace_max_keys < 1 or args.keyspace_rate < 1 or \
+                args.keyspace_batch < 1 or args.keyspace_top < 0:
+            parser.error("--keyspace-max-keys, --keyspace-rate and "
+                         "--keyspace-batch must be at least 1, and "
+                         "--keyspace-top at least 0")
+
+    if args.profile or args.profile_output is not None:
+        PROFILER.enable(args.profile_output)
 
     # Startup parameters
     input_file = args.inputFile
 
     output_file = args.output_file
 
+    if args.command_categories is not None:
+        load_command_categories(args.command_categories)
+
     print("outputFile will be: {}".format(output_file))
-    process_file(input_file, output_file, args.duration)
+    client_kwargs = {
+        'socket_connect_timeout': args.connect_timeout,
+        'socket_timeout': args.read_timeout,
+    }
+    if args.daemon:
+        run_daemon(input_file, output_file, args.interval, args.workers,
+                   client_kwargs, args.history, args.peak_hours,
+                   args.http_host, args.http_port, args.dump_interval,
+                   args.format, args.input_format)
+        return
+    keyspace_kwargs = None
+    if args.keyspace:
+        keyspace_kwargs = {
+            'max_keys': args.keyspace_max_keys,
+            'keys_per_second': args.keyspace_rate,
+            'batch_size': args.keyspace_batch,
+            'top_keys': args.keyspace_top,
+        }
+    process_file(input_file, output_file, args.duration, args.workers,
+                 args.engine, client_kwargs, args.interval, args.resume,
+                 args.format, keyspace_kwargs, args.input_format)
 
 
 if __name__ == "__main__":
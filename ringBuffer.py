@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# A fixed-size ring buffer of NumPy rows, for the samples of long-running
+# collection: once full, every new row overwrites the oldest one, so the
+# memory used stays the same however long the collection runs.
+
+
+class RingBuffer(object):
+    """The last capacity rows appended, in a preallocated NumPy array"""
+
+    def __init__(self, capacity, shape=(), dtype=float):
+        """
+        Args:
+            capacity: the number of rows kept
+            shape: the shape of a row, () for scalars
+            dtype: the NumPy dtype of the rows
+        """
+        import numpy as np
+
+        if capacity < 1:
+            raise ValueError('A ring buffer holds at least one row')
+        self._data = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+        self._next = 0
+        self._length = 0
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def __len__(self):
+        return self._length
+
+    def append(self, row):
+        self._data[self._next] = row
+        self._next = (self._next + 1) % len(self._data)
+        self._length = min(self._length + 1, len(self._data))
+
+    def clear(self):
+        self._next = 0
+        self._length = 0
+
+    def last(self, count=1):
+        """The last count rows, oldest first"""
+        import numpy as np
+
+        count = min(count, self._length)
+        return self._data[np.arange(self._next - count, self._next) %
+                          len(self._data)]
+
+    def values(self):
+        """A copy of all the rows, oldest first"""
+        return self.last(self._length)
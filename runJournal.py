@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# A durable journal of the per-node results of a collection run: every
+# result is appended to a JSON lines file as soon as it is complete, so a
+# run that fails part way can be resumed without collecting again the nodes
+# that are already done.
+
+import json
+import os
+import threading
+
+from apiProfiler import PROFILER
+
+
+def to_json(value):
+    """Serialize the NumPy scalars found in the result rows"""
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+class RunJournal(object):
+    """Append (key, result) entries to a JSON lines file.
+
+    The first line holds a header describing the results (e.g. the result
+    columns); a journal whose header doesn't match is not resumed. Every
+    record call is flushed and fsync'ed before it returns. A line cut short
+    by a crash is ignored when the journal is read back.
+
+    A single instance may be shared by threads.
+    """
+
+    def __init__(self, path, header, resume=False):
+        """
+        Args:
+            path: the journal file
+            header: a JSON serializable description of the results
+            resume: load the entries of an existing journal and append to
+                it, instead of starting a new one
+        """
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            if self._load(header):
+                self._file = open(path, 'a')
+                # Keep a line cut short by a crash apart from the new ones
+                self._file.write('\n')
+                return
+            print('Journal %s was written for other results, starting '
+                  'over' % path)
+        elif resume:
+            print('No journal %s to resume, starting over' % path)
+        self._file = open(path, 'w')
+        self._write([json.dumps({'header': header})])
+
+    def _load(self, header):
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        try:
+            if not lines or json.loads(lines[0]) != {'header': header}:
+                return False
+        except ValueError:
+            return False
+        for line in lines[1:]:
+            try:
+                (key, value) = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by a crash
+                continue
+            self._entries[key] = value
+        print('Resuming from %s: %d results already collected' %
+              (self.path, len(self._entries)))
+        return True
+
+    def _write(self, lines):
+        self._file.write(''.join(line + '\n' for line in lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries[key]
+
+    def values(self):
+        """The recorded results, in the order they were first recorded"""
+        return list(self._entries.values())
+
+    def record(self, entries):
+        """Durably append several (key, result) entries"""
+        entries = list(entries)
+        lines = [json.dumps([key, value], default=to_json)
+                 for (key, value) in entries]
+        with self._lock, PROFILER.measure('journal.record'):
+            self._write(lines)
+            self._entries.update(
+                json.loads(line) for line in lines)
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """Close and delete the journal, once its results are written out"""
+        self.close()
+        os.remove(self.path)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# The input formats of inputReaders: the format told from the file
+# extension, and the rejection of unknown extensions.
+#
+#   python -m pytest tests  (or python -m unittest discover -s tests)
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from inputReaders import INPUT_EXTENSIONS, InputError, \
+    get_input_format  # noqa: E402
+
+
+class GetInputFormatTest(unittest.TestCase):
+
+    def test_format_of_every_known_extension(self):
+        for (extension, input_format) in INPUT_EXTENSIONS.items():
+            self.assertEqual(get_input_format('input' + extension),
+                             input_format)
+
+    def test_extension_is_case_insensitive(self):
+        self.assertEqual(get_input_format('Input.XLSX'), 'xlsx')
+        self.assertEqual(get_input_format('input.CSV'), 'csv')
+
+    def test_given_format_overrides_the_extension(self):
+        self.assertEqual(get_input_format('input.txt', 'jsonl'), 'jsonl')
+        self.assertEqual(get_input_format('input.xls', 'csv'), 'csv')
+
+    def test_stdin_has_no_format_unless_given(self):
+        self.assertIsNone(get_input_format('-'))
+        self.assertEqual(get_input_format('-', 'csv'), 'csv')
+
+    def test_unknown_extension_is_rejected(self):
+        for path in ['input.xls', 'input.json', 'input']:
+            with self.assertRaises(InputError):
+                get_input_format(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# The ranges of metricsCache.MetricsCache: which part of the collection
+# window of a series is fetched on a re-run, how the fetched datapoints are
+# merged with the cached ones, and what is evicted.
+#
+#   python -m pytest tests  (or python -m unittest discover -s tests)
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from metricsCache import SECONDS_IN_DAY, MetricsCache, \
+    get_settled_end  # noqa: E402
+
+PERIOD = 3600
+
+# A window of a day ending on an hour, and a run 30 minutes later: every
+# period of the window has settled by then
+END = 1704067200
+START = END - SECONDS_IN_DAY
+NOW = END + 1800
+
+KEY = 'cluster-0001/CPUUtilization/Average/3600'
+
+
+def get_points(start, end, value):
+    return [(ts, float(value)) for ts in range(start, end, PERIOD)]
+
+
+class MetricsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'metrics.sqlite')
+        self.cache = self.open_cache()
+
+    def tearDown(self):
+        self.cache.close()
+        self._dir.cleanup()
+
+    def open_cache(self, **kwargs):
+        return MetricsCache(self.path, **kwargs)
+
+    def at(self, now):
+        return mock.patch('metricsCache.time.time', return_value=now)
+
+    def get_range(self, start, end):
+        return self.cache.get_missing_ranges(
+            [KEY], start, end, [PERIOD])[KEY]
+
+    def put(self, start, end, points):
+        self.cache.put([(KEY, start, end, PERIOD, points)])
+
+    def test_settled_end(self):
+        self.assertEqual(get_settled_end(PERIOD, END, NOW), END)
+        # The last period ended 5 minutes ago and may still change
+        self.assertEqual(get_settled_end(PERIOD, END, END + 300),
+                         END - PERIOD)
+
+    def test_new_series_is_fetched_in_full(self):
+        with self.at(NOW):
+            self.assertEqual(self.get_range(START, END), (START, END))
+        self.assertEqual(self.cache.fetched, 1)
+
+    def test_series_complete_up_to_its_settled_period_is_skipped(self):
+        with self.at(NOW):
+            self.put(START, END, get_points(START, END, 1))
+            self.assertIsNone(self.get_range(START, END))
+        self.assertEqual(self.cache.cached, 1)
+
+    def test_period_in_progress_is_not_fetched_again_until_it_settles(self):
+        with self.at(END + 300):
+            self.put(START, END, get_points(START, END, 1))
+            self.assertIsNone(self.get_range(START, END))
+        with self.at(NOW):
+            self.assertEqual(self.get_range(START, END),
+                             (END - PERIOD, END))
+
+    def test_refresh_is_merged_with_the_cached_datapoints(self):
+        with self.at(NOW):
+            self.put(START, END, get_points(START, END, 1))
+        # The next run, an hour later, fetches the new hour only
+        with self.at(NOW + PERIOD):
+            (start, end) = self.get_range(START + PERIOD, END + PERIOD)
+            self.assertEqual((start, end), (END, END + PERIOD))
+            self.put(start, end, get_points(start, end, 2))
+            self.assertIsNone(self.get_range(START + PERIOD, END + PERIOD))
+            points = self.cache.get([KEY], START + PERIOD,
+                                    END + PERIOD)[KEY]
+        self.assertEqual(self.cache.refreshed, 1)
+        self.assertEqual(points, get_points(START + PERIOD, END, 1) +
+                         get_points(END, END + PERIOD, 2))
+
+    def test_refresh_replaces_the_datapoints_of_its_range(self):
+        with self.at(END + 300):
+            self.put(START, END, get_points(START, END, 1))
+        with self.at(NOW):
+            (start, end) = self.get_range(START, END)
+            self.put(start, end, get_points(start, end, 3))
+            points = self.cache.get([KEY], START, END)[KEY]
+        self.assertEqual(points, get_points(START, END - PERIOD, 1) +
+                         [(END - PERIOD, 3.0)])
+
+    def test_window_before_the_cached_range_is_fetched_in_full(self):
+        with self.at(NOW):
+            self.put(START, END, get_points(START, END, 1))
+            self.assertEqual(self.get_range(START - PERIOD, END),
+                             (START - PERIOD, END))
+            # The disjoint datapoints cached before are dropped
+            self.put(START - PERIOD, START, get_points(
+                START - PERIOD, START, 2))
+            points = self.cache.get([KEY], START - PERIOD, END)[KEY]
+        self.assertEqual(points, get_points(START - PERIOD, START, 2))
+
+    def test_max_age_skips_the_refresh(self):
+        self.cache.close()
+        self.cache = self.open_cache(max_age_seconds=2 * PERIOD)
+        with self.at(NOW):
+            self.put(START, END, get_points(START, END, 1))
+        with self.at(NOW + PERIOD):
+            self.assertIsNone(self.get_range(START + PERIOD, END + PERIOD))
+        with self.at(NOW + 3 * PERIOD):
+            self.assertEqual(self.get_range(START, END + 3 * PERIOD),
+                             (END, END + 3 * PERIOD))
+
+    def test_series_not_read_within_the_ttl_are_evicted(self):
+        self.cache.close()
+        self.cache = self.open_cache(ttl_days=1)
+        with self.at(NOW):
+            self.put(START, END, get_points(START, END, 1))
+        with self.at(NOW + 2 * SECONDS_IN_DAY):
+            self.assertEqual(self.cache.evict(), 1)
+            self.assertEqual(self.get_range(START, END), (START, END))
+
+
+if __name__ == '__main__':
+    unittest.main()
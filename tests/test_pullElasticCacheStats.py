@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# The GetMetricData calls of pullElasticCacheStats.py, checked against
+# botocore's Stubber: how the queries of the nodes are batched, how the
+# pages of a batch are followed, and how the results map back to the rows.
+#
+#   python -m pytest tests  (or python -m unittest discover -s tests)
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import boto3  # noqa: E402
+from botocore.stub import ANY, Stubber  # noqa: E402
+
+import pullElasticCacheStats  # noqa: E402
+from pullElasticCacheStats import MAX_QUERIES_PER_REQUEST, CacheNode, \
+    CloudWatchFetcher, get_avg_metrics, get_max_metrics, get_metric_data, \
+    get_metric_query, get_node_rows  # noqa: E402
+
+METRICS_PER_NODE = len(get_max_metrics() + get_avg_metrics())
+
+TIMESTAMP = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class StubbedSession(object):
+    """A boto3 session whose CloudWatch client is the stubbed one"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def client(self, service_name):
+        assert service_name == 'cloudwatch'
+        return self._client
+
+
+def get_result(query_id, values):
+    return {
+        'Id': query_id,
+        'Label': query_id,
+        'Timestamps': [TIMESTAMP] * len(values),
+        'Values': values,
+        'StatusCode': 'Complete',
+    }
+
+
+def get_expected_params(queries, next_token=None):
+    params = {'MetricDataQueries': queries, 'StartTime': ANY,
+              'EndTime': ANY}
+    if next_token is not None:
+        params['NextToken'] = next_token
+    return params
+
+
+class GetMetricDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = boto3.client(
+            'cloudwatch', region_name='us-east-1',
+            aws_access_key_id='test', aws_secret_access_key='test')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.fetcher = CloudWatchFetcher(StubbedSession(self.client))
+        # Don't wait between the stubbed calls
+        self.fetcher.limiter.rate = pullElasticCacheStats.MAX_REQUEST_RATE
+
+    def tearDown(self):
+        self.fetcher.__exit__(None, None, None)
+        self.stubber.deactivate()
+
+    def get_queries(self, count):
+        return [get_metric_query('q%d' % i, 'cluster', '0001',
+                                 'CPUUtilization', 'Maximum', 3600)
+                for i in range(count)]
+
+    def test_batches(self):
+        nodes = [CacheNode('cluster-%d' % i, '0001', '', 'cache.m5.large',
+                           'us-east-1a') for i in range(50)]
+        query_count = len(nodes) * METRICS_PER_NODE
+        batch_count = -(-query_count // MAX_QUERIES_PER_REQUEST)
+        for batch in range(batch_count):
+            first = batch * MAX_QUERIES_PER_REQUEST
+            last = min(first + MAX_QUERIES_PER_REQUEST, query_count)
+            self.stubber.add_response('get_metric_data', {
+                'MetricDataResults': [get_result('q%d' % i, [float(i)])
+                                      for i in range(first, last)]})
+
+        rows = get_node_rows(nodes, self.fetcher)
+
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(len(rows), len(nodes))
+        # The value of every query is found back in the row of its node
+        for i, (key, row) in enumerate(rows):
+            self.assertEqual(key, nodes[i].key)
+            self.assertEqual(row[4:], [float(i * METRICS_PER_NODE + j)
+                                       for j in range(METRICS_PER_NODE)])
+
+    def test_next_token(self):
+        queries = self.get_queries(3)
+        self.stubber.add_response(
+            'get_metric_data',
+            {'MetricDataResults': [get_result('q0', [1.0, 2.0]),
+                                   get_result('q1', [3.0])],
+             'NextToken': 'page-2'},
+            get_expected_params(queries))
+        self.stubber.add_response(
+            'get_metric_data',
+            {'MetricDataResults': [get_result('q1', [4.0]),
+                                   get_result('q2', [5.0])]},
+            get_expected_params(queries, 'page-2'))
+
+        results = get_metric_data(self.fetcher, queries, 0, 3600)
+
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual({query_id: [value for (_, value) in data_points]
+                          for query_id, data_points in results.items()},
+                         {'q0': [1.0, 2.0], 'q1': [3.0, 4.0], 'q2': [5.0]})
+
+    def test_no_data_points(self):
+        node = CacheNode('cluster', '0001', '', 'cache.m5.large',
+                         'us-east-1a')
+        self.stubber.add_response('get_metric_data', {
+            'MetricDataResults': [get_result('q0', [7.0])] +
+            [get_result('q%d' % i, []) for i in range(1, METRICS_PER_NODE)]})
+
+        [(_, row)] = get_node_rows([node], self.fetcher)
+
+        self.assertEqual(row[4:], [7.0] + [0] * (METRICS_PER_NODE - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
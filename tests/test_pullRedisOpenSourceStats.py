@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# The sampling targets and command counters of pullRedisOpenSourceStats.py:
+# every node is sampled once whatever the rows that reach it, and the
+# commandstats calls are bucketed by COMMAND_INDEX.
+#
+#   python -m pytest tests  (or python -m unittest discover -s tests)
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import pullRedisOpenSourceStats  # noqa: E402
+from inputReaders import Endpoint  # noqa: E402
+from pullRedisOpenSourceStats import OTHER_CMDS_METRIC, TargetSet, \
+    get_cmd_metrics, get_counters  # noqa: E402
+
+
+def get_topology(db_id, *node_ids):
+    """A topology of the DB, the first node being the master of its shard"""
+    return (db_id, [(node_id, 'node-%s' % node_id, position == 0)
+                    for position, node_id in enumerate(node_ids)])
+
+
+class TargetSetTest(unittest.TestCase):
+
+    def test_nodes_of_a_db_are_added_once(self):
+        targets = TargetSet()
+        first = Endpoint('10.0.0.1')
+        targets.add(first, get_topology('db-1', 'a', 'b'))
+        # Another seed node of the same DB
+        targets.add(Endpoint('10.0.0.2'), get_topology('db-1', 'b', 'a'))
+        self.assertEqual(targets.targets, [(first, 'node-a', True),
+                                           (first, 'node-b', False)])
+
+    def test_node_shared_by_dbs_is_added_for_the_first_row(self):
+        targets = TargetSet()
+        first = Endpoint('10.0.0.1')
+        second = Endpoint('10.0.0.2')
+        targets.add(first, get_topology('db-1', 'a', 'b'))
+        targets.add(second, get_topology('db-2', 'b', 'c'))
+        self.assertEqual(targets.targets, [(first, 'node-a', True),
+                                           (first, 'node-b', False),
+                                           (second, 'node-c', False)])
+
+    def test_failed_discovery_adds_nothing(self):
+        targets = TargetSet()
+        targets.add(Endpoint('10.0.0.1'), None)
+        self.assertEqual(targets.targets, [])
+
+
+class GetCountersTest(unittest.TestCase):
+
+    def setUp(self):
+        self._categories = [(metric, list(commands)) for metric, commands
+                            in pullRedisOpenSourceStats.COMMAND_CATEGORIES]
+
+    def tearDown(self):
+        pullRedisOpenSourceStats.COMMAND_CATEGORIES[:] = self._categories
+        pullRedisOpenSourceStats.COMMAND_INDEX = \
+            pullRedisOpenSourceStats.build_command_index(self._categories)
+
+    def get_counters(self, calls, total=0):
+        counters = get_counters(
+            (calls, {'total_commands_processed': total}, None))
+        return dict(zip(get_cmd_metrics(), counters))
+
+    def test_commands_are_bucketed_by_category(self):
+        counters = self.get_counters(
+            {'get': 3, 'set': 2, 'xadd': 5, 'hset': 7}, total=17)
+        self.assertEqual(counters['StringBasedCmds'], 5)
+        self.assertEqual(counters['StreamBasedCmds'], 5)
+        self.assertEqual(counters['HashBasedCmds'], 7)
+        self.assertEqual(counters[OTHER_CMDS_METRIC], 0)
+        self.assertEqual(counters['TotalOps'], 17)
+
+    def test_subcommands_fall_back_to_their_command(self):
+        counters = self.get_counters({'xinfo|stream': 2, 'config|get': 1,
+                                      'ping': 4})
+        self.assertEqual(counters['StreamBasedCmds'], 2)
+        self.assertEqual(counters[OTHER_CMDS_METRIC], 5)
+
+    def test_loaded_categories_rebuild_the_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'categories.json')
+            with open(path, 'w') as f:
+                json.dump({'ScriptCmds': ['EVAL', 'evalsha'],
+                           'KeyBasedCmds': ['get']}, f)
+            pullRedisOpenSourceStats.load_command_categories(path)
+        counters = self.get_counters({'eval': 1, 'evalsha': 2, 'get': 3,
+                                      'set': 4})
+        self.assertEqual(counters['ScriptCmds'], 3)
+        # A listed command moves to the category it is listed under
+        self.assertEqual(counters['KeyBasedCmds'], 3)
+        self.assertEqual(counters['StringBasedCmds'], 4)
+        self.assertEqual(counters[OTHER_CMDS_METRIC], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
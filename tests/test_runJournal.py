@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# The resume of a runJournal.RunJournal: the results recorded by a run that
+# stopped part way are read back, a line cut short by a crash is ignored,
+# and a journal of other results is started over.
+#
+#   python -m pytest tests  (or python -m unittest discover -s tests)
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import numpy as np  # noqa: E402
+
+from runJournal import RunJournal  # noqa: E402
+
+COLUMNS = ['Source', 'Node', 'Ops']
+
+
+class RunJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'run.journal')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def write_journal(self, entries):
+        journal = RunJournal(self.path, COLUMNS)
+        journal.record(entries)
+        journal.close()
+
+    def test_resume_reads_back_the_recorded_results(self):
+        self.write_journal([('node-1', ['a', 'node-1', 10]),
+                            ('node-2', ['a', 'node-2', 20])])
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        journal.record([('node-3', ['b', 'node-3', 30])])
+        journal.close()
+
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(len(journal), 3)
+        self.assertIn('node-1', journal)
+        self.assertNotIn('node-4', journal)
+        self.assertEqual(journal.get('node-2'), ['a', 'node-2', 20])
+        self.assertEqual(journal.values(), [['a', 'node-1', 10],
+                                            ['a', 'node-2', 20],
+                                            ['b', 'node-3', 30]])
+        journal.close()
+
+    def test_numpy_scalars_are_recorded_as_numbers(self):
+        self.write_journal([('node-1', ['a', 'node-1', np.int64(10)]),
+                            ('node-2', ['a', 'node-2', np.float64(0.5)])])
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(journal.values(), [['a', 'node-1', 10],
+                                            ['a', 'node-2', 0.5]])
+        journal.close()
+
+    def test_line_cut_short_is_ignored(self):
+        self.write_journal([('node-1', ['a', 'node-1', 10])])
+        with open(self.path, 'a') as f:
+            f.write('["node-2", ["a", "no')
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(len(journal), 1)
+        self.assertNotIn('node-2', journal)
+        journal.record([('node-2', ['a', 'node-2', 20])])
+        journal.close()
+
+        # The results recorded after the torn line are read back too
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(journal.get('node-2'), ['a', 'node-2', 20])
+        self.assertEqual(len(journal), 2)
+        journal.close()
+
+    def test_journal_of_other_results_is_started_over(self):
+        self.write_journal([('node-1', ['a', 'node-1', 10])])
+        journal = RunJournal(self.path, COLUMNS + ['Keys'], resume=True)
+        self.assertEqual(len(journal), 0)
+        journal.close()
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(len(journal), 0)
+        journal.close()
+
+    def test_without_resume_the_journal_is_started_over(self):
+        self.write_journal([('node-1', ['a', 'node-1', 10])])
+        RunJournal(self.path, COLUMNS).close()
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(len(journal), 0)
+        journal.close()
+
+    def test_missing_journal_is_started(self):
+        journal = RunJournal(self.path, COLUMNS, resume=True)
+        self.assertEqual(len(journal), 0)
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()